@@ -1,11 +1,10 @@
 import os,getopt
 import sys
 import csv
-import itertools
 import pickle
+import itertools
 
 from Bio.Seq import Seq
-from Bio import SeqIO
 from Bio import Align
 
 import numpy as np
@@ -14,142 +13,61 @@ from multiprocessing import Pool
 from multiprocessing import get_context
 
 import extract_aligned_genes as align_utils
+import alignment_engine as align_engine
+import reference_bundle
+import packed_genome
+import progress_events
+import locus_config
+from locus_config import V, D, J, DR, DL
 
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-#INITIALIZE VARIABLES, default = IGH
-V = 'V'
-D = 'D'
-J = 'J'
-DR = 'D_right'
-DL = 'D_left'
 FWD = '+'
 REV = '-'
 GENE_TYPES = [V,D,J]
-GENE_TYPES_TOFIND = [V,D,J]
-SPACER_LENGTH = {V:23 , DL:12 , DR:12 , J:23}
-GENE_LENGTH = {V: 350 , J: 70, D:150}
 ALIGNMENT_EXTENSION = {V:REV , J:FWD, D:None}
-PI_CUTOFF = {'strict' : {V: 70, J: 70} , 'relax': {V: 60 ,J: 65}}
-MAXK_CUTOFF = {V: 15 , J: 11}
+#long sequences are scanned in overlapping chunks, so that a single contig is split across all processes
+MIN_CHUNK_SIZE = 50000
+MAX_CHUNK_SIZE = 1000000
+NUM_THREADS = 1
 
 ALIGNER = Align.PairwiseAligner()
-
-def InitializeVariables(locus):
-    if locus == 'IGK':
-        SPACER_LENGTH = {V:12, DL:23, DR:12, J:23}
-        GENE_TYPES_TOFIND = [V,J]
-    if locus == 'IGL':
-        SPACER_LENGTH = {V:23, DL:12, DR:23, J:12}    
-        GENE_TYPES_TOFIND = [V,J]
-    if locus == 'TRA':
-        SPACER_LENGTH = {V:23, J:12}
-        GENE_TYPES_TOFIND = [V,J]
-    if locus == 'TRB':
-        SPACER_LENGTH = {V:23, J:12, DL:12, DR:23}
-        GENE_TYPES_TOFIND = [V,D,J]
-    if locus == 'TRD':
-        SPACER_LENGTH = {V:23, J:12, DL:12, DR:23}
-        GENE_TYPES_TOFIND = [V,D,J]
+REFERENCE_SET = None
+BUNDLE = None
+VALID_MOTIFS = None
 
 #READ DATAFILES
-try:
-    motifs_file = os.path.join(SCRIPT_DIR[:-3], 'datafiles', 'motifs')
-    with open(motifs_file, 'rb') as f:   
-        VALID_MOTIFS = pickle.load(f)
-except:
-    print("Error: could not find the input data files. Please make sure the IGDetective.py file and datafiles folder are in the same directory")
-
-#PARSE COMMAND LINE ARGUMENTS
-argumentList = sys.argv[1:]
-options = "hi:o:m:rg:l:"
-long_options = ["help","input_file=", "output_directory=", "multi_process=", "rss_only" , "genes_type=", "locus="]
-force_output = True
-received_input = False
-LOCUS = 'IGH'
-RSS_MODE = False
-help_flag = False
-NUM_THREADS = 1
-try:
-    arguments, values = getopt.getopt(argumentList, options, long_options)
-    for currentArgument, currentValue in arguments:
-        if currentArgument in ("-h", "--help"):
-            print ("Diplaying Help")
-            print("Flags and their usage :")
-            print("-h , --help : Get this message")
-            print("-i, --input_file : provide a fasta file for gene detection")
-            print("-o, --output_directory : (optional) provide an output directory for generated results. Default location is in the parent directory of the input file")
-            print("-l, --locus : immunoglobulin locus IGH, IGK, or IGL. Default is IGH")
-            print("-m, --multi_process : (optional) provide number of parallel processing units if available. Default is 1")
-            print("-r, --rss_only : (optional) switch to RSS finding mode")
-            print("-g, --genes_type : (optional) specify which genes (v,d,j) to find. Eg: vdj, d, vj, jv. Default is vdj")
-            help_flag = True
-            
-        elif currentArgument in ("-i", "--input_file"):
-            INPUT_PATH = str(currentValue)
-            received_input = True
-        
-        elif currentArgument in ("-o", "--output_directory"):
-            OUTPUT_PATH = str(currentValue)
-            force_output = False
-
-        elif currentArgument in ("-l", "--locus"):
-            if currentValue not in ['IGH', 'IGK', 'IGL', 'TRA', 'TRB', 'TRG']:
-                print('Incorrect locus argument: ' + currentValue)
-                sys.exit(1)
-            LOCUS = currentValue
-            InitializeVariables(LOCUS)
-
-        elif currentArgument in ("-m", "--multi_process"):
-            NUM_THREADS = int(currentValue)
-
-        elif currentArgument in ("-r", "--rss_only"):
-            RSS_MODE = True
-
-    if not received_input and not help_flag:
-        raise NameError('no input file was given')
-                
-except getopt.error as err:
-    print (str(err))
-    sys.exit(0)
-
-if force_output == True:
-    OUTPUT_PATH = ".".join(INPUT_PATH.split('.')[:-1])
-if not os.path.exists(OUTPUT_PATH):
-    os.makedirs(OUTPUT_PATH)
-    
-#create signal types from gene types
-SIGNAL_TYPES = []
-if V in GENE_TYPES_TOFIND:
-    SIGNAL_TYPES.append(V)
-if J in GENE_TYPES_TOFIND:
-    SIGNAL_TYPES.append(J)
-if D in GENE_TYPES_TOFIND:
-    SIGNAL_TYPES.extend([DL,DR])
-
-
-#READ INPUT FASTA FILE
-input_seq_dict= {rec.id : rec.seq for rec in SeqIO.parse(INPUT_PATH, "fasta")}
-
-canonical_genes = {V : {} , J : {}}
-for gene in (V,J):
-    file_path = os.path.join(SCRIPT_DIR[:-3], 'datafiles', 'combined_reference_genes', LOCUS + gene + '.fa') #'datafiles/human_{}.fasta'.format(gene)
-    canonical_genes[gene] = {rec.id : rec.seq.upper() for rec in SeqIO.parse(file_path, "fasta")}
+#reference genes and motif lookup tables are memory-mapped from the compiled reference bundle. The bundle is loaded
+#(and compiled if it is stale) on the first search rather than on import, before the worker pools are forked
+def load_reference_data():
+    global BUNDLE, VALID_MOTIFS
+    if BUNDLE is None:
+        bundle = reference_bundle.LoadBundle()
+        VALID_MOTIFS = {st : {k : bundle.MotifTable(st, k) for k in ('7', '9')} for st in (V, J, DL, DR)}
+        BUNDLE = bundle
+
+#read reference genes of the gene types that are aligned for the locus
+def read_canonical_genes(config):
+    canonical_genes = {}
+    for gene in config.AlignedGeneTypes():
+        gene_type = config.locus + gene
+        canonical_genes[gene] = dict(zip(BUNDLE.GeneIds(gene_type), BUNDLE.GeneSeqs(gene_type)))
+    return canonical_genes
 
 #DEFINE RSS FINDING METHODS
-#Find indexes of valid motifs
-def find_valid_motif_idx(locus,motifs,k):
-    motif_idx = []
-    for i in range(0,len(locus)- int(k) +1):
-        candidate = locus[i:i+int(k)].upper()
-        if candidate in motifs:
-            motif_idx.append(i)
-    return set(motif_idx)
+#Find indexes of valid motifs, k-mers are looked up in the motif table of the signal type
+#locus is a packed sequence view (or a string), its 2-bit codes are unpacked by the worker
+def find_valid_motif_idx(locus,sig_type,k,offset = 0):
+    motifs = VALID_MOTIFS[sig_type][str(k)]
+    kmers, is_valid = reference_bundle.KmerCodes(packed_genome.EncodeSequence(locus), int(k))
+    return set((np.flatnonzero(is_valid & motifs[kmers]) + offset).tolist())
+
+def find_valid_motif_task(task):
+    return find_valid_motif_idx(*task)
 
 #return idx of heptamer and nonamer
-def find_valid_rss(heptamer_idx, nonamer_idx, sig_type, strand, seq_length):
+def find_valid_rss(heptamer_idx, nonamer_idx, sig_type, strand, seq_length, spacer):
     rss_idx = []
-    spacer = SPACER_LENGTH[sig_type]
     
     #set the 5' appearing k-mer
     if sig_type == V or sig_type == DR:
@@ -162,7 +80,7 @@ def find_valid_rss(heptamer_idx, nonamer_idx, sig_type, strand, seq_length):
         second_set = heptamer_idx
     
     #search for spacer separation between heptamer and nonamer    
-    for idx in first_set:
+    for idx in sorted(first_set):
         if spacer + idx + k_first in second_set:
             rss_idx.append((idx ,spacer  + idx + k_first))
         elif spacer - 1 + idx + k_first in second_set:
@@ -179,38 +97,58 @@ def find_valid_rss(heptamer_idx, nonamer_idx, sig_type, strand, seq_length):
 
     return rss_idx
 
+#split a sequence into overlapping chunks [start, end)
+def get_chunk_bounds(seq_length, overlap):
+    chunk_size = -(-seq_length // NUM_THREADS)
+    chunk_size = min(MAX_CHUNK_SIZE, max(MIN_CHUNK_SIZE, chunk_size))
+    return [(start, min(seq_length, start + chunk_size + overlap)) for start in range(0, max(seq_length, 1), chunk_size)]
+
 #combine data of heptamer and nonamer indexes
-def get_contigwise_rss(sig_type,strand,parent_seq):
+def get_contigwise_rss(sig_type,strand,parent_seq,config):
     parallel_heptamers = []
     parallel_nonamers = []
     parallel_rss = []
+    chunk_contigs = []
+    #a motif pair spans at most spacer + heptamer + nonamer positions
+    overlap = config.spacer_length[sig_type] + 1 + 7 + 9
     
-    #find valid heptamer and nonamers motifs
+    #find valid heptamer and nonamers motifs, chunks are views of the packed sequences
     for i,contigs in enumerate(list(parent_seq.keys())):
         if strand == FWD:
-            sequence = str(parent_seq[contigs])
+            sequence = parent_seq[contigs]
         elif strand == REV:
-            sequence = str(parent_seq[contigs].reverse_complement())
-            
-        parallel_heptamers.append((sequence, VALID_MOTIFS[sig_type]['7'], 7))
-        parallel_nonamers.append((sequence, VALID_MOTIFS[sig_type]['9'], 9))
+            sequence = parent_seq[contigs].reverse_complement()
+
+        for start, end in get_chunk_bounds(len(sequence), overlap):
+            chunk = sequence[start:end]
+            parallel_heptamers.append((chunk, sig_type, 7, start))
+            parallel_nonamers.append((chunk, sig_type, 9, start))
+            chunk_contigs.append(i)
 
 #    p = Pool(NUM_THREADS)    
-    p = get_context("fork").Pool(NUM_THREADS)
-    heptamer_resultset = p.starmap(find_valid_motif_idx,parallel_heptamers)
-    nonamer_resultset = p.starmap(find_valid_motif_idx,parallel_nonamers)
-
-    #combine valid heptamer and nonamer motifs
-    for i,contig in enumerate(list(parent_seq.keys())):
-        L = len(parent_seq[contig])
-        parallel_rss.append((heptamer_resultset[i], nonamer_resultset[i], sig_type, strand, L)) 
-    result = p.starmap(find_valid_rss , parallel_rss)
+    progress = progress_events.Progress('rss_scan', len(parallel_heptamers) + len(parallel_nonamers), locus = config.locus, signal_type = sig_type, strand = strand)
+    with get_context("fork").Pool(NUM_THREADS) as p:
+        heptamer_resultset = list(progress.Track(p.imap(find_valid_motif_task,parallel_heptamers)))
+        nonamer_resultset = list(progress.Track(p.imap(find_valid_motif_task,parallel_nonamers)))
+
+        #merge chunks of the same contig, motifs found in overlaps are reported twice
+        contig_heptamers = [set() for contig in parent_seq]
+        contig_nonamers = [set() for contig in parent_seq]
+        for i, hepta, nona in zip(chunk_contigs, heptamer_resultset, nonamer_resultset):
+            contig_heptamers[i] |= hepta
+            contig_nonamers[i] |= nona
+
+        #combine valid heptamer and nonamer motifs
+        for i,contig in enumerate(list(parent_seq.keys())):
+            L = len(parent_seq[contig])
+            parallel_rss.append((contig_heptamers[i], contig_nonamers[i], sig_type, strand, L, config.spacer_length[sig_type]))
+        result = p.starmap(find_valid_rss , parallel_rss)
     rss_resultset = {contig : result[i] for i,contig in enumerate(list(parent_seq.keys()))}
 
     return rss_resultset
 
 #D_left(D_right) idx is of the form "input_rss_info['D_left(D_right)']"
-def combine_D_RSS(D_left_idx , D_right_idx, input_seq_dict, strand, Dgene_len = GENE_LENGTH[D]):
+def combine_D_RSS(D_left_idx , D_right_idx, input_seq_dict, strand, Dgene_len):
     rss_resultset = {contigs : [] for contigs in input_seq_dict.keys()}
     for contig in input_seq_dict:
         for dr in D_right_idx[contig]:
@@ -268,12 +206,12 @@ def extract_s_fragment(index, extract_dir, length, parent_seq):
         fragment = parent_seq[index-length:index]
     return fragment
 
-def get_s_fragment_from_RSS(gene, strand):
+def get_s_fragment_from_RSS(gene, strand, input_rss_info, input_seq_dict, config):
     s_fragments = {contig : [] for contig in input_rss_info[gene][strand]}
     if (gene == V and strand == FWD) or (gene == J and strand == REV):
         for contig in input_rss_info[gene][strand]:
             for rss in input_rss_info[gene][strand][contig]:
-                fragment = extract_s_fragment(rss[0], REV, GENE_LENGTH[gene], input_seq_dict[contig])
+                fragment = extract_s_fragment(rss[0], REV, config.gene_length[gene], input_seq_dict[contig])
                 s_fragments[contig].append(fragment)
             if strand == REV:
                 s_fragments[contig] = [x.reverse_complement() for x in s_fragments[contig]]
@@ -281,7 +219,7 @@ def get_s_fragment_from_RSS(gene, strand):
     elif (gene == J and strand == FWD) or (gene == V and strand == REV):
         for contig in input_rss_info[gene][strand]:
             for rss in input_rss_info[gene][strand][contig]:
-                fragment = extract_s_fragment(rss[0] + 7, FWD, GENE_LENGTH[gene], input_seq_dict[contig])
+                fragment = extract_s_fragment(rss[0] + 7, FWD, config.gene_length[gene], input_seq_dict[contig])
                 s_fragments[contig].append(fragment)
             if strand == REV:
                 s_fragments[contig] = [x.reverse_complement() for x in s_fragments[contig]]
@@ -319,52 +257,34 @@ def ComputeAlignment(seq_A, seq_B, extend_alignment = None):
     else:
         return alignment_rc, '-', rev_matches
 
-def align_fragment_to_genes(fragments, canon_genes, scoring_scheme, gene):
+#score a fragment and its reverse complement against all reference genes
+def score_fragment(seq_A):
+    query = Seq(str(seq_A).upper())
+    if len(query) == 0:
+        query = Seq('A' * int(max(REFERENCE_SET.lengths)))
+    summary, _ = align_engine.SearchFragmentBothStrands(query, query.reverse_complement(), REFERENCE_SET)
+    return summary.PI(), summary.spans
+
+#clustered reference genes are searched hierarchically: centroids first, then members of the best clusters
+def align_fragment_to_genes(fragments, canon_genes, scoring_scheme, gene, clusters = None):
+    global REFERENCE_SET
     set_aligner(scoring_scheme)
-    parallel_alignments = []
-    pis = []
-    alignment_lens = []
-
-# non-parallel version
-#    alignment_results = []
-#    for i in range(0, len(fragments)):
-#        for j in range(0, len(canon_genes)):
-#            seq_A = fragments[i]
-#            seq_B = canon_genes[j]
-#            if len(seq_A) == 0:
-#                seq_A = 'A' * len(seq_B)
-#            alignment_results.append(ComputeAlignment(seq_A, seq_B))    
-
-    for i in range(0,len(fragments)):
-        for j in range(0,len(canon_genes)):
-            seq_A = fragments[i]
-            seq_B = canon_genes[j]
-            if len(seq_A) == 0:
-                seq_A = 'A' * len(seq_B) #canon_genes[j]
-            parallel_alignments.append((seq_A,seq_B,ALIGNMENT_EXTENSION[gene]))
-            
-    p = get_context("fork").Pool(NUM_THREADS)
-    alignment_results = p.starmap(ComputeAlignment, parallel_alignments)
-    for a in alignment_results:
-        alignment = a[0]
-        strand = a[1]
-        num_matches = a[2]
-        bio_align = align_utils.BioAlign(alignment)
-        pis.append(bio_align.PI())
-        alignment_lens.append(len(bio_align))
-        
-    pi_mat = np.zeros((len(fragments), len(canon_genes)))
-    alig_len_mat = np.zeros((len(fragments), len(canon_genes)))
-    
-    for i in range(0,len(fragments)):
-        for j in range(0,len(canon_genes)):
-            pi_mat[i][j] = pis.pop(0)
-            alig_len_mat[i][j] = alignment_lens.pop(0)
+    REFERENCE_SET = align_engine.ReferenceSet(canon_genes, clusters = clusters, identity = BUNDLE.ClusterIdentity())
+    if len(fragments) == 0:
+        return np.zeros((0, len(canon_genes))), np.zeros((0, len(canon_genes)))
+
+    #fragments are views of packed sequences, tasks carry contig offsets rather than sequences
+    chunksize = max(1, len(fragments) // (NUM_THREADS * 4))
+    progress = progress_events.Progress('fragment_alignment', len(fragments), gene = gene)
+    with get_context("fork").Pool(NUM_THREADS) as p:
+        alignment_results = list(progress.Track(p.imap(score_fragment, fragments, chunksize)))
+    pi_mat = np.array([a[0] for a in alignment_results])
+    alig_len_mat = np.array([a[1] for a in alignment_results], dtype = float)
     return pi_mat , alig_len_mat
 
   
 #Evaluate and print genes
-def extract_genes(parent_seq, gene, rss_idx, fragments, fragment_alignments):
+def extract_genes(parent_seq, gene, rss_idx, fragments, fragment_alignments, canonical_genes, config):
     final_genes = []
     if gene == D:
         for strand in rss_idx:
@@ -387,7 +307,7 @@ def extract_genes(parent_seq, gene, rss_idx, fragments, fragment_alignments):
                 f = fragments[strand][contig]
                 c = list(canonical_genes[gene].keys()) 
                 for i,e in enumerate(fragment_alignments[strand][contig]):
-                    if e[1] >= PI_CUTOFF['strict'][gene] or (e[1] >= PI_CUTOFF['relax'][gene] and e[2] >= MAXK_CUTOFF[gene]):
+                    if e[1] >= config.pi_cutoff['strict'][gene] or (e[1] >= config.pi_cutoff['relax'][gene] and e[2] >= config.maxk_cutoff[gene]):
                         a = ComputeAlignment(f[i], canonical_genes[gene][c[e[0]]], ALIGNMENT_EXTENSION)
                         alignment = align_utils.BioAlign(a[0])
                         alig_direction = a[1]
@@ -397,7 +317,7 @@ def extract_genes(parent_seq, gene, rss_idx, fragments, fragment_alignments):
                         if strand == FWD:
                             if gene == V:
                                 ge = r[i][0] -1
-                                gs = r[i][0]- GENE_LENGTH[gene] + start
+                                gs = r[i][0]- config.gene_length[gene] + start
                             elif gene == J:
                                 gs = r[i][0] + 7
                                 ge = gs + end
@@ -408,7 +328,7 @@ def extract_genes(parent_seq, gene, rss_idx, fragments, fragment_alignments):
                         elif strand == REV:
                             if gene == V:
                                 gs = r[i][0] + 7
-                                ge = gs + GENE_LENGTH[gene] - start -1
+                                ge = gs + config.gene_length[gene] - start -1
                             #    predicted_gene = parent_seq[contig][gs:ge+1].reverse_complement().upper()
                             elif gene == J:
                                 ge = r[i][0] -1
@@ -439,54 +359,141 @@ def print_predicted_genes(filepath, gene, predictions):
         writer.writerows(detected_gene_info)
 
 
-print("Finding immunoglobulin genes for locus " + LOCUS + '...')
-
-#FIND RSS IN INPUT FASTA
-print("Finding candidate RSS...",end =" ")
-input_rss_info = {st : {strand : get_contigwise_rss(st,strand, input_seq_dict) for strand in (FWD , REV)} for st in SIGNAL_TYPES}
-if D in GENE_TYPES_TOFIND:
-    input_rss_info[D] = { strand: combine_D_RSS(input_rss_info[DL][strand] , input_rss_info[DR][strand], input_seq_dict , strand)\
-                       for strand in (FWD, REV)}
-print("Done")
-if RSS_MODE:
-    for st in SIGNAL_TYPES:
-        write_rss_to_file('{}/rss_{}.csv'.format(OUTPUT_PATH, st), input_rss_info[st], input_seq_dict)
-    sys.exit(0)
-
-
-#create and alingn S fragments
-s_fragments = {g : {strand : get_s_fragment_from_RSS(g,strand) for strand in (FWD, REV)} for g in GENE_TYPES_TOFIND}
-fragments_to_align = {gene : [] for gene in GENE_TYPES_TOFIND}
-for gene in GENE_TYPES_TOFIND:
-    for strand in (FWD,REV):
-        for contig in s_fragments[gene][strand]:
-            fragments_to_align[gene].extend(s_fragments[gene][strand][contig])
-
-print("Aligning candidate genes...",end =" ")          
-s_fragment_alignment = {gene : { strand : {contig : [] for contig in s_fragments[gene][strand]} for strand in (FWD,REV)} for gene in GENE_TYPES_TOFIND}
-for gene in GENE_TYPES_TOFIND:
-    if gene == D:
-        continue
-    pi_mat , _ = align_fragment_to_genes(fragments_to_align[gene], list(canonical_genes[gene].values()) , 'AFFINE', gene)
-    _ , maxk_mat = align_fragment_to_genes(fragments_to_align[gene], list(canonical_genes[gene].values()) , 'MAXK', gene)
-    k = 0
-    for strand in (FWD,REV):
-        for contig in s_fragments[gene][strand]:
-            for sequence in s_fragments[gene][strand][contig]:
-                best_alignment_index = np.argmax(pi_mat[k])
-                pi = pi_mat[k][best_alignment_index]
-                maxk = maxk_mat[k][best_alignment_index]
-                k+=1
-                s_fragment_alignment[gene][strand][contig].append((best_alignment_index,pi,maxk))
-print("Done")
-
-#Print genes to tsv file
-for gene in GENE_TYPES_TOFIND:
-#    print(gene, input_rss_info[gene], s_fragments[gene], s_fragment_alignment[gene])
-    if gene == D:
-        print_predicted_genes('{}/genes_{}.tsv'.format(OUTPUT_PATH, D) , D, extract_genes(input_seq_dict, D, input_rss_info[D], None, None))
-    else:
-        predictions = extract_genes(input_seq_dict, gene, input_rss_info[gene], s_fragments[gene], s_fragment_alignment[gene])
-        print_predicted_genes('{}/genes_{}.tsv'.format(OUTPUT_PATH, gene) , gene, predictions)
 
-print("Please see {}/ for gene predictions".format(OUTPUT_PATH))  
+def find_genes(input_seq_dict, config, output_path, rss_mode = False):
+    load_reference_data()
+    print("Finding immunoglobulin genes for locus " + config.locus + '...')
+    signal_types = config.SignalTypes()
+    gene_types = config.gene_types
+
+    #FIND RSS IN INPUT FASTA
+    print("Finding candidate RSS...",end =" ")
+    with progress_events.Stage('rss_scan', locus = config.locus, contigs = len(input_seq_dict)):
+        input_rss_info = {st : {strand : get_contigwise_rss(st,strand, input_seq_dict, config) for strand in (FWD , REV)} for st in signal_types}
+        if config.HasDGenes():
+            input_rss_info[D] = { strand: combine_D_RSS(input_rss_info[DL][strand] , input_rss_info[DR][strand], input_seq_dict , strand, config.gene_length[D])\
+                               for strand in (FWD, REV)}
+    for st in input_rss_info:
+        progress_events.Count('rss_scan', 'rss', sum(len(input_rss_info[st][strand][contig]) for strand in (FWD, REV) for contig in input_rss_info[st][strand]), locus = config.locus, signal_type = st)
+    print("Done")
+    if rss_mode:
+        for st in signal_types:
+            write_rss_to_file('{}/rss_{}.csv'.format(output_path, st), input_rss_info[st], input_seq_dict)
+        return
+
+    #create and alingn S fragments
+    canonical_genes = read_canonical_genes(config)
+    s_fragments = {g : {strand : get_s_fragment_from_RSS(g,strand, input_rss_info, input_seq_dict, config) for strand in (FWD, REV)} for g in gene_types}
+    fragments_to_align = {gene : [] for gene in gene_types}
+    for gene in gene_types:
+        for strand in (FWD,REV):
+            for contig in s_fragments[gene][strand]:
+                fragments_to_align[gene].extend(s_fragments[gene][strand][contig])
+
+    print("Aligning candidate genes...",end =" ")          
+    s_fragment_alignment = {gene : { strand : {contig : [] for contig in s_fragments[gene][strand]} for strand in (FWD,REV)} for gene in gene_types}
+    for gene in config.AlignedGeneTypes():
+        with progress_events.Stage('fragment_alignment', locus = config.locus, gene = gene, fragments = len(fragments_to_align[gene])):
+            pi_mat , maxk_mat = align_fragment_to_genes(fragments_to_align[gene], list(canonical_genes[gene].values()) , 'AFFINE', gene, BUNDLE.Clusters(config.locus + gene))
+        k = 0
+        for strand in (FWD,REV):
+            for contig in s_fragments[gene][strand]:
+                for sequence in s_fragments[gene][strand][contig]:
+                    best_alignment_index = np.argmax(pi_mat[k])
+                    pi = pi_mat[k][best_alignment_index]
+                    maxk = maxk_mat[k][best_alignment_index]
+                    k+=1
+                    s_fragment_alignment[gene][strand][contig].append((best_alignment_index,pi,maxk))
+    print("Done")
+
+    #Print genes to tsv file
+    for gene in gene_types:
+        if gene == D:
+            predictions = extract_genes(input_seq_dict, D, input_rss_info[D], None, None, canonical_genes, config)
+        else:
+            predictions = extract_genes(input_seq_dict, gene, input_rss_info[gene], s_fragments[gene], s_fragment_alignment[gene], canonical_genes, config)
+        print_predicted_genes('{}/genes_{}.tsv'.format(output_path, gene) , gene, predictions)
+        progress_events.Count('denovo_search', 'genes', len(predictions), locus = config.locus, gene = gene)
+
+    print("Please see {}/ for gene predictions".format(output_path))  
+
+def main(argv):
+    global NUM_THREADS
+    #PARSE COMMAND LINE ARGUMENTS
+    options = "hi:o:m:rg:l:"
+    long_options = ["help","input_file=", "output_directory=", "multi_process=", "rss_only" , "genes_type=", "locus="]
+    force_output = True
+    received_input = False
+    locus = 'IGH'
+    rss_mode = False
+    help_flag = False
+    genes_type = None
+    try:
+        arguments, values = getopt.getopt(argv, options, long_options)
+        for currentArgument, currentValue in arguments:
+            if currentArgument in ("-h", "--help"):
+                print ("Diplaying Help")
+                print("Flags and their usage :")
+                print("-h , --help : Get this message")
+                print("-i, --input_file : provide a fasta file for gene detection")
+                print("-o, --output_directory : (optional) provide an output directory for generated results. Default location is in the parent directory of the input file")
+                print("-l, --locus : immunoglobulin locus " + ", ".join(locus_config.LOCI) + ". Default is IGH")
+                print("-m, --multi_process : (optional) provide number of parallel processing units if available. Default is 1")
+                print("-r, --rss_only : (optional) switch to RSS finding mode")
+                print("-g, --genes_type : (optional) specify which genes (v,d,j) to find. Eg: vdj, d, vj, jv. Default is all genes of the locus")
+                help_flag = True
+
+            elif currentArgument in ("-i", "--input_file"):
+                input_path = str(currentValue)
+                received_input = True
+
+            elif currentArgument in ("-o", "--output_directory"):
+                output_path = str(currentValue)
+                force_output = False
+
+            elif currentArgument in ("-l", "--locus"):
+                if currentValue not in locus_config.LOCI:
+                    print('Incorrect locus argument: ' + currentValue)
+                    sys.exit(1)
+                locus = currentValue
+
+            elif currentArgument in ("-m", "--multi_process"):
+                NUM_THREADS = int(currentValue)
+
+            elif currentArgument in ("-r", "--rss_only"):
+                rss_mode = True
+
+            elif currentArgument in ("-g", "--genes_type"):
+                genes_type = [g.upper() for g in currentValue if g.upper() in GENE_TYPES]
+
+        if help_flag:
+            sys.exit(0)
+        if not received_input:
+            raise NameError('no input file was given')
+
+    except getopt.error as err:
+        print (str(err))
+        sys.exit(0)
+
+    config = locus_config.GetLocusConfig(locus)
+    if genes_type is not None:
+        config = config.Restrict(genes_type)
+
+    if force_output == True:
+        output_path = ".".join(input_path.split('.')[:-1])
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+
+    #errors of loading or compiling the bundle (e.g., a read-only installation) are reported with their cause
+    try:
+        load_reference_data()
+    except (OSError, ValueError, KeyError, pickle.UnpicklingError) as err:
+        print("Error: could not load the reference bundle " + reference_bundle.DEFAULT_BUNDLE_DIR + ": " + str(err))
+        sys.exit(1)
+
+    #READ INPUT FASTA FILE into 2-bit packed sequences
+    input_seq_dict = packed_genome.PackFasta(input_path).Contigs()
+    find_genes(input_seq_dict, config, output_path, rss_mode)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,204 @@
+import numpy as np
+
+# scoring scheme of extract_aligned_genes.SetupAligner: the fragment is the target and reference genes are queries,
+# gaps in the reference before and after the gene are free (the fragment is longer than the gene)
+MATCH_SCORE = 2
+MISMATCH_SCORE = 0
+GAP_OPEN_SCORE = -2
+GAP_EXTEND_SCORE = -1
+NEG_INF = -1000000
+# references similar at the identity are clustered (see ClusterReferences), fragments are scored against centroids and
+# then against the members of the clusters with the best centroids only: at least SEARCHED_CLUSTERS clusters and all
+# clusters whose centroid PI is within 100 - identity of the best one. The margin is a heuristic: a member usually
+# exceeds its centroid by less, but the search is not guaranteed to find the best reference
+CLUSTER_IDENTITY = 90
+SEARCHED_CLUSTERS = 3
+# a reference is aligned to the centroids sharing the most k-mers with it only when references are clustered
+CANDIDATE_CENTROIDS = 8
+CANDIDATE_KMER_SIZE = 11
+
+def EncodeSeq(seq):
+    # comparison is case-sensitive as in PairwiseAligner, callers upper-case sequences themselves
+    return np.frombuffer(str(seq).encode(), dtype = np.uint8)
+
+class ReferenceSet:
+    def __init__(self, seqs, ids = None, clusters = None, identity = CLUSTER_IDENTITY):
+        # clusters are centroid indices of references, subsets are not clustered
+        self.seqs = [str(s) for s in seqs]
+        self.ids = list(ids) if ids is not None else list(range(len(self.seqs)))
+        self.lengths = np.array([len(s) for s in self.seqs], dtype = np.int64)
+        max_len = int(self.lengths.max()) if len(self.seqs) != 0 else 0
+        # reversed references (one per column) make anti-diagonals contiguous,
+        # 0 is used for padding and never matches a nucleotide
+        self.rev_codes = np.zeros((max_len, len(self.seqs)), dtype = np.uint8)
+        for i, seq in enumerate(self.seqs):
+            self.rev_codes[max_len - len(seq) :, i] = EncodeSeq(seq)[:: -1]
+        # clusters computed for another list of references (e.g., with duplicate IDs) are ignored
+        self.clusters = None
+        if clusters is not None and len(clusters) == len(self.seqs) and len(self.seqs) != 0:
+            self.clusters = np.asarray(clusters)
+            self.margin = 100 - identity
+            self.centroids = np.unique(self.clusters)
+            self.centroid_set = self.Subset(self.centroids)
+            self.members = [np.flatnonzero((self.clusters == c) & (np.arange(len(self.seqs)) != c)) for c in self.centroids]
+
+    def SearchedMembers(self, centroid_pis, num_clusters = SEARCHED_CLUSTERS):
+        # non-centroid members of the clusters with the highest centroid PIs
+        searched = centroid_pis >= centroid_pis.max() - self.margin
+        searched[np.argsort(-centroid_pis, kind = 'stable')[: num_clusters]] = True
+        return np.sort(np.concatenate([self.members[i] for i in np.flatnonzero(searched)]))
+
+    def Subset(self, indices):
+        return ReferenceSet([self.seqs[i] for i in indices], [self.ids[i] for i in indices])
+
+    def __len__(self):
+        return len(self.seqs)
+
+class AlignmentSummary:
+    def __init__(self, scores, matches, spans, starts):
+        self.scores = scores
+        self.matches = matches
+        self.spans = spans
+        self.starts = starts
+
+    def NumMatches(self):
+        # BioAlign.NumMatches counts matches starting from -1, PIs are kept comparable with it
+        return self.matches - 1
+
+    def PI(self):
+        return self.NumMatches() / np.maximum(self.spans, 1) * 100
+
+    def AlignmentRanges(self):
+        return self.starts, self.starts + self.spans
+
+    @staticmethod
+    def Empty(num_refs):
+        # references that were not aligned, their PI is below PIs of any alignment
+        zeros = np.zeros(num_refs, dtype = np.int64)
+        return AlignmentSummary(np.full(num_refs, NEG_INF, dtype = np.int64), zeros, zeros.copy(), zeros.copy())
+
+    def Assign(self, indices, other):
+        for name in ['scores', 'matches', 'spans', 'starts']:
+            getattr(self, name)[indices] = getattr(other, name)
+
+    def Select(self, mask, other):
+        return AlignmentSummary(np.where(mask, self.scores, other.scores), np.where(mask, self.matches, other.matches),
+                                np.where(mask, self.spans, other.spans), np.where(mask, self.starts, other.starts))
+
+def ScoreFragment(fragment, ref_set):
+    # Gotoh DP over anti-diagonals, vectorized over all references at once. Every cell holds one int64 key:
+    # the score in the upper bits followed by statistics of the path (number of alignment columns covered by the
+    # reference stored as a complement, number of matches and the fragment position where the reference starts),
+    # so that a single maximum picks both the best move and the statistics. Ties in score are resolved in favour
+    # of fewer alignment columns (i.e. fewer gaps) and then more matches.
+    frag = EncodeSeq(fragment)
+    n = len(frag)
+    max_len, num_refs = ref_set.rev_codes.shape
+    field_bits = (n + max_len + 1).bit_length()
+    match_unit = 1 << field_bits
+    span_unit = 1 << (2 * field_bits)
+    score_unit = 1 << (3 * field_bits)
+    field_mask = match_unit - 1
+    empty_path = field_mask * span_unit
+    neg_inf = -(1 << 62)
+    gap_open = GAP_OPEN_SCORE * score_unit - span_unit
+    gap_extend = GAP_EXTEND_SCORE * score_unit - span_unit
+    mismatch = MISMATCH_SCORE * score_unit - span_unit
+    match_gain = (MATCH_SCORE - MISMATCH_SCORE) * score_unit + match_unit
+    ref_idx = np.arange(num_refs)
+    # H, E and F buffers are reused: diagonals d, d - 1 and d - 2 for H, d and d - 1 for E and F.
+    # Cells (i, d - i) of a diagonal are stored in rows i, references in columns
+    H = [np.full((n + 1, num_refs), neg_inf, dtype = np.int64) for k in range(3)]
+    E = [np.full((n + 1, num_refs), neg_inf, dtype = np.int64) for k in range(2)]
+    F = [np.full((n + 1, num_refs), neg_inf, dtype = np.int64) for k in range(2)]
+    H[0][0] = empty_path
+    frag = frag[:, None]
+    best = np.full(num_refs, neg_inf, dtype = np.int64)
+    for d in range(1, n + max_len + 1):
+        H_new, H_prev, H_prev2 = H[d % 3], H[(d - 1) % 3], H[(d - 2) % 3]
+        E_new, E_prev = E[d % 2], E[(d - 1) % 2]
+        F_new, F_prev = F[d % 2], F[(d - 1) % 2]
+        # cells with reference position d - i >= 1
+        lo = max(0, d - max_len)
+        hi = min(n, d - 1)
+        # reference nucleotide against a gap in the fragment
+        np.maximum(H_prev[lo : hi + 1] + gap_open, E_prev[lo : hi + 1] + gap_extend, out = E_new[lo : hi + 1])
+        H_new[lo : hi + 1] = E_new[lo : hi + 1]
+        i_lo = max(1, lo)
+        if i_lo <= hi:
+            # fragment nucleotide against a gap in the reference
+            np.maximum(H_prev[i_lo - 1 : hi] + gap_open, F_prev[i_lo - 1 : hi] + gap_extend, out = F_new[i_lo : hi + 1])
+            is_match = ref_set.rev_codes[max_len - d + i_lo : max_len - d + hi + 1] == frag[i_lo - 1 : hi]
+            diag = H_prev2[i_lo - 1 : hi] + mismatch + is_match * match_gain
+            np.maximum(diag, F_new[i_lo : hi + 1], out = diag)
+            np.maximum(diag, H_new[i_lo : hi + 1], out = H_new[i_lo : hi + 1])
+        if d <= n:
+            # the fragment prefix before the reference is free
+            H_new[d] = empty_path + d
+            E_new[d] = neg_inf
+        # the fragment suffix after the reference is free: the last reference column is collected
+        end_rows = d - ref_set.lengths
+        is_end = (end_rows >= 0) & (end_rows <= n)
+        if is_end.any():
+            best[is_end] = np.maximum(best[is_end], H_new[end_rows[is_end], ref_idx[is_end]])
+    spans = field_mask - ((best >> (2 * field_bits)) & field_mask)
+    return AlignmentSummary(best >> (3 * field_bits), (best >> field_bits) & field_mask, spans, best & field_mask)
+
+def ScoreFragmentBothStrands(fragment, fragment_rc, ref_set):
+    # the strand with more matches is chosen for every reference, as in IGDetective.ComputeAlignment
+    fwd = ScoreFragment(fragment, ref_set)
+    rev = ScoreFragment(fragment_rc, ref_set)
+    use_fwd = fwd.matches > rev.matches
+    return fwd.Select(use_fwd, rev), use_fwd
+
+def SearchFragment(fragment, ref_set, num_clusters = SEARCHED_CLUSTERS):
+    # hierarchical search over clustered references, references of other clusters get empty alignments
+    if ref_set.clusters is None:
+        return ScoreFragment(fragment, ref_set)
+    summary = AlignmentSummary.Empty(len(ref_set))
+    centroid_summary = ScoreFragment(fragment, ref_set.centroid_set)
+    summary.Assign(ref_set.centroids, centroid_summary)
+    members = ref_set.SearchedMembers(centroid_summary.PI(), num_clusters)
+    if len(members) != 0:
+        summary.Assign(members, ScoreFragment(fragment, ref_set.Subset(members)))
+    return summary
+
+def SearchFragmentBothStrands(fragment, fragment_rc, ref_set, num_clusters = SEARCHED_CLUSTERS):
+    if ref_set.clusters is None:
+        return ScoreFragmentBothStrands(fragment, fragment_rc, ref_set)
+    summary = AlignmentSummary.Empty(len(ref_set))
+    use_fwd = np.zeros(len(ref_set), dtype = bool)
+    centroid_summary, centroid_fwd = ScoreFragmentBothStrands(fragment, fragment_rc, ref_set.centroid_set)
+    use_fwd[ref_set.centroids] = centroid_fwd
+    summary.Assign(ref_set.centroids, centroid_summary)
+    members = ref_set.SearchedMembers(centroid_summary.PI(), num_clusters)
+    if len(members) != 0:
+        member_summary, member_fwd = ScoreFragmentBothStrands(fragment, fragment_rc, ref_set.Subset(members))
+        use_fwd[members] = member_fwd
+        summary.Assign(members, member_summary)
+    return summary, use_fwd
+
+def ClusterReferences(seqs, identity = CLUSTER_IDENTITY, num_candidates = CANDIDATE_CENTROIDS, k = CANDIDATE_KMER_SIZE):
+    # greedy clustering from the longest reference: a reference joins the first of the candidate centroids aligned to it
+    # with the PI of at least the identity, otherwise it becomes a centroid. Candidates are the centroids sharing the
+    # most k-mers with the reference, found in a k-mer index of centroids that grows with them, so every reference
+    # is aligned to at most num_candidates centroids. Returns the centroid index of every reference
+    clusters = np.zeros(len(seqs), dtype = np.int32)
+    centroids = []
+    kmer_centroids = dict()
+    for i in sorted(range(len(seqs)), key = lambda i : -len(seqs[i])):
+        kmers = {seqs[i][j : j + k] for j in range(len(seqs[i]) - k + 1)}
+        hits = [kmer_centroids[kmer] for kmer in kmers if kmer in kmer_centroids]
+        if len(hits) != 0:
+            shared = np.bincount(np.concatenate(hits), minlength = len(centroids))
+            candidates = np.sort(np.argsort(-shared, kind = 'stable')[: min(num_candidates, np.count_nonzero(shared))])
+            pis = ScoreFragment(seqs[i], ReferenceSet([seqs[centroids[c]] for c in candidates])).PI()
+            similar = np.flatnonzero(pis >= identity)
+            if len(similar) != 0:
+                clusters[i] = centroids[candidates[similar[0]]]
+                continue
+        for kmer in kmers:
+            kmer_centroids.setdefault(kmer, []).append(len(centroids))
+        centroids.append(i)
+        clusters[i] = i
+    return clusters
@@ -1,106 +1,94 @@
 import os
 import sys
-import gzip
 import shutil
 import re
 import numpy as np
-
-import matplotlib as mplt
-mplt.use('Agg')
-import matplotlib.pyplot as plt
-import seaborn as sns
-
-from Bio import SeqIO
-
-class Match:
-    def __init__(self, gene_id, cigar):
-        self.gene_id = gene_id
-        self.cigar = cigar
-        self.cigar_splits, self.cigar_delims = GetCigarSplits(cigar)
-
-    def GeneId(self):
-        return self.gene_id
-
-    def MatchLength(self):
-        match_length = 0
-        for s, d in zip(self.cigar_splits, self.cigar_delims):
-            if d == 'M':
-                match_length += s
-        return match_length
-
-    def __repr__(self):
-        return self.gene_id
-
-def GetCigarSplits(cigar):
-    delims = ['M', 'S', 'H', 'I', 'D']
-    delim_str = '|'.join(delims)
-    splits = re.split(delim_str, cigar)
-    if splits[-1] == '':
-        splits = splits[ : len(splits) - 1]
-    cigar_pos = 0
-    delims = []
-    for s in splits:
-        delim = cigar[cigar_pos + len(s) : cigar_pos + len(s) + 1]
-        delims.append(delim)
-        cigar_pos += len(s) + 1
-    splits = [int(s) for s in splits]
-    return splits, delims
+from array import array
+from multiprocessing import get_context
+
+import visualization_tools as visual_tools
+import packed_genome
+import progress_events
+
+CIGAR_MATCH_RE = re.compile(r'(\d+)M')
+
+class HitColumns:
+    # minimap2 hits stored as columns, contigs and genes are stored as indices of contig_ids and gene_ids.
+    # Columns are typed arrays while parsing, so memory per hit is fixed
+    def __init__(self):
+        self.contig_ids = []
+        self.contig_index = dict()
+        self.gene_ids = []
+        self.gene_index = dict()
+        self.contig = array('q')
+        self.start = array('q')
+        self.match_len = array('q')
+        self.gene = array('q')
+
+    def _GetIndex(self, ids, index, item_id):
+        if item_id not in index:
+            index[item_id] = len(ids)
+            ids.append(item_id)
+        return index[item_id]
+
+    def Add(self, contig_id, start_pos, cigar, gene_id):
+        self.contig.append(self._GetIndex(self.contig_ids, self.contig_index, contig_id))
+        self.start.append(start_pos)
+        # the number of aligned (M) positions is the length used for choosing the best hit
+        self.match_len.append(sum([int(l) for l in CIGAR_MATCH_RE.findall(cigar)]))
+        self.gene.append(self._GetIndex(self.gene_ids, self.gene_index, gene_id))
+
+    def Finalize(self):
+        self.contig = np.frombuffer(self.contig, dtype = np.int64)
+        self.start = np.frombuffer(self.start, dtype = np.int64)
+        self.match_len = np.frombuffer(self.match_len, dtype = np.int64)
+        self.gene = np.frombuffer(self.gene, dtype = np.int64)
+        return self
+
+    def SplitByContig(self):
+        # contig ID -> (starts, match lengths, gene indices) sorted by start, hits with the same start keep the SAM order
+        order = np.lexsort((self.start, self.contig))
+        contigs = self.contig[order]
+        bounds = np.searchsorted(contigs, np.arange(len(self.contig_ids) + 1))
+        contig_hits = dict()
+        for i, contig_id in enumerate(self.contig_ids):
+            idx = order[bounds[i] : bounds[i + 1]]
+            contig_hits[contig_id] = (self.start[idx], self.match_len[idx], self.gene[idx])
+        return contig_hits
 
 def AnalyzeMatches(sam_file):
-    contig_match_dict = dict()
-    lines = open(sam_file).readlines()
-    for l in lines:
-        if l[0] == '@':
-            continue
-        line_splits = l.strip().split()
-        read_id = line_splits[0]
-        ref_id = line_splits[2]
-        cigar = line_splits[5]
-        if cigar == '*':
-            continue
-        start_pos = int(line_splits[3])
-        if ref_id not in contig_match_dict:
-            contig_match_dict[ref_id] = dict()
-        if start_pos not in contig_match_dict[ref_id]:
-            contig_match_dict[ref_id][start_pos] = []
-        contig_match_dict[ref_id][start_pos].append(Match(read_id, cigar))
-    return contig_match_dict
-
-def CompressMatches(match_dict, gene_type):
-    # match dict: start pos -> [Match]
+    hits = HitColumns()
+    with open(sam_file) as fh:
+        for l in fh:
+            if l[0] == '@':
+                continue
+            line_splits = l.split('\t')
+            cigar = line_splits[5]
+            if cigar == '*':
+                continue
+            hits.Add(line_splits[2], int(line_splits[3]), cigar, line_splits[0])
+    return hits.Finalize()
+
+def CompressMatches(starts, match_lens, genes, gene_ids, gene_type):
+    # hits are sorted by start. Windows are built greedily: a window starts at the first hit position that is not
+    # covered by the previous window. The longest hit of every window (the first one in case of ties) is reported
     window_dict = {'V' : 200, 'J' : 30, 'C' : 500}
     window_size = window_dict[gene_type.split('-')[0]]
-    cur_match_index = 0
-    compressed_positions = [] # positions
-    best_hits = [] # Matches with longest lengths
-    processed_matches = set()
-    sorted_start_positions = sorted(match_dict.keys())
-    for pos in sorted_start_positions: #range(sorted_start_positions[0], sorted_start_positions[-1] + 1):
-        if pos in processed_matches:
-            continue
-        bounds = (pos, pos + window_size)
-        num_bound_matches = 0 # the number of matches within bounds
-        bound_matches = [] # matches within bounds
-        for match_ind in range(cur_match_index, len(sorted_start_positions)):
-            match_pos = sorted_start_positions[match_ind]
-            if match_pos >= bounds[0] and match_pos < bounds[1]:
-                num_bound_matches += 1
-                processed_matches.add(match_pos)
-                for m in match_dict[match_pos]:
-                    bound_matches.append(m)
-            else:
-                cur_match_index = match_ind
-                break
-        if num_bound_matches > 0:
-#            compressed_positions.append((pos, num_bound_matches))
-            best_match = ''
-            best_length = 0
-            for m in bound_matches:
-                if m.MatchLength() > best_length:
-                    best_length = m.MatchLength()
-                    best_match = m
-            best_hits.append(best_match)
-            compressed_positions.append((pos, best_match))
+    positions = np.unique(starts)
+    window_idx = []
+    i = 0
+    while i < len(positions):
+        window_idx.append(i)
+        i = np.searchsorted(positions, positions[i] + window_size, 'left')
+    window_starts = positions[window_idx]
+    hit_window = np.searchsorted(window_starts, starts, 'right') - 1
+    best_lens = np.maximum.reduceat(match_lens, np.searchsorted(starts, window_starts, 'left'))
+    best_idx = np.flatnonzero(match_lens == best_lens[hit_window])
+    best_idx = best_idx[np.unique(hit_window[best_idx], return_index = True)[1]]
+    compressed_positions = []
+    for pos, best_len, hit_idx in zip(window_starts, best_lens, best_idx):
+        best_match = gene_ids[genes[hit_idx]] if best_len > 0 else ''
+        compressed_positions.append((int(pos), best_match))
     return compressed_positions
 
 def OutputLoci(contig_id, contig_seq, loci_bounds, output_dir):
@@ -110,7 +98,7 @@ def OutputLoci(contig_id, contig_seq, loci_bounds, output_dir):
     for locus, gene in loci_bounds:
         gene_locus_bounds = loci_bounds[(locus, gene)]
         real_bounds = (max(0, gene_locus_bounds[0] - 1000), min(len(contig_seq), gene_locus_bounds[1] + 1000))
-        contig_subseq = contig_seq[real_bounds[0] : real_bounds[1]]
+        contig_subseq = str(contig_seq[real_bounds[0] : real_bounds[1]])
         output_fname = os.path.join(output_dir, contig_id + '_' + locus + gene + '.fasta')
         output_fh = open(output_fname, 'w')
         output_fh.write('>CONTIG:' + contig_id + '|START_POS:' + str(real_bounds[0]) + '|END_POS:' + str(real_bounds[1]) + '|LOCUS:' + locus + '|GENE:' + gene + '\n')
@@ -121,12 +109,12 @@ def OutputLoci(contig_id, contig_seq, loci_bounds, output_dir):
     genes = ','.join(sorted(set([l[1] for l in loci_bounds])))
     fh = open(os.path.join(output_dir, locus + '_' + contig_id + '.fasta'), 'w')
     fh.write('>CONTIG:' + contig_id + '|GENES:' + genes + '\n')
-    fh.write(contig_seq + '\n')
+    fh.write(str(contig_seq) + '\n')
     fh.close()
     # output overall locus
     fh = open(os.path.join(output_dir, contig_id + '_IG.fasta'), 'w')
     fh.write('>CONTIG:' + contig_id + '|START_POS:' + str(total_bounds[0]) + '|END_POS:' + str(total_bounds[1]) + '\n')
-    fh.write(contig_seq[total_bounds[0] : total_bounds[1]] + '\n')
+    fh.write(str(contig_seq[total_bounds[0] : total_bounds[1]]) + '\n')
     fh.close()
     # output IGHD locus if possible
     if ('IGH', 'V') in loci_bounds and ('IGH', 'J') in loci_bounds:
@@ -143,110 +131,124 @@ def OutputLoci(contig_id, contig_seq, loci_bounds, output_dir):
             sys.exit(1)
         output_fh = open(output_fname, 'w')
         output_fh.write('>CONTIG:' + contig_id + '|START_POS:' + str(ighd_bounds[0]) + '|END_POS:' + str(ighd_bounds[1]) + '|LOCUS:IGH|GENE:D|REVERSE:' + reverse + '\n')
-        output_fh.write(contig_seq[ighd_bounds[0] : ighd_bounds[1]] + '\n')
+        output_fh.write(str(contig_seq[ighd_bounds[0] : ighd_bounds[1]]) + '\n')
         output_fh.close()
 
-######################################################
-input_dir = sys.argv[1]
-output_dir = sys.argv[2]
-contig_file = sys.argv[3]
-
-if os.path.exists(output_dir):
-    shutil.rmtree(output_dir)
-os.mkdir(output_dir)
-
-loci = ['IGH', 'IGK', 'IGL', 'TRA', 'TRB', 'TRG']
-genes = ['V', 'J', 'C']
-
-input_files = os.listdir(input_dir)
-
-gene_sam_dict = dict()
-for f in input_files:
-    for l in loci:
-        for g in genes:
-            gene = l + g
-            if f.find(gene) != -1 and f.find('sam') != -1:
-                gene_sam_dict[(l, g)] = os.path.join(input_dir, f)
-
-contig_matches = dict() # exact positions of matches
-combined_matches = dict() # contig -> locus, gene -> compressed positions
-for locus, gene in gene_sam_dict:
-    matches = AnalyzeMatches(gene_sam_dict[(locus, gene)]) # config -> start pos -> list of alignments
-    for contig in matches:
-        if contig not in contig_matches:
-            contig_matches[contig] = dict()
-            combined_matches[contig] = dict()
-        contig_matches[contig][(locus, gene)] = matches[contig]
-        compressed_matches = CompressMatches(matches[contig], gene)
-        print(locus, gene, contig, compressed_matches)
-        combined_matches[contig][(locus, gene)] = compressed_matches
-
-contig_seqs = dict() # contig ID -> seq
-if contig_file.endswith('.gz'):
-    contig_handle = gzip.open(contig_file, 'rt')
-else:
-    contig_handle = open(contig_file, 'r')
-for r in SeqIO.parse(contig_handle, 'fasta'):
-    if r.id not in combined_matches:
-        continue
-    contig_seqs[r.id] = str(r.seq)
-contig_handle.close()
-
-matrix = []
-annot_matrix = []
-ylabels = []
-for contig in contig_matches:
-    num_matches = []
+def FindGeneSamFiles(input_dir, loci, genes):
+    gene_sam_dict = dict()
+    for f in os.listdir(input_dir):
+        for l in loci:
+            for g in genes:
+                gene = l + g
+                if f.find(gene) != -1 and f.find('sam') != -1:
+                    gene_sam_dict[(l, g)] = os.path.join(input_dir, f)
+    return gene_sam_dict
+
+def CompressGeneMatches(sam_file, gene):
+    # SAM files are streamed by worker processes, only compressed positions are sent back
+    hits = AnalyzeMatches(sam_file)
+    contig_hits = hits.SplitByContig()
+    compressed_matches = []
+    for contig in contig_hits:
+        starts, match_lens, gene_idx = contig_hits[contig]
+        compressed_matches.append((contig, CompressMatches(starts, match_lens, gene_idx, hits.gene_ids, gene)))
+    return compressed_matches
+
+def CompressGeneMatchesTask(task):
+    return CompressGeneMatches(*task)
+
+def CombineMatches(gene_sam_dict, num_processes = 1):
+    locus_genes = list(gene_sam_dict)
+    tasks = [(gene_sam_dict[(locus, gene)], gene) for locus, gene in locus_genes]
+    progress = progress_events.Progress('hit_parsing', len(tasks))
+    if num_processes > 1 and len(tasks) > 1:
+        with get_context('fork').Pool(min(num_processes, len(tasks))) as p:
+            results = list(progress.Track(p.imap(CompressGeneMatchesTask, tasks, 1)))
+    else:
+        results = [CompressGeneMatches(sam_file, gene) for sam_file, gene in progress.Track(tasks)]
+    combined_matches = dict() # contig -> locus, gene -> compressed positions
+    for (locus, gene), compressed_list in zip(locus_genes, results):
+        for contig, compressed_matches in compressed_list:
+            if contig not in combined_matches:
+                combined_matches[contig] = dict()
+            print(locus, gene, contig, '[' + ', '.join(['(' + str(pos) + ', ' + name + ')' for pos, name in compressed_matches]) + ']')
+            combined_matches[contig][(locus, gene)] = compressed_matches
+    return combined_matches
+
+def ReadContigs(contig_file, contig_ids):
+    # contig ID -> view of the packed contig
+    return packed_genome.LoadGenome(contig_file).Contigs(contig_ids)
+
+def OutputHeatmap(combined_matches, loci, genes, title, output_dir, plot_jobs):
+    matrix = []
+    annot_matrix = []
+    ylabels = []
+    for contig in combined_matches:
+        num_matches = []
+        for l in loci:
+            for g in genes:
+                if (l, g) in combined_matches[contig]:
+                    num_matches.append(len(combined_matches[contig][(l, g)]))
+                else:
+                    num_matches.append(0)
+        matrix.append(num_matches)
+        annot_row = [''] * len(num_matches)
+        for i in range(len(num_matches)):
+            if num_matches[i] != 0:
+                annot_row[i] = str(num_matches[i])
+        annot_matrix.append(annot_row)
+        ylabels.append(contig)
+
+    xlabels = []
     for l in loci:
         for g in genes:
-            if (l, g) in combined_matches[contig]:
-                num_matches.append(len(combined_matches[contig][(l, g)]))
-            else:
-                num_matches.append(0)
-    matrix.append(num_matches)
-    annot_row = [''] * len(num_matches)
-    for i in range(len(num_matches)):
-        if num_matches[i] != 0:
-            annot_row[i] = str(num_matches[i])
-    annot_matrix.append(annot_row)
-    ylabels.append(contig)
-
-xlabels = []
-for l in loci:
-    for g in genes:
-        xlabels.append(l + g)   
-
-if len(matrix) != 0:
-    plt.figure(figsize = (12, 8))
-    plt.title(input_dir) 
-    sns.heatmap(matrix, annot = np.array(annot_matrix), cmap = 'coolwarm', robust = True, fmt = '', xticklabels = xlabels, yticklabels = ylabels, cbar = False)
-    plt.yticks(fontsize = 6)
-    plt.savefig(os.path.join(output_dir, '__summary.png'), dpi = 300)
-    plt.clf()
-
-summary_txt = os.path.join(output_dir, '__summary.txt')
-summary_fh = open(summary_txt, 'w')
-summary_fh.write('ContigID\tContigLength\tLocus\tGeneType\tPosition\tGeneName\n')
-for contig in contig_matches:
-    contig_str = contig.replace('|', '_')
-#    print(contig)
-    locus_gene_matches = combined_matches[contig]
-    max_pos = 0
-    min_pos = sys.maxsize
-    for locus, gene in locus_gene_matches:
-        matches_pos = [p[0] for p in locus_gene_matches[(locus, gene)]]
-        max_pos = max(max_pos, max(matches_pos))
-        min_pos = min(min_pos, min(matches_pos))
-    gene_bounds = dict() # geneType -> bounds
-    for locus, gene in locus_gene_matches:
-        locus_gene_bounds = (sys.maxsize, 0)
-        # txt writing
-        for pos, gene_name in sorted(locus_gene_matches[(locus, gene)], key = lambda x : x[0]):
-            summary_fh.write(contig_str + '\t' + str('-') + '\t' + locus + '\t' + gene + '\t' + str(pos) + '\t' + str(gene_name) + '\n')
-            locus_gene_bounds = (min(locus_gene_bounds[0], pos), max(locus_gene_bounds[1], pos))
-        # gene bounds
-        gene_bounds[(locus, gene)] = locus_gene_bounds
-    # extracting loci and subloci
-    OutputLoci(contig_str, contig_seqs[contig], gene_bounds, output_dir)
-
-summary_fh.close()
+            xlabels.append(l + g)   
+
+    if len(matrix) != 0:
+        plot_jobs.Add('heatmap', os.path.join(output_dir, '__summary.png'), {'matrix' : matrix, 'annot' : annot_matrix, 'xlabels' : xlabels, 'ylabels' : ylabels, 'title' : title})
+
+def OutputSummary(combined_matches, contig_seqs, output_dir):
+    summary_txt = os.path.join(output_dir, '__summary.txt')
+    summary_fh = open(summary_txt, 'w')
+    summary_fh.write('ContigID\tContigLength\tLocus\tGeneType\tPosition\tGeneName\n')
+    for contig in combined_matches:
+        contig_str = contig.replace('|', '_')
+        locus_gene_matches = combined_matches[contig]
+        gene_bounds = dict() # geneType -> bounds
+        for locus, gene in locus_gene_matches:
+            locus_gene_bounds = (sys.maxsize, 0)
+            # txt writing
+            for pos, gene_name in sorted(locus_gene_matches[(locus, gene)], key = lambda x : x[0]):
+                summary_fh.write(contig_str + '\t' + str('-') + '\t' + locus + '\t' + gene + '\t' + str(pos) + '\t' + str(gene_name) + '\n')
+                locus_gene_bounds = (min(locus_gene_bounds[0], pos), max(locus_gene_bounds[1], pos))
+            # gene bounds
+            gene_bounds[(locus, gene)] = locus_gene_bounds
+        # extracting loci and subloci
+        OutputLoci(contig_str, contig_seqs[contig], gene_bounds, output_dir)
+    summary_fh.close()
+
+def main(input_dir, output_dir, contig_file, num_processes = 1, plots = 'inline'):
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    os.mkdir(output_dir)
+
+    loci = ['IGH', 'IGK', 'IGL', 'TRA', 'TRB', 'TRG']
+    genes = ['V', 'J', 'C']
+
+    gene_sam_dict = FindGeneSamFiles(input_dir, loci, genes)
+    with progress_events.Stage('hit_parsing', sam_files = len(gene_sam_dict)):
+        combined_matches = CombineMatches(gene_sam_dict, num_processes)
+    progress_events.Count('hit_parsing', 'ig_contigs', len(combined_matches))
+    contig_seqs = ReadContigs(contig_file, combined_matches)
+    plot_jobs = visual_tools.PlotJobs(plots, os.path.join(output_dir, '__plots.jsonl'), num_processes)
+    OutputHeatmap(combined_matches, loci, genes, input_dir, output_dir, plot_jobs)
+    plot_jobs.Finish()
+    OutputSummary(combined_matches, contig_seqs, output_dir)
+
+if __name__ == '__main__':
+    input_dir = sys.argv[1]
+    output_dir = sys.argv[2]
+    contig_file = sys.argv[3]
+    num_processes = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+    plots = sys.argv[5] if len(sys.argv) > 5 else 'inline'
+    main(input_dir, output_dir, contig_file, num_processes, plots)
@@ -0,0 +1,208 @@
+import os
+import sys
+import json
+import time
+import shutil
+import getopt
+import socket
+import tempfile
+import socketserver
+from collections import OrderedDict
+
+import reference_bundle
+import packed_genome
+import progress_events
+import stage_scheduler
+
+# Long-lived annotation service: jobs (a genome, optional regions and loci) are sent as JSON lines over a local Unix
+# socket and gene tables are returned as JSON lines. The service process keeps imported modules, the reference
+# bundle and motif tables loaded. Jobs run inside the service process one by one, so process pools of the RSS search
+# and alignments are forked from this warm state, minimap2 indexes of annotated regions are kept in an LRU cache:
+#     request:  {"genome": "genome.fasta", "regions": ["ctg1:100000-400000"], "loci": ["IGH"], "threads": 4}
+#     response: {"status": "ok", "genes": [{"Locus": "IGH", "GeneType": "V", "Contig": "ctg1", "Pos": 123456, ...}]}
+# Other requests are {"command": "status"} and {"command": "shutdown"}
+DEFAULT_MAX_INDEXES = 8
+GENE_COLUMNS = ['Locus', 'GeneType', 'Contig', 'Pos', 'Strand', 'Sequence', 'Productive']
+
+class IndexCache:
+    # minimap2 indexes of region FASTA files keyed by the SHA-1 of the file, the least recently used index is removed
+    # when the cache is full
+    def __init__(self, cache_dir, max_indexes = DEFAULT_MAX_INDEXES):
+        self.cache_dir = cache_dir
+        self.max_indexes = max(1, max_indexes)
+        self.indexes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok = True)
+
+    def Get(self, fasta):
+        key = reference_bundle.FileSha1(fasta)
+        if key in self.indexes:
+            self.indexes.move_to_end(key)
+            self.hits += 1
+            return self.indexes[key]
+        self.misses += 1
+        index_fname = os.path.join(self.cache_dir, key + '.mmi')
+        with progress_events.Stage('minimap2_index', fasta = os.path.basename(fasta)):
+            stage_scheduler.RunCommand(['minimap2', '-d', index_fname, fasta], quiet = True)
+        self.indexes[key] = index_fname
+        while len(self.indexes) > self.max_indexes:
+            evicted_key, evicted_fname = self.indexes.popitem(last = False)
+            if os.path.exists(evicted_fname):
+                os.remove(evicted_fname)
+        return index_fname
+
+    def Status(self):
+        return {'indexes' : len(self.indexes), 'max_indexes' : self.max_indexes, 'hits' : self.hits, 'misses' : self.misses}
+
+def ParseRegion(region):
+    # contig or contig:start-end (0-based, end exclusive), contig IDs may contain colons
+    if region.find(':') != -1:
+        contig_id, bounds = region.rsplit(':', 1)
+        splits = bounds.replace(',', '').split('-')
+        if len(splits) == 2 and splits[0].isdigit() and splits[1].isdigit():
+            return contig_id, int(splits[0]), int(splits[1])
+    return region, 0, None
+
+def WriteRegions(genome_fasta, regions, region_fasta, window_fasta):
+    # writes sequences of regions (all contigs if no regions are given) twice: with contig IDs for minimap2 alignments
+    # and with window headers (CONTIG:contig|GENES:region|START:start|END:end) for the de novo search.
+    # Returns starts of regions by contig ID
+    genome = packed_genome.LoadGenome(genome_fasta)
+    if len(regions) == 0:
+        regions = genome.contig_ids
+    region_starts = dict()
+    region_fh = open(region_fasta, 'w')
+    window_fh = open(window_fasta, 'w')
+    for region in regions:
+        contig_id, start, end = ParseRegion(region)
+        if contig_id not in genome.contig_index:
+            raise ValueError('contig ' + contig_id + ' was not found in ' + genome_fasta)
+        if contig_id in region_starts:
+            raise ValueError('contig ' + contig_id + ' occurs in more than one region')
+        contig_len = genome.Length(genome.contig_index[contig_id])
+        end = contig_len if end is None else min(end, contig_len)
+        if start >= end:
+            raise ValueError('region ' + region + ' is empty')
+        seq = str(genome.Contig(contig_id)[start : end])
+        region_fh.write('>' + contig_id + '\n' + seq + '\n')
+        window_fh.write('>CONTIG:' + contig_id + '|GENES:region|START:' + str(start) + '|END:' + str(end) + '\n' + seq + '\n')
+        region_starts[contig_id] = start
+    region_fh.close()
+    window_fh.close()
+    return region_starts
+
+class AnnotationService:
+    def __init__(self, process_job, work_dir, num_threads = 1, max_indexes = DEFAULT_MAX_INDEXES):
+        # process_job(job, index_cache, job_dir, num_threads) returns gene rows of a job
+        self.process_job = process_job
+        self.work_dir = work_dir
+        self.num_threads = num_threads
+        self.index_cache = IndexCache(os.path.join(work_dir, 'indexes'), max_indexes)
+        self.num_jobs = 0
+        self.start_time = time.time()
+
+    def Status(self):
+        status = {'status' : 'ok', 'jobs' : self.num_jobs, 'uptime' : round(time.time() - self.start_time, 3), 'threads' : self.num_threads}
+        status.update(self.index_cache.Status())
+        return status
+
+    def Process(self, request):
+        if request.get('command') == 'status':
+            return self.Status()
+        if 'genome' not in request:
+            return {'status' : 'error', 'error' : 'a job requires a genome'}
+        job_dir = tempfile.mkdtemp(prefix = 'job_', dir = self.work_dir)
+        start_time = time.time()
+        try:
+            with progress_events.Stage('service_job', genome = request['genome']):
+                genes = self.process_job(request, self.index_cache, job_dir, request.get('threads', self.num_threads))
+        except Exception as e:
+            print('ERROR: job failed: ' + repr(e))
+            return {'status' : 'error', 'error' : repr(e)}
+        finally:
+            shutil.rmtree(job_dir)
+            self.num_jobs += 1
+        return {'status' : 'ok', 'genes' : genes, 'elapsed' : round(time.time() - start_time, 3)}
+
+class ServiceHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            response = {'status' : 'error', 'error' : 'invalid request: ' + str(e)}
+        else:
+            if request.get('command') == 'shutdown':
+                response = {'status' : 'ok'}
+                self.server.stopped = True
+            else:
+                response = self.server.service.Process(request)
+        self.wfile.write((json.dumps(response) + '\n').encode())
+
+class ServiceServer(socketserver.UnixStreamServer):
+    def __init__(self, socket_path, service):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        socketserver.UnixStreamServer.__init__(self, socket_path, ServiceHandler)
+        self.service = service
+        self.stopped = False
+
+def Serve(socket_path, service):
+    # handles requests until a shutdown request is received
+    server = ServiceServer(socket_path, service)
+    print('Annotation service is listening on ' + socket_path)
+    sys.stdout.flush()
+    try:
+        while not server.stopped:
+            server.handle_request()
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+def SubmitJob(socket_path, request):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(socket_path)
+    client.sendall((json.dumps(request) + '\n').encode())
+    fh = client.makefile('r')
+    response = json.loads(fh.readline())
+    fh.close()
+    client.close()
+    return response
+
+def PrintGenes(genes):
+    print('\t'.join(GENE_COLUMNS))
+    for gene in genes:
+        print('\t'.join(str(gene[column]) for column in GENE_COLUMNS))
+
+if __name__ == '__main__':
+    options, args = getopt.gnu_getopt(sys.argv[1:], '', ['loci=', 'threads=', 'seeded', 'status', 'shutdown'])
+    request = dict()
+    for option, value in options:
+        if option == '--loci':
+            request['loci'] = value.split(',')
+        elif option == '--threads':
+            request['threads'] = int(value)
+        elif option == '--seeded':
+            request['seeded'] = True
+        elif option == '--status':
+            request = {'command' : 'status'}
+        elif option == '--shutdown':
+            request = {'command' : 'shutdown'}
+    if len(args) == 0 or ('command' not in request and len(args) < 2):
+        print('python annotation_service.py service.sock genome.fasta [contig[:start-end] ...] [--loci IGH,IGK] [--threads N] [--seeded]')
+        print('python annotation_service.py service.sock --status|--shutdown')
+        sys.exit(1)
+    if 'command' not in request:
+        request['genome'] = os.path.abspath(args[1])
+        request['regions'] = args[2:]
+    response = SubmitJob(args[0], request)
+    if response['status'] != 'ok':
+        print('ERROR: ' + response['error'])
+        sys.exit(1)
+    if 'genes' in response:
+        PrintGenes(response['genes'])
+    else:
+        print(json.dumps(response))
@@ -0,0 +1,66 @@
+import os
+import sys
+import subprocess
+
+import reference_bundle
+
+# Import-time budget of the detection path: every core module is imported by a fresh interpreter, which reports
+# the cumulative import time (python -X importtime) and the heavy modules it loaded. The check fails if a module
+# exceeds the budget or loads the plotting stack or pandas. Modules of py and the driver script are importable
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+CORE_MODULES = ['run_iterative_igdetective', 'IGDetective', 'analyze_matches', 'extract_aligned_genes', 'locus_boundaries_refiner', 'visualization_tools',
+                'packed_genome', 'reference_bundle', 'alignment_engine', 'locus_config', 'progress_events']
+FORBIDDEN_MODULES = ['matplotlib', 'seaborn', 'pandas']
+DEFAULT_BUDGET = 0.5 # seconds per module
+NUM_REPEATS = 3 # the fastest of repeated imports is compared with the budget
+
+def MeasureImport(module):
+    # returns the cumulative import time (seconds) and the loaded forbidden modules
+    code = 'import sys; import ' + module + '; print(",".join(m for m in ' + repr(FORBIDDEN_MODULES) + ' if m in sys.modules))'
+    env = dict(os.environ, PYTHONPATH = os.pathsep.join([os.path.dirname(SCRIPT_DIR)] + [p for p in [os.environ.get('PYTHONPATH')] if p]))
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd = SCRIPT_DIR, env = env, capture_output = True, text = True)
+    if proc.returncode != 0:
+        raise RuntimeError('import of ' + module + ' failed:\n' + proc.stderr)
+    import_time = None
+    for l in proc.stderr.split('\n'):
+        splits = l.split('|')
+        if l.startswith('import time:') and len(splits) == 3 and splits[2].strip() == module:
+            import_time = int(splits[1]) / 1000000
+    loaded = [m for m in proc.stdout.strip().split(',') if m != '']
+    return import_time, loaded
+
+def CheckImports(modules = CORE_MODULES, budget = DEFAULT_BUDGET, num_repeats = NUM_REPEATS):
+    # modules do not load the reference bundle on import, but it is compiled here in any case, so that building
+    # a stale bundle is never measured as import time
+    reference_bundle.LoadBundle()
+    failed = []
+    for module in modules:
+        measurements = [MeasureImport(module) for i in range(num_repeats)]
+        import_time = min(t for t, loaded in measurements)
+        loaded = measurements[0][1]
+        status = 'OK'
+        if import_time > budget:
+            status = 'SLOW'
+        if len(loaded) != 0:
+            status = 'LOADS ' + ','.join(loaded)
+        print(module + '\t' + str(round(import_time, 3)) + ' s\t' + status)
+        if status != 'OK':
+            failed.append(module)
+    return failed
+
+if __name__ == '__main__':
+    budget = DEFAULT_BUDGET
+    modules = []
+    for arg in sys.argv[1:]:
+        if arg.startswith('--budget='):
+            budget = float(arg.split('=')[1])
+        else:
+            modules.append(arg)
+    if len(modules) == 0:
+        modules = CORE_MODULES
+    print('Import time budget: ' + str(budget) + ' s per module')
+    failed = CheckImports(modules, budget)
+    if len(failed) != 0:
+        print('ERROR: import budget check failed for ' + ', '.join(failed))
+        sys.exit(1)
+    print('Import budget check passed')
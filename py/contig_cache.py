@@ -0,0 +1,170 @@
+import os
+import gzip
+import json
+import shutil
+import hashlib
+
+from Bio import SeqIO
+
+import reference_bundle
+import gene_records
+
+# Per-contig cache of pipeline results used for incremental re-annotation. The manifest stores content hashes of
+# contig sequences and of their reference gene hits, cached tables store per-contig rows of the stage outputs.
+# A contig is rerun if its sequence or hits changed, rows of unchanged contigs are taken from the cache
+CACHE_VERSION = 1
+
+ContigKey = gene_records.ContigKey
+
+def WindowContigKey(window_id):
+    return ContigKey(gene_records.ParseWindowId(window_id)[0])
+
+# output tables (relative paths) -> (contig column, function computing the contig key from the column value)
+def CachedTables(loci):
+    tables = {os.path.join('ig_contigs', '__summary.txt') : ('ContigID', ContigKey)}
+    for locus in loci:
+        for gene_type in ['V', 'J', 'D']:
+            tables[os.path.join('denovo_search', 'predicted_genes_' + locus, 'genes_' + gene_type + '.tsv')] = ('reference contig', WindowContigKey)
+        tables[os.path.join('iterative_search', locus + 'V_final', 'genes.tsv')] = ('Contig', ContigKey)
+    return tables
+
+def ReferenceFingerprint(ig_gene_dir):
+    sha1 = hashlib.sha1(str(CACHE_VERSION).encode())
+    for fname in reference_bundle.SourceFiles(ig_gene_dir, reference_bundle.DEFAULT_MOTIF_FILE):
+        sha1.update(os.path.basename(fname).encode())
+        sha1.update(reference_bundle.FileSha1(fname).encode())
+    return sha1.hexdigest()
+
+def ContigHashes(genome_fasta):
+    # contig key -> (contig ID, SHA1 of the sequence)
+    contig_hashes = dict()
+    if genome_fasta.endswith('.gz'):
+        genome_handle = gzip.open(genome_fasta, 'rt')
+    else:
+        genome_handle = open(genome_fasta, 'r')
+    for r in SeqIO.parse(genome_handle, 'fasta'):
+        contig_hashes[ContigKey(r.id)] = (r.id, hashlib.sha1(str(r.seq).encode()).hexdigest())
+    genome_handle.close()
+    return contig_hashes
+
+def HitHashes(alignment_dir):
+    # contig key -> SHA1 of the mapped hits of reference genes (SAM file, gene, flag, position and CIGAR)
+    hit_hashes = dict()
+    for sam_fname in sorted(f for f in os.listdir(alignment_dir) if f.endswith('.sam')):
+        with open(os.path.join(alignment_dir, sam_fname)) as fh:
+            for l in fh:
+                if l[0] == '@':
+                    continue
+                splits = l.split('\t')
+                if splits[5] == '*':
+                    continue
+                contig = ContigKey(splits[2])
+                if contig not in hit_hashes:
+                    hit_hashes[contig] = hashlib.sha1()
+                hit_hashes[contig].update('\t'.join([sam_fname, splits[0], splits[1], splits[3], splits[5]]).encode() + b'\n')
+    return {contig : hit_hashes[contig].hexdigest() for contig in hit_hashes}
+
+def FilterSamFile(sam_fname, output_fname, contig_ids):
+    with open(sam_fname) as fh, open(output_fname, 'w') as out_fh:
+        for l in fh:
+            if l[0] == '@' or l.split('\t', 3)[2] in contig_ids:
+                out_fh.write(l)
+
+def WriteContigs(genome_fasta, output_fasta, contig_ids):
+    if genome_fasta.endswith('.gz'):
+        genome_handle = gzip.open(genome_fasta, 'rt')
+    else:
+        genome_handle = open(genome_fasta, 'r')
+    with open(output_fasta, 'w') as fh:
+        for r in SeqIO.parse(genome_handle, 'fasta'):
+            if r.id in contig_ids:
+                fh.write('>' + r.id + '\n' + str(r.seq) + '\n')
+    genome_handle.close()
+
+class ContigCache:
+    def __init__(self, cache_dir, ig_gene_dir, loci, seeded = False):
+        self.cache_dir = cache_dir
+        self.seeded = seeded
+        self.reference = ReferenceFingerprint(ig_gene_dir)
+        self.tables = CachedTables(loci)
+        self.contigs = dict()
+        self.clean_contigs = set()
+        self.rerun_contigs = None
+        manifest_fname = os.path.join(cache_dir, 'manifest.json')
+        self.manifest = None
+        if os.path.exists(manifest_fname):
+            with open(manifest_fname) as fh:
+                self.manifest = json.load(fh)
+            if self.manifest['version'] != CACHE_VERSION or self.manifest['reference'] != self.reference:
+                print('Cached results were computed for other reference genes and will be ignored')
+                self.manifest = None
+
+    def Update(self, genome_fasta, alignment_dir):
+        # returns contig IDs that have to be processed or None if the whole genome has to be processed
+        contig_hashes = ContigHashes(genome_fasta)
+        hit_hashes = HitHashes(alignment_dir)
+        self.contigs = {contig : {'seq' : contig_hashes[contig][1], 'hits' : hit_hashes.get(contig, '')} for contig in contig_hashes}
+        if self.manifest is None:
+            return None
+        cached_contigs = self.manifest['contigs']
+        self.clean_contigs = {contig for contig in self.contigs if contig in cached_contigs and cached_contigs[contig] == self.contigs[contig]}
+        # changed contigs without hits do not contain genes, their cached rows are dropped
+        self.rerun_contigs = {contig_hashes[contig][0] for contig in self.contigs if contig not in self.clean_contigs and self.contigs[contig]['hits'] != ''}
+        print(str(len(self.clean_contigs)) + ' contigs are unchanged, ' + str(len(self.rerun_contigs)) + ' changed contigs with IG/TR hits will be processed')
+        return self.rerun_contigs
+
+    def IterativeResultsValid(self):
+        # cached results of the iterative search are valid only for the genome with the same contigs, sequences and hits
+        # and for the same alignment mode (seeded or exhaustive)
+        return self.manifest is not None and self.contigs == self.manifest['contigs'] and self.manifest.get('seeded', False) == self.seeded
+
+    def PrepareInputs(self, genome_fasta, alignment_dir, work_dir):
+        # FASTA of contigs to rerun and their reference gene hits
+        os.mkdir(work_dir)
+        work_genome = os.path.join(work_dir, 'genome.fasta')
+        WriteContigs(genome_fasta, work_genome, self.rerun_contigs)
+        work_alignment_dir = os.path.join(work_dir, 'initial_alignments')
+        os.mkdir(work_alignment_dir)
+        for sam_fname in os.listdir(alignment_dir):
+            FilterSamFile(os.path.join(alignment_dir, sam_fname), os.path.join(work_alignment_dir, sam_fname), self.rerun_contigs)
+        return work_genome, work_alignment_dir
+
+    def MergeTables(self, output_dir, prefix):
+        # appends cached rows of unchanged contigs to output tables starting with the prefix
+        import pandas as pd
+        if self.manifest is None:
+            return
+        for table in self.tables:
+            if not table.startswith(prefix):
+                continue
+            cached_fname = os.path.join(self.cache_dir, 'tables', table)
+            if not os.path.exists(cached_fname):
+                continue
+            column, get_key = self.tables[table]
+            cached_df = pd.read_csv(cached_fname, sep = '\t', dtype = str, keep_default_na = False)
+            cached_df = cached_df.loc[[get_key(contig) in self.clean_contigs for contig in cached_df[column]]]
+            output_fname = os.path.join(output_dir, table)
+            if os.path.exists(output_fname):
+                df = pd.read_csv(output_fname, sep = '\t', dtype = str, keep_default_na = False)
+                cached_df = pd.concat([df, cached_df])
+            elif len(cached_df) == 0:
+                continue
+            os.makedirs(os.path.dirname(output_fname), exist_ok = True)
+            cached_df.to_csv(output_fname, sep = '\t', index = False)
+
+    def Save(self, output_dir):
+        # the new cache is written next to the old one and moved in place
+        tmp_dir = self.cache_dir.rstrip('/') + '.tmp' + str(os.getpid())
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(os.path.join(tmp_dir, 'tables'))
+        for table in self.tables:
+            fname = os.path.join(output_dir, table)
+            if os.path.exists(fname):
+                os.makedirs(os.path.dirname(os.path.join(tmp_dir, 'tables', table)), exist_ok = True)
+                shutil.copy(fname, os.path.join(tmp_dir, 'tables', table))
+        with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as fh:
+            json.dump({'version' : CACHE_VERSION, 'reference' : self.reference, 'seeded' : self.seeded, 'contigs' : self.contigs}, fh)
+        if os.path.exists(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+        os.rename(tmp_dir, self.cache_dir)
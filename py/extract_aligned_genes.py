@@ -1,41 +1,64 @@
 import os
 import sys
-import gzip
 import shutil
-import pandas as pd
+import subprocess
+import numpy as np
 from Bio import SeqIO
 from Bio import Align
 from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+from multiprocessing import get_context
+
+import alignment_engine as align_engine
+import reference_bundle
+import packed_genome
+import progress_events
+
+GENE_LEN = 400 # half of the contig window aligned around a hit position
+# contigs, genes and hits shared with worker processes, see AlignPositions. Contigs are views of a packed genome
+# memory-mapped from the genome cache, so tasks carry only contig IDs and positions and workers read sequences
+# from the shared pages
+POSITION_TASK_DATA = None
+
+# seeded mode: nucleotides added on both sides of the minimap2 hit and the PI below which all genes are aligned
+SEED_BAND = 30
+SEEDED_PI_THRESHOLD = 70
 
 class BioAlign:
     def __init__(self, alignment):
         self.alignment = alignment
-        self.query_align = self.alignment[0].upper()
-        self.gene_align = self.alignment[1].upper()
-        self.gene_range = self._ComputeGeneRange()
+        # alignment blocks between consecutive coordinates: the fragment (row 0) and the gene (row 1) advance
+        # together in aligned blocks, only one of them advances in gaps
+        self.coordinates = np.asarray(self.alignment.coordinates)
+        self.query_steps = np.diff(self.coordinates[0])
+        self.gene_steps = np.diff(self.coordinates[1])
+        self.block_lens = np.maximum(self.query_steps, self.gene_steps)
+        self.gene_range, self.query_range = self._ComputeGeneRange()
         ####
         self.num_matches = -1
         self.query_seq = ''
 
     def _ComputeGeneRange(self):
-        start_pos = 0
-        for i in range(len(self.gene_align)):
-            if self.gene_align[i] != '-':
-                start_pos = i
-                break
-        end_pos = len(self.gene_align)
-        for i in range(len(self.gene_align)):
-            pos = len(self.gene_align) - i - 1
-            if self.gene_align[pos] != '-':
-                end_pos = pos + 1
-                break
-        return start_pos, end_pos
+        # alignment columns from the first to the last gene nucleotide and the fragment range they cover
+        gene_blocks = np.nonzero(self.gene_steps > 0)[0]
+        if len(gene_blocks) == 0:
+            return (0, int(self.block_lens.sum())), (int(self.coordinates[0][0]), int(self.coordinates[0][-1]))
+        block_ends = np.cumsum(self.block_lens)
+        first, last = gene_blocks[0], gene_blocks[-1]
+        gene_range = (int(block_ends[first] - self.block_lens[first]), int(block_ends[last]))
+        return gene_range, (int(self.coordinates[0][first]), int(self.coordinates[0][last + 1]))
 
     def NumMatches(self):
         if self.num_matches == -1:
-            for i in range(self.gene_range[0], self.gene_range[1]):
-                if self.query_align[i] == self.gene_align[i]:
-                    self.num_matches += 1
+            # only aligned blocks can contain matches, all of them lie within the gene range
+            blocks = np.nonzero((self.query_steps > 0) & (self.gene_steps > 0))[0]
+            lens = self.query_steps[blocks]
+            offsets = np.arange(lens.sum()) - np.repeat(np.cumsum(lens) - lens, lens)
+            query_idx = np.repeat(self.coordinates[0][blocks], lens) + offsets
+            gene_idx = np.repeat(self.coordinates[1][blocks], lens) + offsets
+            query = align_engine.EncodeSeq(str(self.alignment.target).upper())
+            gene = align_engine.EncodeSeq(str(self.alignment.query).upper())
+            self.num_matches += int(np.count_nonzero(query[query_idx] == gene[gene_idx]))
         return self.num_matches
 
     def PI(self):
@@ -43,11 +66,7 @@ class BioAlign:
 
     def QuerySeq(self):
         if self.query_seq == '':
-            nucls = []
-            for n in self.query_align[self.gene_range[0] : self.gene_range[1]]:
-                if n != '-':
-                    nucls.append(n)
-            self.query_seq = ''.join(nucls)
+            self.query_seq = str(self.alignment.target[self.query_range[0] : self.query_range[1]]).upper()
         return self.query_seq
 
     def __len__(self):
@@ -83,116 +102,296 @@ def SetupAligner(aligner):
     aligner.query_end_open_gap_score = 0
     aligner.query_end_extend_gap_score = 0
 
-def ComputeAlignment(aligner, query_list, strand_list, gene_seqs):
-    best_alignment = ''
+def FindBestGene(query_list, strand_list, ref_set):
+    # returns the query, the strand and the index of the gene with the highest PI or -1 if no gene is aligned
+    best_query = ''
     best_pi = 0
-    best_gene = ''
+    best_gene = -1
     best_strand = ''
     for query, strand in zip(query_list, strand_list):
-        for gene in gene_seqs:
-            alignments = aligner.align(query, gene.seq)
-            if len(alignments) == 0:
-                continue
-            alignment = BioAlign(alignments[0])
-            if alignment.PI() >= best_pi:
-                best_pi = alignment.PI()
-                best_alignment = alignment
-                best_gene = gene.id
-                best_strand = strand
-    if len(best_alignment) == 0:
-        return Alignment(), ''
+        pis = align_engine.SearchFragment(query, ref_set).PI()
+        # the last gene with the highest PI is taken
+        gene_idx = len(pis) - 1 - np.argmax(pis[:: -1])
+        if pis[gene_idx] >= best_pi:
+            best_pi = pis[gene_idx]
+            best_query = query
+            best_gene = gene_idx
+            best_strand = strand
+    return best_query, best_strand, best_gene
+
+def TraceAlignment(aligner, query, gene):
+    best_alignment = BioAlign(aligner.align(query, gene.seq)[0])
     alignment = Alignment()
-    alignment.Initiate(best_alignment.QuerySeq(), best_gene, best_pi)
-    return alignment, best_strand
+    alignment.Initiate(best_alignment.QuerySeq(), gene.id, best_alignment.PI())
+    return alignment
+
+def ComputeAlignment(aligner, query_list, strand_list, gene_seqs, ref_set = None):
+    if ref_set is None:
+        ref_set = align_engine.ReferenceSet([gene.seq for gene in gene_seqs], [gene.id for gene in gene_seqs])
+    if len(ref_set) == 0:
+        return Alignment(), ''
+    best_query, best_strand, best_gene = FindBestGene(query_list, strand_list, ref_set)
+    if best_gene == -1:
+        return Alignment(), ''
+    # traceback is computed for the best gene only
+    return TraceAlignment(aligner, best_query, gene_seqs[best_gene]), best_strand
+
+def GetSeededQueries(contig_seq, hits, band):
+    # one query per hit strand covering the hits extended by clipped gene ends and the band
+    query_list = []
+    strand_list = []
+    for strand in ['+', '-']:
+        strand_hits = [hit for hit in hits if hit.strand == strand]
+        if len(strand_hits) == 0:
+            continue
+        start = max(0, min([hit.pos - 1 - hit.left_clip for hit in strand_hits]) - band)
+        end = min(len(contig_seq), max([hit.pos - 1 + hit.ref_len + hit.right_clip for hit in strand_hits]) + band)
+        query = contig_seq[start : end]
+        if strand == '-':
+            query = query.reverse_complement()
+        query_list.append(str(query).upper())
+        strand_list.append(strand)
+    return query_list, strand_list
+
+def ComputeSeededAlignment(aligner, fragment, contig_seq, hits, gene_seqs, ref_set, gene_index, band = SEED_BAND, pi_threshold = SEEDED_PI_THRESHOLD):
+    # the best of the genes that produced the hits is chosen on the hit region in the hit orientation. The chosen gene
+    # is then traced on the whole fragment in this orientation, so that its PI (compared with the threshold) and
+    # its sequence are computed as in the exhaustive mode. The whole fragment is aligned to all genes on both strands
+    # only if the seeded alignment is poor
+    fragment_rc = str(Seq(fragment).reverse_complement())
+    shortlist = sorted(set([gene_index[hit.gene_id] for hit in hits if hit.gene_id in gene_index]))
+    if len(shortlist) != 0:
+        query_list, strand_list = GetSeededQueries(contig_seq, hits, band)
+        query, strand, gene_idx = FindBestGene(query_list, strand_list, ref_set.Subset(shortlist))
+        if gene_idx != -1:
+            alignment = TraceAlignment(aligner, fragment if strand == '+' else fragment_rc, gene_seqs[shortlist[gene_idx]])
+            if not alignment.Empty() and alignment.pi >= pi_threshold:
+                return alignment, strand
+    return ComputeAlignment(aligner, [fragment, fragment_rc], ['+', '-'], gene_seqs, ref_set)
+
+def AlignPosition(task):
+    c_id, pos = task
+    contig_dict, hit_dict, genes, ref_set, gene_index, aligner, seeded = POSITION_TASK_DATA
+    contig_seq = contig_dict[c_id]
+    fragment = str(contig_seq[max(0, pos - GENE_LEN) : min(len(contig_seq), pos + GENE_LEN)]).upper()
+    if seeded:
+        return ComputeSeededAlignment(aligner, fragment, contig_seq, hit_dict[c_id][pos], genes, ref_set, gene_index)
+    fragment_rc = str(Seq(fragment).reverse_complement())
+    return ComputeAlignment(aligner, [fragment, fragment_rc], ['+', '-'], genes, ref_set)
+
+def SelectPositions(positions, prev_pos = -1):
+    # greedy spacing filter assuming that every selected position yields a gene
+    selected = []
+    for pos in positions:
+        pos = int(pos)
+        if pos - prev_pos <= GENE_LEN:
+            continue
+        selected.append(pos)
+        prev_pos = pos
+    return selected
+
+def AlignPositions(position_dict, contig_dict, hit_dict, genes, ref_set, gene_index, seeded, num_workers):
+    # Positions passing the spacing filter are aligned in parallel under the assumption that all of them yield genes.
+    # The filter is then replayed serially with the actual results: a position without a gene does not update
+    # the previous position, positions skipped by the speculative filter are aligned on demand,
+    # so the output is the same as the one of the serial loop.
+    global POSITION_TASK_DATA
+    aligner = Align.PairwiseAligner()
+    SetupAligner(aligner)
+    POSITION_TASK_DATA = (contig_dict, hit_dict, genes, ref_set, gene_index, aligner, seeded)
+    tasks = [(c_id, pos) for c_id in position_dict for pos in SelectPositions(position_dict[c_id])]
+    progress = progress_events.Progress('position_alignment', len(tasks))
+    if num_workers > 1 and len(tasks) > 1:
+        chunksize = max(1, len(tasks) // (num_workers * 4))
+        with get_context('fork').Pool(num_workers) as p:
+            results = dict(zip(tasks, progress.Track(p.imap(AlignPosition, tasks, chunksize))))
+    else:
+        results = {task : AlignPosition(task) for task in progress.Track(tasks)}
+    accepted = []
+    for c_id in position_dict:
+        prev_pos = -1
+        for pos in position_dict[c_id]:
+            pos = int(pos)
+            if pos - prev_pos <= GENE_LEN:
+                continue
+            if (c_id, pos) not in results:
+                results[(c_id, pos)] = AlignPosition((c_id, pos))
+            alignment, strand = results[(c_id, pos)]
+            if alignment.Empty():
+                continue
+            accepted.append((c_id, pos, alignment, strand))
+            prev_pos = pos
+    return accepted
+
+def ReadGenes(gene_fasta):
+    # reference gene files are read from the compiled bundle, other files (e.g., genes of previous iterations) are parsed
+    bundle = reference_bundle.LoadBundle()
+    gene_type = bundle.GeneTypeBySource(gene_fasta)
+    if gene_type is not None:
+        return [SeqRecord(Seq(seq), id = gene_id) for gene_id, seq in zip(bundle.GeneIds(gene_type), bundle.GeneSeqs(gene_type))]
+    genes = []
+    for r in SeqIO.parse(gene_fasta, 'fasta'):
+        r.seq = r.seq.upper()
+        genes.append(r)
+    return genes
+
+def ReadGeneClusters(gene_fasta):
+    # clusters of reference genes compiled into the bundle, genes of other files are not clustered
+    bundle = reference_bundle.LoadBundle()
+    gene_type = bundle.GeneTypeBySource(gene_fasta)
+    if gene_type is None:
+        return None
+    return bundle.Clusters(gene_type)
 
 def PrepareOutputDir(output_dir):
     if os.path.exists(output_dir):
         shutil.rmtree(output_dir)
     os.mkdir(output_dir)
 
-def ProcessSamFile(sam_file):
-    position_dict = dict()
-    for l in open(sam_file).readlines():
+class Hit:
+    def __init__(self, gene_id, contig_id, pos, strand, ref_len, left_clip, right_clip):
+        self.gene_id = gene_id
+        self.contig_id = contig_id
+        self.pos = pos # 1-based leftmost position of the hit in the contig
+        self.strand = strand
+        self.ref_len = ref_len
+        # unaligned gene nucleotides before and after the hit in contig coordinates
+        self.left_clip = left_clip
+        self.right_clip = right_clip
+
+def ParseCigar(cigar):
+    # returns the reference length and the clipped lengths at both ends of the alignment
+    ref_len = 0
+    clips = []
+    num = ''
+    for c in cigar:
+        if c.isdigit():
+            num += c
+            continue
+        if c in 'MDN=X':
+            ref_len += int(num)
+        elif c in 'SH':
+            clips.append((ref_len == 0, int(num)))
+        num = ''
+    left_clip = sum([l for is_left, l in clips if is_left])
+    right_clip = sum([l for is_left, l in clips if not is_left])
+    return ref_len, left_clip, right_clip
+
+def ParseHit(line, hit_format):
+    # returns None for headers and unmapped records
+    if line[0] == '@':
+        return None
+    splits = line.split('\t')
+    if hit_format == 'paf':
+        query_len, query_start, query_end = int(splits[1]), int(splits[2]), int(splits[3])
+        strand = splits[4]
+        left_clip, right_clip = query_start, query_len - query_end
+        if strand == '-':
+            left_clip, right_clip = right_clip, left_clip
+        # PAF target start is 0-based
+        return Hit(splits[0], splits[5], int(splits[7]) + 1, strand, int(splits[8]) - int(splits[7]), left_clip, right_clip)
+    if splits[2] == '*':
+        return None
+    strand = '-' if int(splits[1]) & 16 else '+'
+    ref_len, left_clip, right_clip = ParseCigar(splits[5])
+    return Hit(splits[0], splits[2], int(splits[3]), strand, ref_len, left_clip, right_clip)
+
+def CollectHits(lines, hit_format = 'sam'):
+    # returns per-contig sorted positions and hits grouped by contig and position
+    hit_dict = dict()
+    for l in lines:
         l = l.strip()
-        if l[0] == '@':
+        if l == '':
             continue
-        splits = l.split()
-        contig_id = splits[2]
-        pos = int(splits[3])
-        if contig_id == '*':
+        hit = ParseHit(l, hit_format)
+        if hit is None:
             continue
-        if contig_id not in position_dict:
-            position_dict[contig_id] = []
-        if pos not in position_dict[contig_id]:
-            position_dict[contig_id].append(pos)
-    return position_dict
+        if hit.contig_id not in hit_dict:
+            hit_dict[hit.contig_id] = dict()
+        if hit.pos not in hit_dict[hit.contig_id]:
+            hit_dict[hit.contig_id][hit.pos] = []
+        hit_dict[hit.contig_id][hit.pos].append(hit)
+    position_dict = {contig_id : np.sort(np.fromiter(hit_dict[contig_id], dtype = np.int64)) for contig_id in hit_dict}
+    return position_dict, hit_dict
+
+def CollectHitPositions(lines, hit_format = 'sam'):
+    return CollectHits(lines, hit_format)[0]
+
+def ProcessSamFile(sam_file):
+    with open(sam_file) as fh:
+        return CollectHitPositions(fh, 'sam')
+
+def TeeLines(lines, output_fname):
+    with open(output_fname, 'w') as fh:
+        for l in lines:
+            fh.write(l)
+            yield l
+
+def RunMinimap(genome_fasta, gene_fasta, hit_format = 'sam', alignment_file = None, minimap_index = None):
+    # minimap2 output is parsed while it is produced, it is written to alignment_file only if the file is given.
+    # A prebuilt minimap2 index of the genome is used instead of the FASTA file if it is given
+    command = ['minimap2', genome_fasta if minimap_index is None else minimap_index, gene_fasta]
+    if hit_format == 'sam':
+        command.insert(1, '-a')
+    with progress_events.Stage('minimap2', genes = os.path.basename(gene_fasta)) as stage:
+        proc = subprocess.Popen(command, stdout = subprocess.PIPE, stderr = subprocess.DEVNULL, text = True)
+        lines = proc.stdout
+        if alignment_file is not None:
+            lines = TeeLines(lines, alignment_file)
+        position_dict, hit_dict = CollectHits(lines, hit_format)
+        proc.stdout.close()
+        if proc.wait() != 0:
+            stage.Fail(exit_code = proc.returncode)
+    if proc.returncode != 0:
+        print('ERROR: minimap2 failed with exit code ' + str(proc.returncode))
+        return dict(), dict()
+    progress_events.Count('minimap2', 'hit_positions', sum(len(positions) for positions in position_dict.values()), genes = os.path.basename(gene_fasta))
+    return position_dict, hit_dict
 
-def main(genome_fasta, gene_fasta, output_dir):
+def main(genome_fasta, gene_fasta, output_dir, hit_format = 'sam', keep_alignment = False, seeded = False, num_workers = 1, minimap_index = None, genome = None):
+    # genome is a packed genome of genome_fasta, by default it is loaded from the genome cache
+    # pandas is only needed for the output table, IGDetective imports this module for the aligner utilities
+    import pandas as pd
     PrepareOutputDir(output_dir)
 
     print('Running minimap...')
     print('Alignment of IG genes ' + gene_fasta + ' to ' + genome_fasta)
-    sam_file = os.path.join(output_dir, 'alignment.sam')
-    os.system('minimap2 -a ' + genome_fasta + ' ' + gene_fasta + ' -o ' + sam_file + '> /dev/null 2>&1')
-
-    print('Processing SAM file...')
-    position_dict = ProcessSamFile(sam_file)
+    alignment_file = None
+    if keep_alignment:
+        alignment_file = os.path.join(output_dir, 'alignment.' + hit_format)
+    position_dict, hit_dict = RunMinimap(genome_fasta, gene_fasta, hit_format, alignment_file, minimap_index)
     if len(position_dict) == 0:
         print('no matches were found')
         return
     
-    if genome_fasta.endswith('.gz'):
-        genome_handle = gzip.open(genome_fasta, 'rt')
-    else:
-        genome_handle = open(genome_fasta, 'r')
-    contig_dict = dict()
-    for r in SeqIO.parse(genome_handle, 'fasta'):
-        if r.id in position_dict:
-            contig_dict[r.id] = str(r.seq)
-    genome_handle.close()
+    if genome is None:
+        genome = packed_genome.LoadGenome(genome_fasta)
+    contig_dict = genome.Contigs(position_dict)
 
-    genes = []
-    for r in SeqIO.parse(gene_fasta, 'fasta'):
-        r.seq = str(r.seq).upper()
-        genes.append(r)
+    genes = ReadGenes(gene_fasta)
 
-    aligner = Align.PairwiseAligner()
-    SetupAligner(aligner)
+    ref_set = align_engine.ReferenceSet([gene.seq for gene in genes], [gene.id for gene in genes], ReadGeneClusters(gene_fasta), reference_bundle.LoadBundle().ClusterIdentity())
+    gene_index = {gene.id : i for i, gene in enumerate(genes)}
 
-    gene_len = 400 #max([len(gene) for gene in genes])
     df = {'Contig' : [], 'Pos' : [], 'Seq' : [], 'AASeq' : [], 'PI' : [], 'BestHit' : [], 'Productive' : [], 'Strand' : []}
-    for c_id in position_dict:
-        contig_seq = contig_dict[c_id]
-        prev_pos = -1
-        for pos in sorted(position_dict[c_id]):
-            if pos - prev_pos <= gene_len:
-                continue
-            fragment = contig_seq[max(0, pos - gene_len) : min(len(contig_seq), pos + gene_len)]
-            fragment_rc = str(Seq(fragment).reverse_complement())
-            alignment, strand = ComputeAlignment(aligner, [fragment, fragment_rc], ['+', '-'], genes)
-            if alignment.Empty():
-                continue
-            aa_seq = str(Seq(alignment.gene_seq).translate())
-#            if aa_seq.find('*') != -1:
-#                print('non-productive gene')
-#                continue
-#            print('==== ' + c_id + ', pos: ' + str(pos) + ', gene: ' + alignment.gene_id + ', PI: ' + str(alignment.pi))
-#            print(alignment.gene_seq)
-#            print(aa_seq)
-            df['Contig'].append(c_id)
-            df['Pos'].append(pos)
-            df['Seq'].append(alignment.gene_seq)
-            df['AASeq'].append(aa_seq)
-            df['PI'].append(alignment.pi)
-            df['BestHit'].append(alignment.gene_id)
-            df['Productive'].append(aa_seq.find('*') == -1)
-            df['Strand'].append(strand)
-            prev_pos = pos
+    with progress_events.Stage('position_alignment', genes = os.path.basename(gene_fasta), positions = sum(len(positions) for positions in position_dict.values())):
+        accepted = AlignPositions(position_dict, contig_dict, hit_dict, genes, ref_set, gene_index, seeded, num_workers)
+    for c_id, pos, alignment, strand in accepted:
+        aa_seq = str(Seq(alignment.gene_seq).translate())
+        df['Contig'].append(c_id)
+        df['Pos'].append(pos)
+        df['Seq'].append(alignment.gene_seq)
+        df['AASeq'].append(aa_seq)
+        df['PI'].append(alignment.pi)
+        df['BestHit'].append(alignment.gene_id)
+        df['Productive'].append(aa_seq.find('*') == -1)
+        df['Strand'].append(strand)
 
     df = pd.DataFrame(df)
     df.to_csv(os.path.join(output_dir, 'genes.tsv'), index = False, sep = '\t')
 
     print('# detected genes: ' + str(len(df)))
+    progress_events.Count('position_alignment', 'genes', len(df), genes = os.path.basename(gene_fasta))
 
     fh = open(os.path.join(output_dir, 'genes.fasta'), 'w')
     for i in range(len(df)):
@@ -200,11 +399,17 @@ def main(genome_fasta, gene_fasta, output_dir):
     fh.close()
 
 if __name__ == '__main__':
-    if len(sys.argv) != 4:
+    options = sys.argv[4:]
+    seeded = '--seeded' in options
+    num_workers = 1
+    for option in options:
+        if option.startswith('--threads='):
+            num_workers = int(option.split('=')[1])
+    if len(sys.argv) < 4 or len([o for o in options if o != '--seeded' and not o.startswith('--threads=')]) != 0:
        print('Invalid arguments')
-       print('python extract_aligned_genes.py genome.fasta reference_IG_genes.fasta output_dir')
+       print('python extract_aligned_genes.py genome.fasta reference_IG_genes.fasta output_dir [--seeded] [--threads=N]')
        sys.exit(1)
     genome_fasta = sys.argv[1]
     gene_fasta = sys.argv[2]
     output_dir = sys.argv[3]
-    main(genome_fasta, gene_fasta, output_dir)
+    main(genome_fasta, gene_fasta, output_dir, seeded = seeded, num_workers = num_workers)
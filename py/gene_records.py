@@ -0,0 +1,114 @@
+import csv
+import numpy as np
+
+# Gene records shared by the stages: one row of a structured array per gene with an integer index into the contig
+# table and a position on the contig (window offsets of the de novo search are already added). Stage tables
+# (IgDetective and alignment TSVs) are parsed into records once, combined gene tables are written from records
+GENE_DTYPE = np.dtype([('locus', 'U3'), ('gene_type', 'U1'), ('contig', np.int32), ('pos', np.int64), ('strand', 'U1'), ('productive', np.int8)])
+GENE_COLUMNS = ['GeneType', 'Contig', 'Pos', 'Strand', 'Sequence', 'Productive', 'Locus']
+PRODUCTIVE_VALUES = {'True' : 1, 'False' : 0}
+PRODUCTIVE_NAMES = {1 : 'True', 0 : 'False', -1 : 'NA'}
+
+def ContigKey(contig_id):
+    # contig IDs of output tables and files
+    return contig_id.replace('|', '_')
+
+def ParseWindowId(window_id):
+    # IgDetective windows are named CONTIG:<contig>|GENES:<genes>|START:<start>|END:<end>
+    splits = window_id.split('|')
+    return splits[0].split(':')[1], int(splits[2].split(':')[1])
+
+def ReadTsv(fname):
+    with open(fname, newline = '') as fh:
+        return list(csv.DictReader(fh, delimiter = '\t'))
+
+class GeneRecords:
+    def __init__(self):
+        self.contig_ids = []
+        self.contig_index = dict()
+        self.records = np.zeros(0, dtype = GENE_DTYPE)
+        self.sequences = []
+
+    def __len__(self):
+        return len(self.records)
+
+    def ContigIndex(self, contig_id):
+        if contig_id not in self.contig_index:
+            self.contig_index[contig_id] = len(self.contig_ids)
+            self.contig_ids.append(contig_id)
+        return self.contig_index[contig_id]
+
+    def Append(self, rows, sequences):
+        # rows are (locus, gene_type, contig index, pos, strand, productive) tuples
+        self.records = np.concatenate([self.records, np.array(rows, dtype = GENE_DTYPE)])
+        self.sequences.extend(sequences)
+
+    def Extend(self, other):
+        records = other.records.copy()
+        contig_map = np.array([self.ContigIndex(contig_id) for contig_id in other.contig_ids], dtype = np.int32)
+        if len(records) != 0:
+            records['contig'] = contig_map[records['contig']]
+        self.records = np.concatenate([self.records, records])
+        self.sequences.extend(other.sequences)
+
+    def Contig(self, i):
+        return self.contig_ids[self.records['contig'][i]]
+
+    def Count(self, gene_type):
+        return int(np.count_nonzero(self.records['gene_type'] == gene_type))
+
+    def SortByPosition(self):
+        # by contig ID and position, genes at the same position keep their order
+        contig_ranks = {contig_id : rank for rank, contig_id in enumerate(sorted(self.contig_ids))}
+        contig_order = np.array([contig_ranks[contig_id] for contig_id in self.contig_ids], dtype = np.int64)
+        order = np.lexsort((self.records['pos'], contig_order[self.records['contig']]))
+        self.records = self.records[order]
+        self.sequences = [self.sequences[i] for i in order]
+
+    def Rows(self):
+        # output rows as dicts of GENE_COLUMNS
+        for i, r in enumerate(self.records):
+            yield {'GeneType' : str(r['gene_type']), 'Contig' : self.contig_ids[r['contig']], 'Pos' : int(r['pos']), 'Strand' : str(r['strand']),
+                   'Sequence' : self.sequences[i], 'Productive' : PRODUCTIVE_NAMES[int(r['productive'])], 'Locus' : str(r['locus'])}
+
+    def WriteTsv(self, fname):
+        fh = open(fname, 'w')
+        fh.write('\t'.join(GENE_COLUMNS) + '\n')
+        for row in self.Rows():
+            fh.write('\t'.join(str(row[column]) for column in GENE_COLUMNS) + '\n')
+        fh.close()
+
+def ReadAlignedGenes(fname, locus, gene_type, records):
+    # genes.tsv of extract_aligned_genes, positions are contig positions
+    rows = []
+    sequences = []
+    for row in ReadTsv(fname):
+        rows.append((locus, gene_type, records.ContigIndex(ContigKey(row['Contig'])), int(row['Pos']), row['Strand'], PRODUCTIVE_VALUES.get(row['Productive'], -1)))
+        sequences.append(row['Seq'])
+    records.Append(rows, sequences)
+
+def ReadDenovoGenes(fname, locus, gene_type, records):
+    # genes_<type>.tsv of IgDetective, positions are lifted from windows to contigs. Every window ID is parsed once
+    windows = dict()
+    rows = []
+    sequences = []
+    for row in ReadTsv(fname):
+        window_id = row['reference contig']
+        if window_id not in windows:
+            contig_id, start_pos = ParseWindowId(window_id)
+            windows[window_id] = (records.ContigIndex(ContigKey(contig_id)), start_pos)
+        contig_idx, start_pos = windows[window_id]
+        rows.append((locus, gene_type, contig_idx, start_pos + int(row['start of gene']), row['strand'], -1))
+        sequences.append(row['gene sequence'])
+    records.Append(rows, sequences)
+
+def ReadGeneTable(fname):
+    # combined gene table written by GeneRecords.WriteTsv
+    records = GeneRecords()
+    rows = []
+    sequences = []
+    for row in ReadTsv(fname):
+        rows.append((row['Locus'], row['GeneType'], records.ContigIndex(row['Contig']), int(row['Pos']), row['Strand'], PRODUCTIVE_VALUES.get(row['Productive'], -1)))
+        sequences.append(row['Sequence'])
+    records.Append(rows, sequences)
+    return records
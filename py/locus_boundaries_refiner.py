@@ -1,109 +1,86 @@
 import os
 import sys
-import gzip
-import pandas as pd
 import numpy as np
-from Bio import SeqIO
 
-import matplotlib as mplt
-mplt.use('Agg')
-import matplotlib.pyplot as plt
-import seaborn as sns
+import visualization_tools as visual_tools
+import packed_genome
 
-def ComputeRanges(distances, max_dist = 300000):
-    ranges = []
-    start_idx = -1
-    end_idx = -1
-    for idx, dist in enumerate(distances):
-        if dist <= max_dist:
-            if start_idx == -1:
-                start_idx = idx
-                end_idx = idx
-            end_idx += 1
-        else:
-            if start_idx != -1:
-                ranges.append((start_idx, end_idx))
-            start_idx = -1
-    if start_idx != -1:
-        ranges.append((start_idx, end_idx))
-    return ranges
+def ComputeLocusClusters(df, max_dist = 300000):
+    # genes sorted by contig and position are split into clusters at contig changes and at gaps longer than max_dist.
+    # Clusters of single genes and contigs with at most 2 genes are discarded (cluster -1)
+    df = df.sort_values(by = ['Contig', 'Pos'], kind = 'mergesort')
+    contigs = df['Contig'].values
+    positions = df['Pos'].values
+    new_contig = np.concatenate([[True], contigs[1 :] != contigs[: -1]])
+    new_cluster = new_contig | np.concatenate([[True], np.diff(positions) > max_dist])
+    cluster = np.cumsum(new_cluster) - 1
+    contig_size = np.diff(np.append(np.flatnonzero(new_contig), len(df)))
+    cluster_size = np.bincount(cluster)
+    keep = (np.repeat(contig_size, contig_size) > 2) & (cluster_size[cluster] > 1)
+    df = df.assign(Cluster = np.where(keep, cluster, -1))
+    return df.loc[df['Cluster'] != -1]
 
 def ComputeSummaryDF(dfs, contig_len_dict, shift):
-    locus_df = {'LocusID' : [], 'Locus' : [], 'Contig' : [], 'StartPos' : [], 'EndPos' : [], 'Length' : [], 'GeneTypes' : [], 'NumV' : [], 'NumProdV' : [], 'FracProdV' : [], 'RelStart' : [], 'RelEnd' : []}
-    locus_id = 1
+    import pandas as pd
+    dfs = [df for df in dfs if len(df) != 0]
+    columns = ['LocusID', 'Locus', 'Contig', 'StartPos', 'EndPos', 'Length', 'GeneTypes', 'NumV', 'NumProdV', 'FracProdV', 'RelStart', 'RelEnd']
+    if len(dfs) == 0:
+        return pd.DataFrame({c : [] for c in columns})
+    # clusters of every locus file are numbered after clusters of the previous files
+    clustered = []
+    num_clusters = 0
     for df in dfs:
-        if len(df) == 0:
-            continue
-        locus = df['Locus'][0]
-        contigs = set(df['Contig'])
-        for contig in contigs:
-            contig_df = df.loc[df['Contig'] == contig]
-            if len(contig_df) <= 2:
-                continue
-            positions = sorted(contig_df['Pos'])
-            distances = []
-            for i in range(1, len(positions)):
-                distances.append(positions[i] - positions[i - 1])
-            ranges = ComputeRanges(distances)
-            for start_idx, end_idx in ranges:
-                start_pos = positions[start_idx]
-                end_pos = positions[end_idx]
-                range_df = contig_df.loc[(contig_df['Pos'] >= start_pos) & (contig_df['Pos'] <= end_pos)]
-                range_v_df = range_df.loc[range_df['GeneType'] == 'V']
-                range_prod_v_df = range_v_df.loc[range_v_df['Productive']]
-                locus_df['LocusID'].append(locus_id)
-                locus_df['Locus'].append(locus)
-                locus_df['Contig'].append(contig)
-                refined_start = max(0, start_pos - shift)
-                locus_df['StartPos'].append(refined_start)
-                refined_end = min(end_pos + shift, contig_len_dict[contig])
-                locus_df['EndPos'].append(refined_end)
-                locus_df['Length'].append(refined_end - refined_start)
-                locus_df['GeneTypes'].append(','.join(sorted(set(range_df['GeneType']))))
-                locus_df['NumV'].append(len(range_v_df))
-                locus_df['NumProdV'].append(len(range_prod_v_df))
-                frac_prod = 0
-                if len(range_v_df) != 0:
-                    frac_prod = len(range_prod_v_df) / len(range_v_df)
-                locus_df['FracProdV'].append(frac_prod)
-                locus_df['RelStart'].append(refined_start / contig_len_dict[contig])
-                locus_df['RelEnd'].append(refined_end / contig_len_dict[contig])
-                locus_id += 1
-    locus_df = pd.DataFrame(locus_df)
-    return locus_df
+        cluster_df = ComputeLocusClusters(df).assign(Locus = df['Locus'].values[0])
+        cluster_df['Cluster'] += num_clusters
+        num_clusters = cluster_df['Cluster'].max() + 1 if len(cluster_df) != 0 else num_clusters
+        clustered.append(cluster_df)
+    gene_df = pd.concat(clustered)
+    is_v = gene_df['GeneType'] == 'V'
+    gene_df = gene_df.assign(IsV = is_v, IsProdV = is_v & (gene_df['Productive'] == True))
+    locus_df = gene_df.groupby('Cluster', sort = True).agg(Locus = ('Locus', 'first'), Contig = ('Contig', 'first'),
+                                                          MinPos = ('Pos', 'min'), MaxPos = ('Pos', 'max'),
+                                                          GeneTypes = ('GeneType', lambda x : ','.join(sorted(set(x)))),
+                                                          NumV = ('IsV', 'sum'), NumProdV = ('IsProdV', 'sum')).reset_index(drop = True)
+    contig_lens = locus_df['Contig'].map(contig_len_dict)
+    locus_df['LocusID'] = np.arange(1, len(locus_df) + 1)
+    locus_df['StartPos'] = np.maximum(0, locus_df['MinPos'] - shift)
+    locus_df['EndPos'] = np.minimum(locus_df['MaxPos'] + shift, contig_lens)
+    locus_df['Length'] = locus_df['EndPos'] - locus_df['StartPos']
+    locus_df['NumV'] = locus_df['NumV'].astype(int)
+    locus_df['NumProdV'] = locus_df['NumProdV'].astype(int)
+    locus_df['FracProdV'] = np.where(locus_df['NumV'] != 0, locus_df['NumProdV'] / locus_df['NumV'].clip(lower = 1), 0)
+    locus_df['RelStart'] = locus_df['StartPos'] / contig_lens
+    locus_df['RelEnd'] = locus_df['EndPos'] / contig_lens
+    return locus_df[columns]
+
+class LocusIndex:
+    # interval index of loci: contig -> loci sorted by start, queried by contig and position
+    def __init__(self, locus_df):
+        self.locus_df = locus_df
+        self.contig_loci = dict()
+        for contig, contig_df in locus_df.groupby('Contig', sort = False):
+            contig_df = contig_df.sort_values(by = 'StartPos', kind = 'mergesort')
+            self.contig_loci[contig] = (contig_df['StartPos'].values, contig_df['EndPos'].values, contig_df.index.values)
+
+    def Query(self, contig, pos):
+        # index labels of loci of the contig containing the position
+        if contig not in self.contig_loci:
+            return []
+        starts, ends, labels = self.contig_loci[contig]
+        num_started = np.searchsorted(starts, pos, 'right')
+        return labels[: num_started][ends[: num_started] >= pos].tolist()
 
-def VisualizeSummary(locus_df, output_fname):
+def VisualizeSummary(locus_df, output_fname, plot_jobs = None):
     if len(locus_df) == 0:
         return
     locus_colors = {'IGH' : '#9367BD', 'IGK' : 'orange', 'IGL' : '#2AA02B', 'TRA' : '#D62727', 'TRB' : '#1F77B4', 'TRG' : '#E377C1'}
-    fig, axes = plt.subplots(nrows = 3, figsize = (15, 10))
-    x = np.array(range(len(locus_df)))
-    colors = [locus_colors[locus_df['Locus'][i]] for i in range(len(locus_df))]
-    # lengths
-    sns.barplot(x = x, y = locus_df['Length'], palette = colors, ax = axes[0])
-    plt.sca(axes[0])
-    plt.xticks([], [])
-    # fraction productive Vs
-    sns.barplot(x = x, y = locus_df['NumProdV'], palette = colors, ax = axes[1])
-    plt.sca(axes[1])
-    plt.xticks([], [])
-    # positions
-    rel_pos_df = {'Index' : [], 'RelPos' : []}
-    for i in range(len(locus_df)):
-        rel_pos_df['Index'].append(i)
-        rel_pos_df['RelPos'].append(locus_df['RelStart'][i])
-        rel_pos_df['Index'].append(i)
-        rel_pos_df['RelPos'].append(locus_df['RelEnd'][i])
-    rel_pos_df = pd.DataFrame(rel_pos_df)
-    sns.swarmplot(x = 'Index', y = 'RelPos', data = rel_pos_df, palette = colors, ax = axes[2])
-    plt.sca(axes[2])
-    plt.xticks(x, locus_df['Contig'], rotation = 90, fontsize = 6)
-    plt.ylim(0, 1.01)
-    plt.xlabel('')
-    # output
-    plt.tight_layout()
-    plt.savefig(output_fname, dpi = 300)
-    plt.clf()
+    data = {'colors' : [locus_colors[locus] for locus in locus_df['Locus']],
+            'lengths' : locus_df['Length'].tolist(),
+            'num_prod_v' : locus_df['NumProdV'].tolist(),
+            'rel_start' : locus_df['RelStart'].tolist(),
+            'rel_end' : locus_df['RelEnd'].tolist(),
+            'contigs' : locus_df['Contig'].tolist()}
+    visual_tools.SubmitPlot(plot_jobs, 'locus_summary', output_fname, data)
 
 def GetRangeBasename(summary_df, idx):
     return summary_df['Locus'][idx] + '_' + summary_df['Contig'][idx] + '_' + str(summary_df['NumV'][idx]) + 'Vs'
@@ -114,38 +91,37 @@ def OutputLociToFastaFiles(summary_df, contig_seq_dict, output_dir):
         contig_len = len(contig_seq)
         start_pos = summary_df['StartPos'][i]
         end_pos = summary_df['EndPos'][i]
-        fragment = contig_seq[start_pos : end_pos]
+        fragment = str(contig_seq[start_pos : end_pos])
         fname = os.path.join(output_dir, GetRangeBasename(summary_df, i) + '.fasta')
         fh = open(fname, 'w')
         fh.write('>' + summary_df['Contig'][i] + '_' + str(summary_df['LocusID'][i]) + '_' + summary_df['Locus'][i] + '\n' + fragment + '\n')
         fh.close()
 
-def VisualizeGenePositions(gene_df, locus_df, output_dir):
+def VisualizeGenePositions(gene_df, locus_df, output_dir, plot_jobs = None):
     gene_color = {'V' : '#1F77B4', 'D' : '#FF7F0F', 'J' : '#2AA02B'}
+    # genes of every contig sorted by position, genes of a locus are found by binary search
+    gene_df = gene_df.sort_values(by = 'Pos', kind = 'mergesort')
+    contig_genes = {contig : contig_df for contig, contig_df in gene_df.groupby('Contig', sort = False)}
     for i in range(len(locus_df)):
         contig = locus_df['Contig'][i]
         start_pos = locus_df['StartPos'][i]
         end_pos = locus_df['EndPos'][i]
-        sub_df = gene_df.loc[(gene_df['Contig'] == contig) & (gene_df['Pos'] >= start_pos) & (gene_df['Pos'] <= end_pos)]
+        if contig not in contig_genes:
+            continue
+        contig_df = contig_genes[contig]
+        positions = contig_df['Pos'].values
+        sub_df = contig_df.iloc[np.searchsorted(positions, start_pos, 'left') : np.searchsorted(positions, end_pos, 'right')]
         if len(sub_df) == 0:
             continue
-        sub_df = sub_df.sort_values(by = 'Pos').reset_index()
         scale = 300
-        scaled_pos = []
-        color_list = []
-        for j in range(len(sub_df)):
-            scaled_pos.append((sub_df['Pos'][j] - start_pos) / (end_pos - start_pos) * scale)
-            color_list.append(gene_color[sub_df['GeneType'][j]])
-        plt.figure(figsize = (6, 3))
-        plt.bar(scaled_pos, [1] * len(scaled_pos), color = color_list)
-        plt.xlim(0, scale)
-        plt.xticks([], [])
-        plt.yticks([], [])
-        plt.savefig(os.path.join(output_dir, GetRangeBasename(locus_df, i) + '.png'), dpi = 300)
-        plt.clf()
-        plt.close()
+        scaled_pos = ((sub_df['Pos'] - start_pos) / (end_pos - start_pos) * scale).tolist()
+        color_list = [gene_color[gene_type] for gene_type in sub_df['GeneType']]
+        output_fname = os.path.join(output_dir, GetRangeBasename(locus_df, i) + '.png')
+        visual_tools.SubmitPlot(plot_jobs, 'positions', output_fname, {'positions' : scaled_pos, 'colors' : color_list, 'scale' : scale, 'fixed_height' : False})
 
-def main(genome_fasta, input_dir, output_dir):
+def main(genome_fasta, input_dir, output_dir, plot_jobs = None):
+    # pandas is imported by the refinement only, the driver and the annotation service start without it
+    import pandas as pd
     files = ['combined_genes_IGH.txt', 'combined_genes_IGK.txt', 'combined_genes_IGL.txt', 'combined_genes_TRA.txt', 'combined_genes_TRB.txt', 'combined_genes_TRG.txt']
     dfs = [pd.read_csv(os.path.join(input_dir, fname), sep = '\t', dtype = {'Contig' : str}) for fname in files]
     df = pd.concat(dfs)
@@ -153,24 +129,19 @@ def main(genome_fasta, input_dir, output_dir):
     contig_set = set(df['Contig'])
     contig_len_dict = dict()
     contig_seq_dict = dict()
-    if genome_fasta.endswith('.gz'):
-        genome_fasta_handle = gzip.open(genome_fasta, 'rt')
-    else:
-        genome_fasta_handle = open(genome_fasta, 'r')
-    for r in SeqIO.parse(genome_fasta_handle, 'fasta'):
-        contig_id = r.id.replace('|', '_')
-        if contig_id not in contig_set:
+    genome = packed_genome.LoadGenome(genome_fasta)
+    for contig_idx, contig_id in enumerate(genome.contig_ids):
+        if contig_id.replace('|', '_') not in contig_set:
             continue
-        contig_len_dict[contig_id] = len(r.seq)
-        contig_seq_dict[contig_id] = str(r.seq)
-    genome_fasta_handle.close()
+        contig_len_dict[contig_id.replace('|', '_')] = genome.Length(contig_idx)
+        contig_seq_dict[contig_id.replace('|', '_')] = genome.Contig(contig_id)
 
     #### creating summary dataframe
     shift = 10000
     locus_df = ComputeSummaryDF(dfs, contig_len_dict, shift)
     locus_df = locus_df.sort_values(by = ['Contig', 'RelStart'], ascending = True).reset_index()
     locus_df.to_csv(os.path.join(output_dir, 'summary.csv'), index = False, columns = ['LocusID', 'Locus', 'Contig', 'StartPos', 'EndPos', 'Length', 'GeneTypes', 'NumV', 'NumProdV', 'FracProdV', 'RelStart', 'RelEnd'])
-    VisualizeSummary(locus_df, os.path.join(output_dir, 'summary.png'))
+    VisualizeSummary(locus_df, os.path.join(output_dir, 'summary.png'), plot_jobs)
     
     #### output IG loci into fasta
     igloci_fasta_dir = os.path.join(output_dir, 'igloci_fasta')
@@ -182,4 +153,5 @@ def main(genome_fasta, input_dir, output_dir):
     gene_pos_dir = os.path.join(output_dir, 'gene_pos_plots')
     if not os.path.exists(gene_pos_dir):
         os.mkdir(gene_pos_dir)
-    VisualizeGenePositions(df, locus_df, gene_pos_dir)
+    VisualizeGenePositions(df, locus_df, gene_pos_dir, plot_jobs)
+    return LocusIndex(locus_df)
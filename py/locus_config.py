@@ -0,0 +1,51 @@
+V = 'V'
+D = 'D'
+J = 'J'
+DR = 'D_right'
+DL = 'D_left'
+
+LOCI = ['IGH', 'IGK', 'IGL', 'TRA', 'TRB', 'TRG']
+
+class LocusConfig:
+    def __init__(self, locus, spacer_length, gene_types):
+        self.locus = locus
+        self.spacer_length = spacer_length # signal type -> spacer length
+        self.gene_types = gene_types # gene types found by the RSS search
+        self.gene_length = {V : 350, J : 70, D : 150}
+        self.pi_cutoff = {'strict' : {V : 70, J : 70}, 'relax' : {V : 60, J : 65}}
+        self.maxk_cutoff = {V : 15, J : 11}
+
+    def SignalTypes(self):
+        # RSS types scanned for the gene types of the locus, D genes are flanked by two RSSs
+        signal_types = []
+        if V in self.gene_types:
+            signal_types.append(V)
+        if J in self.gene_types:
+            signal_types.append(J)
+        if D in self.gene_types:
+            signal_types.extend([DL, DR])
+        return signal_types
+
+    def AlignedGeneTypes(self):
+        # D genes are reported from RSS pairs only, V and J candidates are aligned to reference genes
+        return [gene for gene in self.gene_types if gene != D]
+
+    def HasDGenes(self):
+        return D in self.gene_types
+
+    def Restrict(self, gene_types):
+        config = LocusConfig(self.locus, self.spacer_length, [gene for gene in self.gene_types if gene in gene_types])
+        config.gene_length = self.gene_length
+        config.pi_cutoff = self.pi_cutoff
+        config.maxk_cutoff = self.maxk_cutoff
+        return config
+
+LOCUS_CONFIGS = {'IGH' : LocusConfig('IGH', {V : 23, DL : 12, DR : 12, J : 23}, [V, D, J]),
+                 'IGK' : LocusConfig('IGK', {V : 12, J : 23}, [V, J]),
+                 'IGL' : LocusConfig('IGL', {V : 23, J : 12}, [V, J]),
+                 'TRA' : LocusConfig('TRA', {V : 23, J : 12}, [V, J]),
+                 'TRB' : LocusConfig('TRB', {V : 23, DL : 12, DR : 23, J : 12}, [V, D, J]),
+                 'TRG' : LocusConfig('TRG', {V : 23, J : 12}, [V, J])}
+
+def GetLocusConfig(locus):
+    return LOCUS_CONFIGS[locus]
@@ -0,0 +1,272 @@
+import os
+import sys
+import gzip
+import json
+import shutil
+import hashlib
+import weakref
+import numpy as np
+
+from Bio import SeqIO
+
+import reference_bundle
+
+# Genome sequences packed into 2 bits per nucleotide (A0 C1 G2 T3, 4 nucleotides per byte, every contig starts
+# at a byte boundary). Symbols other than A, C, G, T are stored as runs of N and as exceptions (position, symbol),
+# soft-masked (lower case) regions are stored as runs. Packed genomes are cached on disk and memory-mapped
+PACKED_VERSION = 1
+DEFAULT_CACHE_DIR = os.environ.get('IGDETECTIVE_GENOME_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'igdetective', 'genomes'))
+
+ASCII_NUCLS = np.frombuffer(b'ACGT', dtype = np.uint8)
+SHIFTS = np.array([6, 4, 2, 0], dtype = np.uint8)
+COMPLEMENT = bytes.maketrans(b'ACGTRYKMBVDHNSWacgtrykmbvdhnsw', b'TGCAYRMKVBHDNSWtgcayrmkvbhdnsw')
+
+def GetRuns(mask):
+    # [start, end) of runs of True values
+    bounds = np.flatnonzero(np.diff(np.concatenate(([0], mask.view(np.int8), [0]))))
+    return bounds.reshape(-1, 2)
+
+def PackSequence(seq):
+    symbols = np.frombuffer(seq.encode(), dtype = np.uint8)
+    codes = reference_bundle.NUCL_CODES[symbols]
+    padded = np.zeros(-(-len(codes) // 4) * 4, dtype = np.uint8)
+    padded[: len(codes)] = codes & 3
+    packed = np.bitwise_or.reduce(padded.reshape(-1, 4) << SHIFTS, axis = 1).astype(np.uint8)
+    upper = symbols & 0xDF
+    is_n = upper == ord('N')
+    exc_pos = np.flatnonzero((codes == 4) & ~is_n)
+    is_lower = (symbols >= ord('a')) & (symbols <= ord('z'))
+    return packed, GetRuns(is_n), GetRuns(is_lower), exc_pos, symbols[exc_pos]
+
+def OpenFasta(fasta):
+    if fasta.endswith('.gz'):
+        return gzip.open(fasta, 'rt')
+    return open(fasta, 'r')
+
+class PackedGenome:
+    def __init__(self, manifest, arrays, location = None):
+        self.manifest = manifest
+        self.packed = arrays['packed']
+        self.n_runs = arrays['n_runs']
+        self.mask_runs = arrays['mask_runs']
+        self.exc_pos = arrays['exc_pos']
+        self.exc_sym = arrays['exc_sym']
+        self.contig_ids = [c['id'] for c in manifest['contigs']]
+        self.contig_index = {contig_id : i for i, contig_id in enumerate(self.contig_ids)}
+        self.location = location
+        # views are pickled as a reference to the genome: worker processes forked after loading find the genome
+        # in LOADED_GENOMES, other processes reopen the cache
+        self.key = location if location is not None else 'memory:' + str(id(self))
+        LOADED_GENOMES[self.key] = self
+
+    def __reduce__(self):
+        return (GetGenome, (self.key, ))
+
+    def __len__(self):
+        return len(self.contig_ids)
+
+    def Length(self, contig_idx):
+        return self.manifest['contigs'][contig_idx]['length']
+
+    def Contig(self, contig_id):
+        contig_idx = self.contig_index[contig_id]
+        return PackedSequence(self, contig_idx, 0, self.Length(contig_idx))
+
+    def Contigs(self, contig_ids = None):
+        # contig ID -> view of the whole contig in the genome order
+        return {contig_id : self.Contig(contig_id) for contig_id in self.contig_ids if contig_ids is None or contig_id in contig_ids}
+
+    def _Runs(self, runs, contig, kind, start, end):
+        first, last = contig[kind]
+        runs = runs[first : last]
+        idx = np.searchsorted(runs[:, 1], start, 'right') if len(runs) != 0 else 0
+        selected = []
+        while idx < len(runs) and runs[idx, 0] < end:
+            selected.append((max(int(runs[idx, 0]), start) - start, min(int(runs[idx, 1]), end) - start))
+            idx += 1
+        return selected
+
+    def Codes(self, contig_idx, start, end):
+        # 2-bit codes of [start, end) of the forward strand, 4 marks N and other symbols
+        contig = self.manifest['contigs'][contig_idx]
+        offset = contig['offset']
+        packed = self.packed[offset + start // 4 : offset + (end + 3) // 4]
+        codes = ((packed[:, None] >> SHIFTS) & 3).ravel()[start % 4 : start % 4 + end - start]
+        for run_start, run_end in self._Runs(self.n_runs, contig, 'n_runs', start, end):
+            codes[run_start : run_end] = 4
+        first, last = contig['exceptions']
+        exc_pos = self.exc_pos[first : last]
+        exc_idx = np.arange(np.searchsorted(exc_pos, start, 'left'), np.searchsorted(exc_pos, end, 'left'))
+        codes[exc_pos[exc_idx] - start] = 4
+        return codes
+
+    def Symbols(self, contig_idx, start, end):
+        # ASCII symbols of [start, end) of the forward strand including soft-masking
+        contig = self.manifest['contigs'][contig_idx]
+        codes = self.Codes(contig_idx, start, end)
+        symbols = ASCII_NUCLS[codes & 3]
+        for run_start, run_end in self._Runs(self.n_runs, contig, 'n_runs', start, end):
+            symbols[run_start : run_end] = ord('N')
+        first, last = contig['exceptions']
+        exc_pos = self.exc_pos[first : last]
+        exc_idx = np.arange(np.searchsorted(exc_pos, start, 'left'), np.searchsorted(exc_pos, end, 'left'))
+        symbols[exc_pos[exc_idx] - start] = self.exc_sym[first : last][exc_idx]
+        for run_start, run_end in self._Runs(self.mask_runs, contig, 'mask_runs', start, end):
+            symbols[run_start : run_end] |= 0x20
+        return symbols
+
+class PackedSequence:
+    # zero-copy view of [start, end) of a contig, reverse views represent the reverse complement of the range
+    def __init__(self, genome, contig_idx, start, end, reverse = False):
+        self.genome = genome
+        self.contig_idx = contig_idx
+        self.start = start
+        self.end = end
+        self.reverse = reverse
+
+    @property
+    def id(self):
+        return self.genome.contig_ids[self.contig_idx]
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice) or item.step not in (None, 1):
+            raise TypeError('packed sequences support only contiguous slices')
+        start, end, _ = item.indices(len(self))
+        end = max(start, end)
+        if self.reverse:
+            return PackedSequence(self.genome, self.contig_idx, self.end - end, self.end - start, True)
+        return PackedSequence(self.genome, self.contig_idx, self.start + start, self.start + end)
+
+    def reverse_complement(self):
+        return PackedSequence(self.genome, self.contig_idx, self.start, self.end, not self.reverse)
+
+    def Codes(self):
+        codes = self.genome.Codes(self.contig_idx, self.start, self.end)
+        if self.reverse:
+            codes = np.where(codes == 4, 4, 3 - codes)[:: -1]
+        return codes
+
+    def __str__(self):
+        symbols = self.genome.Symbols(self.contig_idx, self.start, self.end).tobytes()
+        if self.reverse:
+            symbols = symbols.translate(COMPLEMENT)[:: -1]
+        return symbols.decode()
+
+    def upper(self):
+        return str(self).upper()
+
+def EncodeSequence(seq):
+    # 2-bit codes of a packed sequence or a string
+    if isinstance(seq, PackedSequence):
+        return seq.Codes()
+    return reference_bundle.EncodeNucleotides(seq)
+
+def PackRecords(records):
+    manifest = {'version' : PACKED_VERSION, 'contigs' : []}
+    arrays = {'packed' : [], 'n_runs' : [], 'mask_runs' : [], 'exc_pos' : [], 'exc_sym' : []}
+    counts = {'packed' : 0, 'n_runs' : 0, 'mask_runs' : 0, 'exceptions' : 0}
+    for r in records:
+        packed, n_runs, mask_runs, exc_pos, exc_sym = PackSequence(str(r.seq))
+        manifest['contigs'].append({'id' : r.id, 'length' : len(r.seq), 'offset' : counts['packed'],
+                                    'n_runs' : [counts['n_runs'], counts['n_runs'] + len(n_runs)],
+                                    'mask_runs' : [counts['mask_runs'], counts['mask_runs'] + len(mask_runs)],
+                                    'exceptions' : [counts['exceptions'], counts['exceptions'] + len(exc_pos)]})
+        for name, array in zip(['packed', 'n_runs', 'mask_runs', 'exc_pos', 'exc_sym'], [packed, n_runs, mask_runs, exc_pos, exc_sym]):
+            arrays[name].append(array)
+        counts['packed'] += len(packed)
+        counts['n_runs'] += len(n_runs)
+        counts['mask_runs'] += len(mask_runs)
+        counts['exceptions'] += len(exc_pos)
+    empty = {'packed' : np.zeros(0, dtype = np.uint8), 'n_runs' : np.zeros((0, 2), dtype = np.int64), 'mask_runs' : np.zeros((0, 2), dtype = np.int64),
+             'exc_pos' : np.zeros(0, dtype = np.int64), 'exc_sym' : np.zeros(0, dtype = np.uint8)}
+    for name in arrays:
+        arrays[name] = np.concatenate(arrays[name]).astype(empty[name].dtype) if len(arrays[name]) != 0 else empty[name]
+    return manifest, arrays
+
+def PackFasta(fasta):
+    # packed genome kept in memory
+    fasta_handle = OpenFasta(fasta)
+    manifest, arrays = PackRecords(SeqIO.parse(fasta_handle, 'fasta'))
+    fasta_handle.close()
+    return PackedGenome(manifest, arrays)
+
+def CacheLocation(fasta, cache_dir = DEFAULT_CACHE_DIR):
+    fasta = os.path.abspath(fasta)
+    return os.path.join(cache_dir, hashlib.sha1(fasta.encode()).hexdigest()[:16] + '_' + os.path.basename(fasta))
+
+def IsCacheFresh(location, fasta):
+    manifest_fname = os.path.join(location, 'manifest.json')
+    if not os.path.exists(manifest_fname):
+        return False
+    with open(manifest_fname) as fh:
+        manifest = json.load(fh)
+    if manifest['version'] != PACKED_VERSION:
+        return False
+    source = manifest['source']
+    fingerprint = reference_bundle.SourceFingerprint(fasta)
+    return (fingerprint['size'], fingerprint['mtime_ns']) == (source['size'], source['mtime_ns']) or reference_bundle.FileSha1(fasta) == source['sha1']
+
+def BuildCache(fasta, location):
+    # the cache is written into a temporary directory and moved in place as the reference bundle
+    tmp_dir = location + '.tmp' + str(os.getpid())
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    fasta_handle = OpenFasta(fasta)
+    manifest, arrays = PackRecords(SeqIO.parse(fasta_handle, 'fasta'))
+    fasta_handle.close()
+    manifest['source'] = reference_bundle.SourceFingerprint(fasta)
+    manifest['source']['sha1'] = reference_bundle.FileSha1(fasta)
+    manifest['source']['path'] = os.path.abspath(fasta)
+    for name in arrays:
+        np.save(os.path.join(tmp_dir, name + '.npy'), arrays[name])
+    with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as fh:
+        json.dump(manifest, fh)
+    if os.path.exists(location):
+        shutil.rmtree(location, ignore_errors = True)
+    try:
+        os.rename(tmp_dir, location)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors = True)
+
+def OpenCache(location):
+    with open(os.path.join(location, 'manifest.json')) as fh:
+        manifest = json.load(fh)
+    arrays = {name : np.load(os.path.join(location, name + '.npy'), mmap_mode = 'r') for name in ['packed', 'n_runs', 'mask_runs', 'exc_pos', 'exc_sym']}
+    return PackedGenome(manifest, arrays, location)
+
+# genomes are registered while they (or their views) are referenced, so that genomes packed in memory by
+# a long-lived process (e.g., regions of annotation service jobs) are released after use
+LOADED_GENOMES = weakref.WeakValueDictionary()
+
+def GetGenome(key):
+    genome = LOADED_GENOMES.get(key)
+    if genome is None:
+        genome = OpenCache(key)
+    return genome
+
+def LoadGenome(fasta, cache_dir = DEFAULT_CACHE_DIR):
+    # packed genome memory-mapped from the cache, the cache is built on the first use and rebuilt if the FASTA changes.
+    # The genome is packed in memory if the cache directory is not writable
+    location = CacheLocation(fasta, cache_dir)
+    genome = LOADED_GENOMES.get(location)
+    if genome is not None and IsCacheFresh(location, fasta):
+        return genome
+    try:
+        if not IsCacheFresh(location, fasta):
+            os.makedirs(cache_dir, exist_ok = True)
+            BuildCache(fasta, location)
+        return OpenCache(location)
+    except OSError:
+        return PackFasta(fasta)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('python packed_genome.py genome.fasta [cache_dir]')
+        sys.exit(1)
+    cache_dir = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_CACHE_DIR
+    genome = LoadGenome(sys.argv[1], cache_dir)
+    print(str(len(genome)) + ' contigs were packed into ' + str(genome.location))
@@ -0,0 +1,85 @@
+import os
+import json
+import time
+
+# JSON-lines stream of progress events. The stream (a file or a FIFO) is given by the IGDETECTIVE_EVENTS environment
+# variable, so that scripts started by the driver report into the same stream. Every event is written by a single
+# write to a file opened for appending, lines of concurrent processes are not interleaved
+EVENTS_VARIABLE = 'IGDETECTIVE_EVENTS'
+# progress events of the same stage are reported at most once per interval (seconds)
+PROGRESS_INTERVAL = 1.0
+
+EVENT_STREAM = None
+
+def SetEventStream(fname):
+    # later opened streams (including the ones of child processes) write to fname
+    os.environ[EVENTS_VARIABLE] = os.path.abspath(fname)
+
+def IsEnabled():
+    return os.environ.get(EVENTS_VARIABLE, '') != ''
+
+def Emit(event, stage, **fields):
+    global EVENT_STREAM
+    if not IsEnabled():
+        return
+    fname = os.environ[EVENTS_VARIABLE]
+    if EVENT_STREAM is None or EVENT_STREAM[0] != fname or EVENT_STREAM[1] != os.getpid():
+        # forked workers open their own descriptor
+        EVENT_STREAM = (fname, os.getpid(), os.open(fname, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644))
+    record = {'time' : round(time.time(), 3), 'pid' : os.getpid(), 'event' : event, 'stage' : stage}
+    record.update(fields)
+    os.write(EVENT_STREAM[2], (json.dumps(record) + '\n').encode())
+
+class Stage:
+    # reports the start and the finish (with the elapsed time and the status) of a stage:
+    #     with progress_events.Stage('rss_scan', locus = 'IGH'):
+    def __init__(self, stage, **fields):
+        self.stage = stage
+        self.fields = fields
+        self.start_time = None
+        self.failed = False
+
+    def Fail(self, **fields):
+        # marks the stage as failed without an exception, fields (e.g., an exit code) are added to the finish event
+        self.failed = True
+        self.fields.update(fields)
+
+    def __enter__(self):
+        self.start_time = time.time()
+        Emit('stage_start', self.stage, **self.fields)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        status = 'ok' if exc_type is None and not self.failed else 'failed'
+        Emit('stage_finish', self.stage, status = status, elapsed = round(time.time() - self.start_time, 3), **self.fields)
+        return False
+
+class Progress:
+    # items processed vs. total with the rate and the ETA estimated from the elapsed time
+    def __init__(self, stage, total, **fields):
+        self.stage = stage
+        self.total = total
+        self.fields = fields
+        self.done = 0
+        self.start_time = time.time()
+        self.last_report = 0
+
+    def Update(self, num_done = 1):
+        self.done += num_done
+        now = time.time()
+        if now - self.last_report < PROGRESS_INTERVAL and self.done < self.total:
+            return
+        self.last_report = now
+        elapsed = now - self.start_time
+        rate = self.done / elapsed if elapsed > 0 else 0
+        eta = (self.total - self.done) / rate if rate > 0 else None
+        Emit('progress', self.stage, done = self.done, total = self.total, rate = round(rate, 3), eta = round(eta, 1) if eta is not None else None, **self.fields)
+
+    def Track(self, results):
+        # passes results of an iterator through while counting them
+        for result in results:
+            self.Update()
+            yield result
+
+def Count(stage, name, value, **fields):
+    Emit('count', stage, name = name, value = value, **fields)
@@ -0,0 +1,264 @@
+import os
+import sys
+import json
+import fcntl
+import shutil
+import pickle
+import hashlib
+import subprocess
+import numpy as np
+
+from Bio import SeqIO
+
+import alignment_engine
+
+# Reference genes and RSS motifs compiled into a directory of .npy arrays and a JSON manifest.
+# Arrays are memory-mapped on loading, the bundle is rebuilt when the version or any source file changes
+BUNDLE_VERSION = 3
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SOURCE_DIR = os.path.join(SCRIPT_DIR[:-3], 'datafiles', 'combined_reference_genes')
+DEFAULT_MOTIF_FILE = os.path.join(SCRIPT_DIR[:-3], 'datafiles', 'motifs')
+DEFAULT_BUNDLE_DIR = os.path.join(SCRIPT_DIR[:-3], 'datafiles', 'reference_bundle')
+KMER_SIZE = 11
+# genes of these types are clustered for the hierarchical search of the aligners
+CLUSTERED_GENE_TYPES = ['V']
+
+# 2-bit nucleotide codes, 4 marks any other symbol
+NUCL_CODES = np.full(256, 4, dtype = np.uint8)
+for i, n in enumerate('ACGT'):
+    NUCL_CODES[ord(n)] = i
+    NUCL_CODES[ord(n.lower())] = i
+
+def EncodeNucleotides(seq):
+    return NUCL_CODES[np.frombuffer(str(seq).encode(), dtype = np.uint8)]
+
+def KmerCodes(codes, k):
+    # codes of all k-mers starting at positions 0..len - k and whether they consist of A, C, G, T only
+    num_kmers = len(codes) - k + 1
+    if num_kmers <= 0:
+        return np.zeros(0, dtype = np.int64), np.zeros(0, dtype = bool)
+    kmers = np.zeros(num_kmers, dtype = np.int64)
+    invalid = np.zeros(num_kmers, dtype = bool)
+    for j in range(k):
+        window = codes[j : j + num_kmers]
+        kmers = (kmers << 2) | (window & 3)
+        invalid |= window == 4
+    return kmers, ~invalid
+
+def EncodeKmer(kmer):
+    code = 0
+    for n in kmer:
+        code = (code << 2) | int(NUCL_CODES[ord(n)])
+    return code
+
+def FileSha1(fname):
+    sha1 = hashlib.sha1()
+    with open(fname, 'rb') as fh:
+        for block in iter(lambda : fh.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def SourceFiles(source_dir, motif_file):
+    sources = {os.path.abspath(os.path.join(source_dir, f)) for f in os.listdir(source_dir) if f.endswith('.fa') or f.endswith('.fasta')}
+    sources.add(os.path.abspath(motif_file))
+    return sorted(sources)
+
+def SourceFingerprint(fname):
+    stat = os.stat(fname)
+    return {'size' : stat.st_size, 'mtime_ns' : stat.st_mtime_ns}
+
+def IsBundleFresh(bundle_dir, source_dir, motif_file):
+    manifest_fname = os.path.join(bundle_dir, 'manifest.json')
+    if not os.path.exists(manifest_fname):
+        return False
+    with open(manifest_fname) as fh:
+        manifest = json.load(fh)
+    if manifest['version'] != BUNDLE_VERSION:
+        return False
+    sources = SourceFiles(source_dir, motif_file)
+    if sorted(manifest['sources']) != sources:
+        return False
+    for fname in sources:
+        source = manifest['sources'][fname]
+        fingerprint = SourceFingerprint(fname)
+        # touched files with the same content do not require rebuilding
+        if (fingerprint['size'], fingerprint['mtime_ns']) != (source['size'], source['mtime_ns']) and FileSha1(fname) != source['sha1']:
+            return False
+    return True
+
+def LockBundle(bundle_dir):
+    # exclusive lock of processes checking and building the bundle, released when the returned file is closed
+    lock_fh = open(os.path.normpath(bundle_dir) + '.lock', 'w')
+    fcntl.flock(lock_fh, fcntl.LOCK_EX)
+    return lock_fh
+
+def BuildBundle(bundle_dir = DEFAULT_BUNDLE_DIR, source_dir = DEFAULT_SOURCE_DIR, motif_file = DEFAULT_MOTIF_FILE, cluster_identity = alignment_engine.CLUSTER_IDENTITY):
+    # the bundle is built in a temporary directory and moved in place, so that readers never see a partial bundle
+    tmp_dir = bundle_dir + '.tmp' + str(os.getpid())
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    manifest = {'version' : BUNDLE_VERSION, 'kmer_size' : KMER_SIZE, 'cluster_identity' : cluster_identity, 'sources' : dict(), 'gene_types' : dict(), 'motifs' : dict()}
+    sources = SourceFiles(source_dir, motif_file)
+    for fname in sources:
+        manifest['sources'][fname] = SourceFingerprint(fname)
+        manifest['sources'][fname]['sha1'] = FileSha1(fname)
+
+    seq_codes = []
+    offsets = [0]
+    has_minimap = shutil.which('minimap2') is not None
+    for fname in sources:
+        if fname == os.path.abspath(motif_file):
+            continue
+        gene_type = os.path.basename(fname).split('.')[0]
+        first = len(offsets) - 1
+        ids = []
+        seqs = []
+        kmer_codes = []
+        kmer_genes = []
+        for r in SeqIO.parse(fname, 'fasta'):
+            seq = str(r.seq).upper()
+            ids.append(r.id)
+            seqs.append(seq)
+            seq_codes.append(np.frombuffer(seq.encode(), dtype = np.uint8))
+            offsets.append(offsets[-1] + len(seq))
+            kmers, is_valid = KmerCodes(EncodeNucleotides(seq), KMER_SIZE)
+            kmers = np.unique(kmers[is_valid])
+            kmer_codes.append(kmers)
+            kmer_genes.append(np.full(len(kmers), len(ids) - 1, dtype = np.int32))
+        # k-mer index: (k-mer, gene) pairs sorted by k-mer
+        kmer_codes = np.concatenate(kmer_codes) if len(kmer_codes) != 0 else np.zeros(0, dtype = np.int64)
+        kmer_genes = np.concatenate(kmer_genes) if len(kmer_genes) != 0 else np.zeros(0, dtype = np.int32)
+        order = np.argsort(kmer_codes, kind = 'stable')
+        np.save(os.path.join(tmp_dir, 'kmers_' + gene_type + '.npy'), kmer_codes[order])
+        np.save(os.path.join(tmp_dir, 'kmer_genes_' + gene_type + '.npy'), kmer_genes[order])
+        minimap_index = ''
+        if has_minimap:
+            minimap_index = gene_type + '.mmi'
+            if subprocess.call(['minimap2', '-d', os.path.join(tmp_dir, minimap_index), fname], stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL) != 0:
+                minimap_index = ''
+        # centroid index of every gene
+        clusters = ''
+        if gene_type[-1] in CLUSTERED_GENE_TYPES:
+            clusters = 'clusters_' + gene_type + '.npy'
+            np.save(os.path.join(tmp_dir, clusters), alignment_engine.ClusterReferences(seqs, cluster_identity))
+        manifest['gene_types'][gene_type] = {'source' : fname, 'first' : first, 'last' : len(offsets) - 1, 'ids' : ids, 'minimap_index' : minimap_index, 'clusters' : clusters}
+    seq_codes = np.concatenate(seq_codes) if len(seq_codes) != 0 else np.zeros(0, dtype = np.uint8)
+    np.save(os.path.join(tmp_dir, 'seqs.npy'), seq_codes)
+    np.save(os.path.join(tmp_dir, 'offsets.npy'), np.array(offsets, dtype = np.int64))
+
+    # motif lookup tables indexed by 2-bit k-mer codes
+    with open(motif_file, 'rb') as f:
+        motifs = pickle.load(f)
+    for signal_type in motifs:
+        manifest['motifs'][signal_type] = dict()
+        for k in motifs[signal_type]:
+            table = np.zeros(4 ** int(k), dtype = bool)
+            table[[EncodeKmer(m) for m in motifs[signal_type][k]]] = True
+            table_fname = 'motifs_' + signal_type + '_' + k + '.npy'
+            np.save(os.path.join(tmp_dir, table_fname), table)
+            manifest['motifs'][signal_type][k] = table_fname
+
+    with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as fh:
+        json.dump(manifest, fh)
+    if os.path.exists(bundle_dir):
+        shutil.rmtree(bundle_dir, ignore_errors = True)
+    try:
+        os.rename(tmp_dir, bundle_dir)
+    except OSError:
+        # another process has just installed a bundle built from the same sources
+        shutil.rmtree(tmp_dir, ignore_errors = True)
+
+class ReferenceBundle:
+    def __init__(self, bundle_dir):
+        self.bundle_dir = bundle_dir
+        with open(os.path.join(bundle_dir, 'manifest.json')) as fh:
+            self.manifest = json.load(fh)
+        self.seqs = np.load(os.path.join(bundle_dir, 'seqs.npy'), mmap_mode = 'r')
+        self.offsets = np.load(os.path.join(bundle_dir, 'offsets.npy'), mmap_mode = 'r')
+        self.source_gene_types = {os.path.abspath(info['source']) : gene_type for gene_type, info in self.manifest['gene_types'].items()}
+
+    def GeneTypes(self):
+        return list(self.manifest['gene_types'])
+
+    def HasGeneType(self, gene_type):
+        return gene_type in self.manifest['gene_types']
+
+    def GeneTypeBySource(self, fasta):
+        # gene type compiled from the FASTA file or None
+        return self.source_gene_types.get(os.path.abspath(fasta))
+
+    def GeneIds(self, gene_type):
+        return self.manifest['gene_types'][gene_type]['ids']
+
+    def Lengths(self, gene_type):
+        info = self.manifest['gene_types'][gene_type]
+        return np.diff(self.offsets[info['first'] : info['last'] + 1])
+
+    def Codes(self, gene_type, idx):
+        # ASCII codes of the upper-case gene sequence, a view of the memory-mapped array
+        i = self.manifest['gene_types'][gene_type]['first'] + idx
+        return self.seqs[self.offsets[i] : self.offsets[i + 1]]
+
+    def GeneSeqs(self, gene_type):
+        return [self.Codes(gene_type, i).tobytes().decode() for i in range(len(self.GeneIds(gene_type)))]
+
+    def KmerIndex(self, gene_type):
+        kmers = np.load(os.path.join(self.bundle_dir, 'kmers_' + gene_type + '.npy'), mmap_mode = 'r')
+        genes = np.load(os.path.join(self.bundle_dir, 'kmer_genes_' + gene_type + '.npy'), mmap_mode = 'r')
+        return kmers, genes
+
+    def SharedKmers(self, gene_type, seq):
+        # the number of distinct k-mers of the sequence shared with every gene
+        kmers, genes = self.KmerIndex(gene_type)
+        seq_kmers, is_valid = KmerCodes(EncodeNucleotides(seq), self.manifest['kmer_size'])
+        seq_kmers = np.unique(seq_kmers[is_valid])
+        starts = np.searchsorted(kmers, seq_kmers, 'left')
+        ends = np.searchsorted(kmers, seq_kmers, 'right')
+        lens = ends - starts
+        idx = np.repeat(starts, lens) + np.arange(lens.sum()) - np.repeat(np.cumsum(lens) - lens, lens)
+        return np.bincount(genes[idx], minlength = len(self.GeneIds(gene_type)))
+
+    def Clusters(self, gene_type):
+        # centroid indices of genes (see alignment_engine.ClusterReferences) or None if the genes are not clustered
+        clusters = self.manifest['gene_types'][gene_type]['clusters']
+        if clusters == '':
+            return None
+        return np.load(os.path.join(self.bundle_dir, clusters), mmap_mode = 'r')
+
+    def ClusterIdentity(self):
+        return self.manifest['cluster_identity']
+
+    def MotifTable(self, signal_type, k):
+        return np.load(os.path.join(self.bundle_dir, self.manifest['motifs'][signal_type][str(k)]), mmap_mode = 'r')
+
+    def MinimapIndex(self, gene_type):
+        # path of the minimap2 index of the gene type or None if minimap2 was not available at build time
+        index_fname = self.manifest['gene_types'][gene_type]['minimap_index']
+        if index_fname == '':
+            return None
+        return os.path.join(self.bundle_dir, index_fname)
+
+LOADED_BUNDLES = dict()
+
+def LoadBundle(bundle_dir = DEFAULT_BUNDLE_DIR, source_dir = DEFAULT_SOURCE_DIR, motif_file = DEFAULT_MOTIF_FILE):
+    if bundle_dir not in LOADED_BUNDLES:
+        if not IsBundleFresh(bundle_dir, source_dir, motif_file):
+            # concurrent processes wait for the one building the bundle and use its result
+            with LockBundle(bundle_dir):
+                if not IsBundleFresh(bundle_dir, source_dir, motif_file):
+                    BuildBundle(bundle_dir, source_dir, motif_file)
+        LOADED_BUNDLES[bundle_dir] = ReferenceBundle(bundle_dir)
+    return LOADED_BUNDLES[bundle_dir]
+
+if __name__ == '__main__':
+    # the clustering identity is a PI (percent), bundles built with another identity are kept until the sources change
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--identity=')]
+    identities = [float(arg.split('=')[1]) for arg in sys.argv[1:] if arg.startswith('--identity=')]
+    cluster_identity = identities[-1] if len(identities) != 0 else alignment_engine.CLUSTER_IDENTITY
+    source_dir = args[0] if len(args) > 0 else DEFAULT_SOURCE_DIR
+    bundle_dir = args[1] if len(args) > 1 else DEFAULT_BUNDLE_DIR
+    print('Compiling reference genes from ' + source_dir + ' into ' + bundle_dir + '...')
+    with LockBundle(bundle_dir):
+        BuildBundle(bundle_dir, source_dir, cluster_identity = cluster_identity)
+    print('Done')
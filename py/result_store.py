@@ -0,0 +1,154 @@
+import os
+import json
+import time
+import sqlite3
+
+import gene_records
+
+# SQLite store of IgDetective results. Runs of many genomes can append to the same database:
+# every gene, locus and RSS of a predicted gene refers to the run (genome) it was found in.
+# WAL mode is not used since the store is shared through (network) file systems, see shard_queue
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    label TEXT NOT NULL,
+    genome_fasta TEXT NOT NULL,
+    output_dir TEXT NOT NULL,
+    params TEXT,
+    started REAL,
+    finished REAL
+);
+CREATE TABLE IF NOT EXISTS genes (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    locus TEXT NOT NULL,
+    gene_type TEXT NOT NULL,
+    contig TEXT NOT NULL,
+    pos INTEGER NOT NULL,
+    strand TEXT,
+    sequence TEXT,
+    productive INTEGER,
+    locus_id INTEGER
+);
+CREATE TABLE IF NOT EXISTS loci (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    locus_id INTEGER NOT NULL,
+    locus TEXT NOT NULL,
+    contig TEXT NOT NULL,
+    start_pos INTEGER NOT NULL,
+    end_pos INTEGER NOT NULL,
+    length INTEGER,
+    gene_types TEXT,
+    num_v INTEGER,
+    num_prod_v INTEGER,
+    frac_prod_v REAL,
+    PRIMARY KEY (run_id, locus_id)
+);
+CREATE TABLE IF NOT EXISTS gene_rss (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    locus TEXT NOT NULL,
+    signal_type TEXT NOT NULL,
+    contig TEXT NOT NULL,
+    strand TEXT,
+    heptamer_pos INTEGER,
+    nonamer_pos INTEGER,
+    heptamer TEXT,
+    nonamer TEXT
+);
+CREATE INDEX IF NOT EXISTS genes_by_type ON genes(locus, gene_type, productive);
+CREATE INDEX IF NOT EXISTS genes_by_locus ON genes(run_id, locus_id);
+CREATE INDEX IF NOT EXISTS genes_by_position ON genes(run_id, contig, pos);
+CREATE INDEX IF NOT EXISTS loci_by_contig ON loci(run_id, contig, start_pos);
+CREATE INDEX IF NOT EXISTS gene_rss_by_position ON gene_rss(run_id, contig, heptamer_pos);
+CREATE INDEX IF NOT EXISTS runs_by_label ON runs(label);
+'''
+
+def OpenStore(db_fname):
+    # writes of batch runs appending to one database are serialized by the rollback journal and a long busy timeout
+    conn = sqlite3.connect(db_fname, timeout = 600, isolation_level = None)
+    conn.execute('PRAGMA journal_mode = DELETE')
+    conn.executescript(SCHEMA)
+    return conn
+
+def Write(conn, queries):
+    # queries (SQL, list of parameter tuples) are run in one transaction holding the write lock from the start
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        for query, rows in queries:
+            conn.executemany(query, rows)
+        conn.execute('COMMIT')
+    except:
+        conn.execute('ROLLBACK')
+        raise
+
+def ProductiveValue(value):
+    if value is True or value == 'True':
+        return 1
+    if value is False or value == 'False':
+        return 0
+    return None
+
+def StartRun(conn, label, genome_fasta, output_dir, params):
+    Write(conn, [('INSERT INTO runs (label, genome_fasta, output_dir, params, started) VALUES (?, ?, ?, ?, ?)',
+                  [(label, os.path.abspath(genome_fasta), os.path.abspath(output_dir), json.dumps(params), time.time())])])
+    return conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+
+def FinishRun(conn, run_id):
+    Write(conn, [('UPDATE runs SET finished = ? WHERE run_id = ?', [(time.time(), run_id)])])
+
+def CollectGenes(run_id, output_dir, loci, locus_index):
+    rows = []
+    for locus in loci:
+        fname = os.path.join(output_dir, 'combined_genes_' + locus + '.txt')
+        if not os.path.exists(fname):
+            continue
+        for gene in gene_records.ReadGeneTable(fname).Rows():
+            locus_id = None
+            if locus_index is not None:
+                # genes are linked to the first locus of the same type containing them
+                labels = [l for l in locus_index.Query(gene['Contig'], gene['Pos']) if locus_index.locus_df['Locus'][l] == locus]
+                if len(labels) != 0:
+                    locus_id = int(locus_index.locus_df['LocusID'][labels[0]])
+            rows.append((run_id, locus, gene['GeneType'], gene['Contig'], gene['Pos'], gene['Strand'], gene['Sequence'], ProductiveValue(gene['Productive']), locus_id))
+    return rows
+
+def CollectLoci(run_id, locus_index):
+    if locus_index is None:
+        return []
+    df = locus_index.locus_df
+    return [(run_id, int(df['LocusID'][i]), df['Locus'][i], df['Contig'][i], int(df['StartPos'][i]), int(df['EndPos'][i]), int(df['Length'][i]),
+             df['GeneTypes'][i], int(df['NumV'][i]), int(df['NumProdV'][i]), float(df['FracProdV'][i])) for i in df.index]
+
+def CollectGeneRss(run_id, denovo_dir, loci):
+    # RSSs of genes predicted by the RSS-based search (D genes have two), other candidate RSSs are not stored
+    import pandas as pd
+    rows = []
+    for locus in loci:
+        locus_dir = os.path.join(denovo_dir, 'predicted_genes_' + locus)
+        for gene_type in ['V', 'J', 'D']:
+            fname = os.path.join(locus_dir, 'genes_' + gene_type + '.tsv')
+            if not os.path.exists(fname):
+                continue
+            df = pd.read_csv(fname, sep = '\t', dtype = {'reference contig' : str})
+            if gene_type == 'D':
+                rss_columns = [('D_left', 'left heptamer index', 'left nonamer index', 'left heptamer', 'left nonamer'),
+                               ('D_right', 'right heptamer index', 'right nonamer index', 'right heptamer', 'right nonamer')]
+            else:
+                rss_columns = [(gene_type, 'heptamer index', 'nonamer index', 'heptamer', 'nonamer')]
+            for i in range(len(df)):
+                contig, start_pos = gene_records.ParseWindowId(df['reference contig'][i])
+                contig = contig.replace('|', '_')
+                for signal_type, hepta_idx, nona_idx, hepta, nona in rss_columns:
+                    rows.append((run_id, locus, signal_type, contig, df['strand'][i], start_pos + int(df[hepta_idx][i]), start_pos + int(df[nona_idx][i]), df[hepta][i], df[nona][i]))
+    return rows
+
+def StoreRunResults(db_fname, label, genome_fasta, output_dir, loci, locus_index, params):
+    # genes come from combined_genes_<LOCUS>.txt, loci from the locus index of the refinement step and
+    # RSSs from the RSS-based predictions, genes are linked to the loci containing them
+    conn = OpenStore(db_fname)
+    run_id = StartRun(conn, label, genome_fasta, output_dir, params)
+    Write(conn, [('INSERT INTO genes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', CollectGenes(run_id, output_dir, loci, locus_index)),
+                 ('INSERT INTO loci VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', CollectLoci(run_id, locus_index)),
+                 ('INSERT INTO gene_rss VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', CollectGeneRss(run_id, os.path.join(output_dir, 'denovo_search'), loci))])
+    FinishRun(conn, run_id)
+    conn.close()
+    return run_id
@@ -0,0 +1,166 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+
+import progress_events
+
+# Work queue of genome shards kept in an SQLite database on a shared file system. Workers on any host claim
+# pending shards in a write transaction, so a shard is never processed twice at the same time.
+# WAL mode is not used since it requires shared memory, which does not work across hosts
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS shards (
+    shard_id INTEGER PRIMARY KEY,
+    fasta TEXT NOT NULL,
+    output_dir TEXT NOT NULL,
+    length INTEGER,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    heartbeat REAL,
+    finished REAL,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS settings (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+# a claimed shard is returned to the queue if its worker has not reported for this time (seconds)
+STALE_TIMEOUT = 600
+HEARTBEAT_INTERVAL = 60
+MAX_ATTEMPTS = 2
+
+def WorkerName():
+    return socket.gethostname() + ':' + str(os.getpid())
+
+class ShardQueue:
+    def __init__(self, db_fname):
+        self.db_fname = db_fname
+        self.conn = sqlite3.connect(db_fname, timeout = 600, isolation_level = None)
+        self.conn.executescript(SCHEMA)
+
+    def Close(self):
+        self.conn.close()
+
+    def _Write(self, queries):
+        # queries are run in one transaction holding the write lock from the start. A query is either
+        # (SQL, parameters) or a function of the results of the previous queries returning such a pair
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            results = []
+            for query in queries:
+                if callable(query):
+                    query = query(results)
+                results.append(self.conn.execute(query[0], query[1]).fetchall())
+            self.conn.execute('COMMIT')
+        except:
+            self.conn.execute('ROLLBACK')
+            raise
+        return results
+
+    def AddShards(self, shards, settings):
+        # shards: (FASTA, output directory, total length) in the order they are claimed
+        queries = [('INSERT INTO shards (shard_id, fasta, output_dir, length) VALUES (?, ?, ?, ?)', (i, fasta, output_dir, length)) for i, (fasta, output_dir, length) in enumerate(shards)]
+        queries += [('INSERT OR REPLACE INTO settings VALUES (?, ?)', (name, json.dumps(settings[name]))) for name in settings]
+        self._Write(queries)
+
+    def Settings(self):
+        return {name : json.loads(value) for name, value in self.conn.execute('SELECT name, value FROM settings')}
+
+    def Claim(self, worker):
+        # returns (shard ID, FASTA, output directory) of the claimed shard or None if nothing is left to claim
+        now = time.time()
+        def ClaimFirst(results):
+            shard_id = results[1][0][0] if len(results[1]) != 0 else -1
+            return 'UPDATE shards SET status = \'running\', worker = ?, attempts = attempts + 1, heartbeat = ? WHERE shard_id = ?', (worker, now, shard_id)
+        results = self._Write([self._ResetStaleQuery(now),
+                               ('SELECT shard_id, fasta, output_dir FROM shards WHERE status = \'pending\' AND attempts < ? ORDER BY shard_id LIMIT 1', (MAX_ATTEMPTS, )),
+                               ClaimFirst])
+        if len(results[1]) == 0:
+            return None
+        return tuple(results[1][0])
+
+    def _ResetStaleQuery(self, now):
+        # shards of workers without recent heartbeats (e.g., dead workers) are returned to the queue
+        return 'UPDATE shards SET status = \'pending\' WHERE status = \'running\' AND heartbeat < ?', (now - STALE_TIMEOUT, )
+
+    def ResetStale(self):
+        self._Write([self._ResetStaleQuery(time.time())])
+
+    def Heartbeat(self, shard_id, worker):
+        self._Write([('UPDATE shards SET heartbeat = ? WHERE shard_id = ? AND worker = ? AND status = \'running\'', (time.time(), shard_id, worker))])
+
+    def Finish(self, shard_id, worker, error = None):
+        status = 'done' if error is None else 'pending'
+        self._Write([('UPDATE shards SET status = ?, finished = ?, error = ? WHERE shard_id = ? AND worker = ?', (status, time.time(), error, shard_id, worker))])
+
+    def Counts(self):
+        # status -> the number of shards, pending shards that used up their attempts are reported as failed
+        counts = {'pending' : 0, 'running' : 0, 'done' : 0, 'failed' : 0}
+        for status, attempts, num_shards in self.conn.execute('SELECT status, attempts >= ?, COUNT(*) FROM shards GROUP BY status, attempts >= ?', (MAX_ATTEMPTS, MAX_ATTEMPTS)):
+            if status == 'pending' and attempts:
+                status = 'failed'
+            counts[status] += num_shards
+        return counts
+
+    def Errors(self):
+        return self.conn.execute('SELECT shard_id, worker, error FROM shards WHERE status = \'pending\' AND error IS NOT NULL').fetchall()
+
+    def Shards(self):
+        return self.conn.execute('SELECT shard_id, fasta, output_dir FROM shards ORDER BY shard_id').fetchall()
+
+def RunWorker(db_fname, process_shard):
+    # claims shards until the queue is empty, process_shard(fasta, output_dir, settings) processes one shard
+    queue = ShardQueue(db_fname)
+    settings = queue.Settings()
+    worker = WorkerName()
+    num_processed = 0
+    while True:
+        shard = queue.Claim(worker)
+        if shard is None:
+            break
+        shard_id, fasta, output_dir = shard
+        print('Worker ' + worker + ' processes shard ' + str(shard_id))
+        # heartbeats are sent by a separate thread and a separate connection while the shard is processed
+        stop_event = threading.Event()
+        def SendHeartbeats():
+            heartbeat_queue = ShardQueue(db_fname)
+            while not stop_event.wait(HEARTBEAT_INTERVAL):
+                heartbeat_queue.Heartbeat(shard_id, worker)
+            heartbeat_queue.Close()
+        heartbeat_thread = threading.Thread(target = SendHeartbeats, daemon = True)
+        heartbeat_thread.start()
+        error = None
+        try:
+            with progress_events.Stage('shard', shard_id = shard_id, worker = worker):
+                process_shard(fasta, output_dir, settings)
+        except Exception as e:
+            error = repr(e)
+            print('ERROR: shard ' + str(shard_id) + ' failed: ' + error)
+        stop_event.set()
+        heartbeat_thread.join()
+        queue.Finish(shard_id, worker, error)
+        num_processed += 1
+    queue.Close()
+    return num_processed
+
+def WaitForShards(db_fname, process_shard = None, poll_interval = 10):
+    # waits until every shard is either done or failed and returns status counts. If process_shard is given,
+    # the waiting process works as one more worker and also picks up shards returned to the queue by stale workers
+    queue = ShardQueue(db_fname)
+    while True:
+        if process_shard is not None:
+            RunWorker(db_fname, process_shard)
+        # without local workers nobody else may reset stale shards, stale shards that used up their attempts
+        # are counted as failed
+        queue.ResetStale()
+        counts = queue.Counts()
+        progress_events.Emit('progress', 'shards', done = counts['done'], failed = counts['failed'], running = counts['running'], total = sum(counts.values()))
+        if counts['pending'] == 0 and counts['running'] == 0:
+            break
+        time.sleep(poll_interval)
+    queue.Close()
+    return counts
@@ -0,0 +1,145 @@
+import sys
+import time
+import subprocess
+from multiprocessing import get_context
+
+import progress_events
+
+# Stages of a run form a DAG: a stage starts when all stages it depends on have finished successfully and the CPUs
+# it declares fit into the CPU budget. Stages are either commands (run as subprocesses) or Python functions
+# (run in forked processes). Ready stages are started in the order they were added, so with the budget of
+# a single CPU stages are run one by one in this order
+class StageError(Exception):
+    pass
+
+def RunCommand(command, log_fname = None, quiet = False):
+    # runs a command in the foreground, stdout is written into log_fname and both stdout and stderr are discarded
+    # if quiet is set. Raises StageError if the command fails
+    stdout = subprocess.DEVNULL if quiet else None
+    log_fh = None
+    if log_fname is not None:
+        log_fh = open(log_fname, 'w')
+        stdout = log_fh
+    try:
+        return_code = subprocess.call(command, stdout = stdout, stderr = subprocess.DEVNULL if quiet else None)
+    except OSError as e:
+        raise StageError(command[0] + ' could not be started: ' + str(e))
+    finally:
+        if log_fh is not None:
+            log_fh.close()
+    if return_code != 0:
+        raise StageError(' '.join(command) + ' failed with exit code ' + str(return_code))
+
+class Stage:
+    def __init__(self, name, action, deps, cpus, log_fname, quiet, fields):
+        self.name = name
+        self.action = action # command (list of arguments) or function without arguments
+        self.deps = deps
+        self.cpus = cpus
+        self.log_fname = log_fname
+        self.quiet = quiet
+        self.fields = fields # reported with events of the stage
+        self.handle = None
+        self.log_fh = None
+        self.start_time = None
+
+    def Start(self):
+        self.start_time = time.time()
+        progress_events.Emit('stage_start', self.name, cpus = self.cpus, **self.fields)
+        if callable(self.action):
+            # buffered output would be printed by both processes otherwise
+            sys.stdout.flush()
+            sys.stderr.flush()
+            self.handle = get_context('fork').Process(target = self.action)
+            self.handle.start()
+            return
+        stdout = subprocess.DEVNULL if self.quiet else None
+        if self.log_fname is not None:
+            self.log_fh = open(self.log_fname, 'w')
+            stdout = self.log_fh
+        try:
+            self.handle = subprocess.Popen(self.action, stdout = stdout, stderr = subprocess.DEVNULL if self.quiet else None)
+        except OSError as e:
+            print('ERROR: ' + self.action[0] + ' could not be started: ' + str(e))
+            self.handle = None
+
+    def Poll(self):
+        # exit code or None if the stage is running
+        if self.handle is None:
+            return 127
+        if callable(self.action):
+            if self.handle.is_alive():
+                return None
+            self.handle.join()
+            return self.handle.exitcode
+        return self.handle.poll()
+
+    def Finish(self, exit_code):
+        if self.log_fh is not None:
+            self.log_fh.close()
+        status = 'ok' if exit_code == 0 else 'failed'
+        progress_events.Emit('stage_finish', self.name, status = status, exit_code = exit_code, elapsed = round(time.time() - self.start_time, 3), **self.fields)
+
+class StageScheduler:
+    def __init__(self, cpu_budget = 1, progress_stage = None, poll_interval = 0.1):
+        self.cpu_budget = max(1, cpu_budget)
+        self.progress_stage = progress_stage # if set, finished stages are reported as progress events
+        self.poll_interval = poll_interval
+        self.stages = []
+        self.stage_names = set()
+
+    def Add(self, name, action, deps = [], cpus = 1, log_fname = None, quiet = False, **fields):
+        # dependencies have to be added before the stage, so the graph has no cycles
+        if name in self.stage_names:
+            raise StageError('stage ' + name + ' was added twice')
+        for dep in deps:
+            if dep not in self.stage_names:
+                raise StageError('stage ' + name + ' depends on unknown stage ' + dep)
+        self.stages.append(Stage(name, action, list(deps), min(max(1, cpus), self.cpu_budget), log_fname, quiet, fields))
+        self.stage_names.add(name)
+
+    def Run(self):
+        # runs all stages and raises StageError if some of them failed, stages depending on failed stages are skipped
+        exit_codes = dict()
+        pending = list(self.stages)
+        running = []
+        used_cpus = 0
+        progress = None
+        if self.progress_stage is not None:
+            progress = progress_events.Progress(self.progress_stage, len(self.stages))
+        while len(pending) != 0 or len(running) != 0:
+            changed = False
+            for stage in list(running):
+                exit_code = stage.Poll()
+                if exit_code is None:
+                    continue
+                stage.Finish(exit_code)
+                exit_codes[stage.name] = exit_code
+                if exit_code != 0:
+                    print('ERROR: stage ' + stage.name + ' failed with exit code ' + str(exit_code))
+                running.remove(stage)
+                used_cpus -= stage.cpus
+                changed = True
+                if progress is not None:
+                    progress.Update()
+            for stage in list(pending):
+                if any(dep in exit_codes and exit_codes[dep] != 0 for dep in stage.deps):
+                    print('WARN: stage ' + stage.name + ' is skipped since its dependencies failed')
+                    exit_codes[stage.name] = -1
+                    pending.remove(stage)
+                    changed = True
+                    continue
+                if any(exit_codes.get(dep) != 0 for dep in stage.deps):
+                    continue
+                if used_cpus + stage.cpus > self.cpu_budget:
+                    continue
+                stage.Start()
+                running.append(stage)
+                used_cpus += stage.cpus
+                pending.remove(stage)
+                changed = True
+            if not changed:
+                time.sleep(self.poll_interval)
+        failed = [name for name in exit_codes if exit_codes[name] != 0]
+        if len(failed) != 0:
+            raise StageError('failed stages: ' + ', '.join(failed))
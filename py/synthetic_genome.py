@@ -0,0 +1,339 @@
+import os
+import sys
+import getopt
+import numpy as np
+
+import reference_bundle
+import locus_config
+from locus_config import V, D, J, DR, DL
+
+# Synthetic assemblies for scaling and stress tests: random contigs with soft-masked repeat families and decoy RSSs,
+# and planted adaptive immune loci. Loci are built from mutated reference genes of the bundle (D genes are random)
+# with RSSs made of heptamers and nonamers of the motif tables and random spacers of the lengths used by the RSS
+# search. Every planted gene, locus and decoy RSS is written into a truth table:
+#     Feature  Locus  GeneType  Contig  Start  End  Strand  Source  Mutations
+# with 0-based half-open coordinates. Contigs are generated one by one, the memory is about three times the length
+# of the longest contig
+UPPER_SYMBOLS = np.frombuffer(b'ACGTN', dtype = np.uint8)
+LOWER_SYMBOLS = np.frombuffer(b'acgtn', dtype = np.uint8)
+LINE_WIDTH = 60
+TRUTH_COLUMNS = ['Feature', 'Locus', 'GeneType', 'Contig', 'Start', 'End', 'Strand', 'Source', 'Mutations']
+# predicted gene positions are matched to planted genes extended by the tolerance
+DEFAULT_TOLERANCE = 100
+
+DEFAULT_SETTINGS = {'size' : 10000000, 'contigs' : 100, 'min_contig' : 1000, 'loci' : locus_config.LOCI, 'copies' : 1,
+                    'v_genes' : 40, 'd_genes' : 10, 'j_genes' : 6, 'mutation_rate' : 0.02, 'indel_rate' : 0.002,
+                    'repeat_fraction' : 0.3, 'repeat_families' : 20, 'repeat_divergence' : 0.1, 'decoy_rss' : 20, 'seed' : 1}
+# random filler before genes of the type
+GENE_GAPS = {V : (2000, 8000), D : (500, 3000), J : (300, 1500), 'C' : (2000, 10000)}
+# random filler between V, D and J clusters
+CLUSTER_GAP = (10000, 30000)
+# random sequence around a locus in its contig
+LOCUS_FLANK = (10000, 100000)
+D_GENE_LENGTH = (12, 37)
+
+def ParseSize(value):
+    multipliers = {'K' : 1000, 'M' : 1000000, 'G' : 1000000000}
+    value = value.upper()
+    if value[-1] in multipliers:
+        return int(float(value[:-1]) * multipliers[value[-1]])
+    return int(value)
+
+def DecodeKmer(code, k):
+    return ''.join('ACGT'[(code >> (2 * (k - 1 - j))) & 3] for j in range(k))
+
+def ReadMotifs(bundle):
+    # signal type -> k -> motifs as 2-bit code arrays
+    motifs = dict()
+    for signal_type in (V, J, DL, DR):
+        motifs[signal_type] = dict()
+        for k in (7, 9):
+            codes = np.flatnonzero(bundle.MotifTable(signal_type, k))
+            motifs[signal_type][k] = [reference_bundle.EncodeNucleotides(DecodeKmer(int(code), k)) for code in codes]
+    return motifs
+
+def RandomCodes(rng, length):
+    return rng.integers(0, 4, length, dtype = np.uint8)
+
+def ReverseComplement(codes):
+    return (3 - codes)[::-1]
+
+def Mutate(rng, codes, substitution_rate, indel_rate = 0):
+    # returns mutated codes and the number of mutations
+    codes = codes.copy()
+    substituted = np.flatnonzero(rng.random(len(codes)) < substitution_rate)
+    codes[substituted] = (codes[substituted] + rng.integers(1, 4, len(substituted), dtype = np.uint8)) % 4
+    num_mutations = len(substituted)
+    if indel_rate > 0:
+        indels = np.flatnonzero(rng.random(len(codes)) < indel_rate)
+        for pos in indels[::-1]:
+            if rng.random() < 0.5:
+                codes = np.delete(codes, pos)
+            else:
+                codes = np.insert(codes, pos, rng.integers(0, 4, dtype = np.uint8))
+        num_mutations += len(indels)
+    return codes, num_mutations
+
+def SignalCodes(rng, motifs, signal_type, spacer_length):
+    # RSS in the sense orientation: heptamer-spacer-nonamer after V genes and before D_right,
+    # nonamer-spacer-heptamer before J genes and after D_left
+    heptamer = motifs[signal_type][7][rng.integers(len(motifs[signal_type][7]))]
+    nonamer = motifs[signal_type][9][rng.integers(len(motifs[signal_type][9]))]
+    spacer = RandomCodes(rng, spacer_length)
+    if signal_type in (V, DR):
+        return np.concatenate([heptamer, spacer, nonamer])
+    return np.concatenate([nonamer, spacer, heptamer])
+
+class LocusBuilder:
+    # the sequence of a locus in the sense orientation and its features with offsets in the locus
+    def __init__(self, rng):
+        self.rng = rng
+        self.parts = []
+        self.length = 0
+        self.features = []
+
+    def Add(self, codes):
+        self.parts.append(codes)
+        self.length += len(codes)
+
+    def AddFiller(self, gap):
+        self.Add(RandomCodes(self.rng, self.rng.integers(gap[0], gap[1] + 1)))
+
+    def AddGene(self, gene_type, codes, source, num_mutations):
+        self.features.append(('gene', gene_type, self.length, self.length + len(codes), source, num_mutations))
+        self.Add(codes)
+
+    def Codes(self):
+        return np.concatenate(self.parts)
+
+def BuildLocus(rng, locus, bundle, motifs, settings):
+    config = locus_config.GetLocusConfig(locus)
+    builder = LocusBuilder(rng)
+    num_genes = {V : settings['v_genes'], D : settings['d_genes'] if config.HasDGenes() else 0, J : settings['j_genes']}
+    for gene_type in (V, D, J):
+        if num_genes[gene_type] == 0:
+            continue
+        for i in range(num_genes[gene_type]):
+            builder.AddFiller(GENE_GAPS[gene_type])
+            if gene_type == D:
+                gene = RandomCodes(rng, rng.integers(D_GENE_LENGTH[0], D_GENE_LENGTH[1] + 1))
+                builder.Add(SignalCodes(rng, motifs, DL, config.spacer_length[DL]))
+                builder.AddGene(D, gene, 'synthetic', 0)
+                builder.Add(SignalCodes(rng, motifs, DR, config.spacer_length[DR]))
+                continue
+            gene_ids = bundle.GeneIds(locus + gene_type)
+            gene_idx = rng.integers(len(gene_ids))
+            gene, num_mutations = Mutate(rng, reference_bundle.EncodeNucleotides(bundle.GeneSeqs(locus + gene_type)[gene_idx]) % 4, settings['mutation_rate'], settings['indel_rate'])
+            if gene_type == J:
+                builder.Add(SignalCodes(rng, motifs, J, config.spacer_length[J]))
+            builder.AddGene(gene_type, gene, gene_ids[gene_idx], num_mutations)
+            if gene_type == V:
+                builder.Add(SignalCodes(rng, motifs, V, config.spacer_length[V]))
+        builder.AddFiller(CLUSTER_GAP)
+    if bundle.HasGeneType(locus + 'C'):
+        builder.AddFiller(GENE_GAPS['C'])
+        gene_ids = bundle.GeneIds(locus + 'C')
+        gene_idx = rng.integers(len(gene_ids))
+        gene, num_mutations = Mutate(rng, reference_bundle.EncodeNucleotides(bundle.GeneSeqs(locus + 'C')[gene_idx]) % 4, settings['mutation_rate'])
+        builder.AddGene('C', gene, gene_ids[gene_idx], num_mutations)
+        builder.AddFiller(CLUSTER_GAP)
+    return builder
+
+def LayoutContigs(rng, loci, settings):
+    # every locus is planted into its own contig with random flanks, the rest of the genome size is split into
+    # log-normal lengths of other contigs. Returns contig lengths and contig index -> [(start, locus, builder, reverse)]
+    num_contigs = settings['contigs']
+    min_len = settings['min_contig']
+    if len(loci) > num_contigs:
+        raise ValueError(str(len(loci)) + ' loci need at least as many contigs')
+    flanks = [(int(rng.integers(LOCUS_FLANK[0], LOCUS_FLANK[1] + 1)), int(rng.integers(LOCUS_FLANK[0], LOCUS_FLANK[1] + 1))) for locus in loci]
+    host_lengths = [left + builder.length + right for (locus, builder), (left, right) in zip(loci, flanks)]
+    num_other = num_contigs - len(loci)
+    other_size = settings['size'] - sum(host_lengths)
+    if other_size < num_other * min_len or (num_other == 0 and other_size < 0):
+        raise ValueError('loci (' + str(sum(host_lengths)) + ' nt with flanks) and ' + str(num_other) + ' contigs of at least ' + str(min_len) + ' nt do not fit into ' + str(settings['size']) + ' nt')
+    if num_other == 0:
+        host_lengths[-1] += other_size
+        flanks[-1] = (flanks[-1][0], flanks[-1][1] + other_size)
+        other_lengths = np.zeros(0, dtype = np.int64)
+    else:
+        weights = rng.lognormal(0, 1.5, num_other)
+        other_lengths = min_len + np.floor(weights / weights.sum() * (other_size - num_other * min_len)).astype(np.int64)
+        other_lengths[np.argmax(other_lengths)] += other_size - other_lengths.sum()
+    # contigs with loci are shuffled among other contigs
+    lengths = np.concatenate([np.array(host_lengths, dtype = np.int64), other_lengths])
+    order = rng.permutation(num_contigs)
+    placements = {i : [] for i in range(num_contigs)}
+    for host_idx, ((locus, builder), (left, right)) in enumerate(zip(loci, flanks)):
+        contig_idx = int(np.flatnonzero(order == host_idx)[0])
+        placements[contig_idx].append((left, locus, builder, rng.random() < 0.5))
+    return lengths[order], placements
+
+def Overlaps(start, end, intervals):
+    return any(start < other_end and other_start < end for other_start, other_end in intervals)
+
+class RepeatFamilies:
+    def __init__(self, rng, settings):
+        self.rng = rng
+        self.families = [RandomCodes(rng, rng.integers(300, 6001)) for i in range(settings['repeat_families'])]
+        self.mean_length = np.mean([len(family) for family in self.families]) if len(self.families) != 0 else 0
+        self.fraction = settings['repeat_fraction']
+        self.divergence = settings['repeat_divergence']
+
+    def Insert(self, codes, masked, locus_intervals):
+        # copies of random families with substitutions, soft-masked as by a repeat masker
+        if len(self.families) == 0:
+            return
+        num_copies = int(len(codes) * self.fraction / self.mean_length)
+        for i in range(num_copies):
+            family = self.families[self.rng.integers(len(self.families))]
+            if len(family) >= len(codes):
+                continue
+            start = int(self.rng.integers(0, len(codes) - len(family) + 1))
+            if Overlaps(start, start + len(family), locus_intervals):
+                continue
+            copy, num_mutations = Mutate(self.rng, family, self.divergence)
+            if self.rng.random() < 0.5:
+                copy = ReverseComplement(copy)
+            codes[start : start + len(copy)] = copy
+            masked[start : start + len(copy)] = True
+
+def InsertDecoys(rng, codes, motifs, settings, contig_id, locus_intervals, truth):
+    # isolated RSSs without genes
+    num_decoys = rng.poisson(settings['decoy_rss'] * len(codes) / 1000000)
+    for i in range(num_decoys):
+        signal_type = [V, J, DL, DR][rng.integers(4)]
+        rss = SignalCodes(rng, motifs, signal_type, [12, 23][rng.integers(2)])
+        if len(rss) >= len(codes):
+            continue
+        start = int(rng.integers(0, len(codes) - len(rss) + 1))
+        if Overlaps(start, start + len(rss), locus_intervals):
+            continue
+        strand = '+'
+        if rng.random() < 0.5:
+            rss = ReverseComplement(rss)
+            strand = '-'
+        codes[start : start + len(rss)] = rss
+        truth.append(['decoy_rss', '', '', contig_id, start, start + len(rss), strand, signal_type, 0])
+
+def WriteSequence(fh, contig_id, codes, masked):
+    symbols = np.where(masked, LOWER_SYMBOLS[codes], UPPER_SYMBOLS[codes])
+    num_lines = len(symbols) // LINE_WIDTH
+    lines = np.empty((num_lines, LINE_WIDTH + 1), dtype = np.uint8)
+    lines[:, : LINE_WIDTH] = symbols[: num_lines * LINE_WIDTH].reshape(num_lines, LINE_WIDTH)
+    lines[:, LINE_WIDTH] = ord('\n')
+    fh.write(('>' + contig_id + '\n').encode())
+    fh.write(lines.tobytes())
+    if len(symbols) % LINE_WIDTH != 0:
+        fh.write(symbols[num_lines * LINE_WIDTH :].tobytes() + b'\n')
+
+def WriteTruth(truth, truth_fname):
+    with open(truth_fname, 'w') as fh:
+        fh.write('\t'.join(TRUTH_COLUMNS) + '\n')
+        for row in truth:
+            fh.write('\t'.join(str(value) for value in row) + '\n')
+
+def GenerateGenome(output_fasta, truth_fname, settings = DEFAULT_SETTINGS):
+    rng = np.random.default_rng(settings['seed'])
+    bundle = reference_bundle.LoadBundle()
+    motifs = ReadMotifs(bundle)
+    loci = [(locus, BuildLocus(rng, locus, bundle, motifs, settings)) for locus in settings['loci'] for copy in range(settings['copies'])]
+    lengths, placements = LayoutContigs(rng, loci, settings)
+    repeats = RepeatFamilies(rng, settings)
+    truth = []
+    with open(output_fasta, 'wb') as fh:
+        for contig_idx, contig_len in enumerate(lengths):
+            contig_id = 'contig_' + str(contig_idx + 1)
+            codes = RandomCodes(rng, contig_len)
+            masked = np.zeros(contig_len, dtype = bool)
+            locus_intervals = [(start, start + builder.length) for start, locus, builder, reverse in placements[contig_idx]]
+            repeats.Insert(codes, masked, locus_intervals)
+            InsertDecoys(rng, codes, motifs, settings, contig_id, locus_intervals, truth)
+            for start, locus, builder, reverse in placements[contig_idx]:
+                locus_codes = builder.Codes()
+                if reverse:
+                    locus_codes = ReverseComplement(locus_codes)
+                codes[start : start + builder.length] = locus_codes
+                strand = '-' if reverse else '+'
+                truth.append(['locus', locus, '', contig_id, start, start + builder.length, strand, '', 0])
+                for feature, gene_type, feature_start, feature_end, source, num_mutations in builder.features:
+                    if reverse:
+                        feature_start, feature_end = builder.length - feature_end, builder.length - feature_start
+                    truth.append([feature, locus, gene_type, contig_id, start + feature_start, start + feature_end, strand, source, num_mutations])
+            WriteSequence(fh, contig_id, codes, masked)
+    WriteTruth(truth, truth_fname)
+    return truth
+
+def EvaluateRecall(truth_fname, output_dir, tolerance = DEFAULT_TOLERANCE):
+    # planted genes matched by genes of combined_genes_<locus>.txt: the same locus, gene type and contig and
+    # the position inside the planted gene extended by the tolerance. Returns (locus, gene type) -> (planted, found)
+    import pandas as pd
+    truth_df = pd.read_csv(truth_fname, sep = '\t', dtype = {'Contig' : str}, keep_default_na = False)
+    truth_df = truth_df.loc[(truth_df['Feature'] == 'gene') & (truth_df['GeneType'].isin([V, D, J]))]
+    recall = dict()
+    for (locus, gene_type), planted_df in truth_df.groupby(['Locus', 'GeneType']):
+        predicted = dict()
+        fname = os.path.join(output_dir, 'combined_genes_' + locus + '.txt')
+        if os.path.exists(fname):
+            predicted_df = pd.read_csv(fname, sep = '\t', dtype = {'Contig' : str})
+            predicted_df = predicted_df.loc[predicted_df['GeneType'] == gene_type]
+            for contig, contig_df in predicted_df.groupby('Contig'):
+                predicted[contig] = np.sort(contig_df['Pos'].to_numpy())
+        num_found = 0
+        for contig, start, end in zip(planted_df['Contig'], planted_df['Start'], planted_df['End']):
+            if contig not in predicted:
+                continue
+            positions = predicted[contig]
+            idx = np.searchsorted(positions, start - tolerance)
+            if idx < len(positions) and positions[idx] <= end + tolerance:
+                num_found += 1
+        recall[(locus, gene_type)] = (len(planted_df), num_found)
+    return recall
+
+def PrintRecall(recall):
+    print('Locus\tGeneType\tPlanted\tFound\tRecall')
+    for locus, gene_type in sorted(recall):
+        planted, found = recall[(locus, gene_type)]
+        print(locus + '\t' + gene_type + '\t' + str(planted) + '\t' + str(found) + '\t' + str(round(found / planted, 3) if planted != 0 else 'NA'))
+
+def PrintUsage():
+    print('python synthetic_genome.py genome.fasta truth.tsv [--size 10M] [--contigs 100] [--min-contig 1000] [--loci IGH,IGK,...] [--copies 1] '
+          '[--v-genes 40] [--d-genes 10] [--j-genes 6] [--mutation-rate 0.02] [--indel-rate 0.002] [--repeat-fraction 0.3] '
+          '[--repeat-families 20] [--repeat-divergence 0.1] [--decoy-rss 20 (per Mb)] [--seed 1]')
+    print('python synthetic_genome.py --evaluate truth.tsv igdetective_output_dir [--tolerance ' + str(DEFAULT_TOLERANCE) + ']')
+
+if __name__ == '__main__':
+    long_options = ['size=', 'contigs=', 'min-contig=', 'loci=', 'copies=', 'v-genes=', 'd-genes=', 'j-genes=', 'mutation-rate=', 'indel-rate=',
+                    'repeat-fraction=', 'repeat-families=', 'repeat-divergence=', 'decoy-rss=', 'seed=', 'evaluate', 'tolerance=']
+    try:
+        options, args = getopt.gnu_getopt(sys.argv[1:], '', long_options)
+    except getopt.error as err:
+        print(str(err))
+        PrintUsage()
+        sys.exit(1)
+    settings = dict(DEFAULT_SETTINGS)
+    evaluate = False
+    tolerance = DEFAULT_TOLERANCE
+    for option, value in options:
+        name = option[2:].replace('-', '_')
+        if option == '--evaluate':
+            evaluate = True
+        elif option == '--tolerance':
+            tolerance = int(value)
+        elif option == '--size':
+            settings['size'] = ParseSize(value)
+        elif option == '--loci':
+            settings['loci'] = value.split(',')
+        elif name in ('mutation_rate', 'indel_rate', 'repeat_fraction', 'repeat_divergence', 'decoy_rss'):
+            settings[name] = float(value)
+        else:
+            settings[name] = int(value)
+    if len(args) != 2 or any(locus not in locus_config.LOCI for locus in settings['loci']):
+        PrintUsage()
+        sys.exit(1)
+    if evaluate:
+        PrintRecall(EvaluateRecall(args[0], args[1], tolerance))
+        sys.exit(0)
+    print('Generating ' + str(settings['size']) + ' nt in ' + str(settings['contigs']) + ' contigs with loci ' + ','.join(settings['loci']) + '...')
+    truth = GenerateGenome(args[0], args[1], settings)
+    print(str(sum(1 for row in truth if row[0] == 'gene')) + ' genes, ' + str(sum(1 for row in truth if row[0] == 'decoy_rss')) + ' decoy RSSs were planted')
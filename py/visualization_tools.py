@@ -1,67 +1,167 @@
 import os
-import pandas as pd
+import sys
+import json
 import numpy as np
+from multiprocessing import get_context
 
-import matplotlib as mplt
-mplt.use('Agg')
-import matplotlib.pyplot as plt
-import seaborn as sns
+# the plotting stack and pandas are imported on first use, so that detection scripts recording plot jobs start
+# without them (see check_import_time.py)
+plt = None
+sns = None
 
-def OutputHeatmap(filenames, output_fname):
-    dfs = [pd.read_csv(fname, sep = '\t', dtype = {'Contig' : str}) for fname in filenames if os.path.exists(fname)]
-    genes = ['IGHV', 'IGHD', 'IGHJ', 'IGKV', 'IGKJ', 'IGLV', 'IGLJ']
-    contigs = []
-    for df in dfs:
-        contig_set = set(df['Contig'])
-        for contig in contig_set:
-            if contig not in contigs:
-                contigs.append(contig)
-    matrix = []
-    annot_matrix = []
-    for contig in contigs:
-        matrix.append([0] * len(genes))
-        annot_matrix.append([''] * len(genes))
-    df = pd.concat(dfs).reset_index()
-    df['LongGeneType'] = [df['Locus'][i] + df['GeneType'][i] for i in range(len(df))]
-    for x_idx, contig in enumerate(contigs):
-        for y_idx, gene in enumerate(genes):
-            sub_df = df.loc[(df['LongGeneType'] == gene) & (df['Contig'] == contig)]
-            if len(sub_df) != 0:
-                matrix[x_idx][y_idx] = len(sub_df)
-                annot_matrix[x_idx][y_idx] = str(len(sub_df))
+# none: plots are skipped, deferred: plot data are written to a JSON-lines file and rendered later by
+# running this script on the file, inline: plots are rendered by a process pool when the jobs are finished
+PLOT_MODES = ['none', 'deferred', 'inline']
+
+def LoadPlotting():
+    global plt, sns
+    if plt is not None:
+        return
+    import matplotlib as mplt
+    mplt.use('Agg')
+    import matplotlib.pyplot
+    import seaborn
+    plt = matplotlib.pyplot
+    sns = seaborn
+
+def RenderHeatmap(output_fname, data):
     plt.figure(figsize = (12, 8))
-    sns.heatmap(matrix, annot = np.array(annot_matrix), yticklabels = contigs, xticklabels = genes, cmap = 'coolwarm', robust = True, fmt = '', cbar = False)
+    if 'title' in data:
+        plt.title(data['title'])
+    sns.heatmap(data['matrix'], annot = np.array(data['annot']), yticklabels = data['ylabels'], xticklabels = data['xlabels'], cmap = 'coolwarm', robust = True, fmt = '', cbar = False)
     plt.yticks(fontsize = 6)
     plt.savefig(output_fname, dpi = 300)
-    plt.clf()
+    plt.close()
+
+def RenderPositions(output_fname, data):
+    plt.figure(figsize = (6, 3))
+    plt.bar(data['positions'], [1] * len(data['positions']), color = data['colors'])
+    if data['fixed_height']:
+        plt.ylim(0, 1)
+    plt.xlim(0, data['scale'])
+    plt.xticks([], [])
+    plt.yticks([], [])
+    plt.savefig(output_fname, dpi = 300)
+    plt.close()
+
+def RenderLocusSummary(output_fname, data):
+    import pandas as pd
+    fig, axes = plt.subplots(nrows = 3, figsize = (15, 10))
+    colors = data['colors']
+    x = np.array(range(len(colors)))
+    # lengths
+    sns.barplot(x = x, y = pd.Series(data['lengths'], name = 'Length'), palette = colors, ax = axes[0])
+    plt.sca(axes[0])
+    plt.xticks([], [])
+    # fraction productive Vs
+    sns.barplot(x = x, y = pd.Series(data['num_prod_v'], name = 'NumProdV'), palette = colors, ax = axes[1])
+    plt.sca(axes[1])
+    plt.xticks([], [])
+    # positions
+    rel_pos_df = {'Index' : [], 'RelPos' : []}
+    for i in range(len(colors)):
+        rel_pos_df['Index'].append(i)
+        rel_pos_df['RelPos'].append(data['rel_start'][i])
+        rel_pos_df['Index'].append(i)
+        rel_pos_df['RelPos'].append(data['rel_end'][i])
+    rel_pos_df = pd.DataFrame(rel_pos_df)
+    sns.swarmplot(x = 'Index', y = 'RelPos', data = rel_pos_df, palette = colors, ax = axes[2])
+    plt.sca(axes[2])
+    plt.xticks(x, data['contigs'], rotation = 90, fontsize = 6)
+    plt.ylim(0, 1.01)
+    plt.xlabel('')
+    # output
+    plt.tight_layout()
+    plt.savefig(output_fname, dpi = 300)
+    plt.close()
+
+PLOT_RENDERERS = {'heatmap' : RenderHeatmap, 'positions' : RenderPositions, 'locus_summary' : RenderLocusSummary}
+
+def RenderPlot(job):
+    LoadPlotting()
+    PLOT_RENDERERS[job['type']](job['output'], job['data'])
 
-def OutputPositionsPerContig(filename, locus, output_dir):
+def RenderPlots(jobs, num_processes = 1):
+    if num_processes > 1 and len(jobs) > 1:
+        with get_context('fork').Pool(min(num_processes, len(jobs))) as p:
+            p.map(RenderPlot, jobs, 1)
+    else:
+        for job in jobs:
+            RenderPlot(job)
+
+class PlotJobs:
+    # plots are described by their type, output file and the data they show (JSON-serializable)
+    def __init__(self, mode = 'inline', jobs_fname = '', num_processes = 1):
+        self.mode = mode
+        self.jobs_fname = jobs_fname
+        self.num_processes = num_processes
+        self.jobs = []
+
+    def Add(self, plot_type, output_fname, data):
+        if self.mode == 'none':
+            return
+        self.jobs.append({'type' : plot_type, 'output' : os.path.abspath(output_fname), 'data' : data})
+
+    def Finish(self):
+        if self.mode == 'deferred' and len(self.jobs) != 0:
+            with open(self.jobs_fname, 'a') as fh:
+                for job in self.jobs:
+                    fh.write(json.dumps(job) + '\n')
+        elif self.mode == 'inline':
+            RenderPlots(self.jobs, self.num_processes)
+        self.jobs = []
+
+def SubmitPlot(plot_jobs, plot_type, output_fname, data):
+    if plot_jobs is None:
+        RenderPlot({'type' : plot_type, 'output' : output_fname, 'data' : data})
+    else:
+        plot_jobs.Add(plot_type, output_fname, data)
+
+def ReadPlotJobs(jobs_fname):
+    with open(jobs_fname) as fh:
+        return [json.loads(l) for l in fh if l.strip() != '']
+
+def OutputHeatmap(filenames, output_fname, plot_jobs = None):
+    import pandas as pd
+    dfs = [pd.read_csv(fname, sep = '\t', dtype = {'Contig' : str}) for fname in filenames if os.path.exists(fname)]
+    genes = ['IGHV', 'IGHD', 'IGHJ', 'IGKV', 'IGKJ', 'IGLV', 'IGLJ']
+    df = pd.concat(dfs).reset_index()
+    contigs = list(pd.unique(df['Contig']))
+    counts = pd.crosstab(df['Contig'], df['Locus'] + df['GeneType']).reindex(index = contigs, columns = genes, fill_value = 0)
+    matrix = counts.values.tolist()
+    annot_matrix = [[str(c) if c != 0 else '' for c in row] for row in matrix]
+    SubmitPlot(plot_jobs, 'heatmap', output_fname, {'matrix' : matrix, 'annot' : annot_matrix, 'xlabels' : genes, 'ylabels' : contigs})
+
+def OutputPositionsPerContig(filename, locus, output_dir, plot_jobs = None):
+    import pandas as pd
     if not os.path.exists(filename):
         return
     df = pd.read_csv(filename, sep = '\t', dtype = {'Contig' : str})
-    contigs = set(df['Contig'])
     color_dict = {('V', True) : '#1F77B4', ('V', False) : '#AEC7E8', 'D' : '#FF7F0F', 'J' : '#2AA02B'}
-    strand_dict = {'+' : 1, '-' : -1}
     scale = 500
-    for contig in contigs:
-        contig_df = df.loc[df['Contig'] == contig].reset_index()
+    for contig, contig_df in df.groupby('Contig', sort = False):
+        contig_df = contig_df.reset_index()
         min_pos = max(0, contig_df['Pos'][0] - 10000)
         max_pos = contig_df['Pos'][len(contig_df) - 1] + 10000
-        scaled_pos_list = []
+        scaled_pos_list = ((contig_df['Pos'] - min_pos) / (max_pos - min_pos) * scale).tolist()
         color_list = []
-        y_list = []
-        for i in range(len(contig_df)):
-            scaled_pos_list.append((contig_df['Pos'][i] - min_pos) / (max_pos - min_pos) * scale)
-            gene_key = contig_df['GeneType'][i]
+        for gene_key, productive in zip(contig_df['GeneType'], contig_df['Productive']):
             if gene_key == 'V':
-                gene_key = (gene_key, contig_df['Productive'][i])
+                gene_key = (gene_key, productive)
             color_list.append(color_dict[gene_key])
-            y_list.append(1) # * strand_dict[contig_df['Strand'][i]])
-        plt.figure(figsize = (6, 3))
-        plt.bar(scaled_pos_list, y_list, color = color_list)
-        plt.ylim(0, 1)
-        plt.xlim(0, scale)
-        plt.xticks([], [])
-        plt.yticks([], [])
-        plt.savefig(os.path.join(output_dir, locus + '_' + str(contig) + '.png'), dpi = 300)
-        plt.clf()
+        output_fname = os.path.join(output_dir, locus + '_' + str(contig) + '.png')
+        SubmitPlot(plot_jobs, 'positions', output_fname, {'positions' : scaled_pos_list, 'colors' : color_list, 'scale' : scale, 'fixed_height' : True})
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('python visualization_tools.py plots.jsonl [plots2.jsonl ...] [--threads=N]')
+        sys.exit(1)
+    num_processes = 1
+    jobs = []
+    for arg in sys.argv[1:]:
+        if arg.startswith('--threads='):
+            num_processes = int(arg.split('=')[1])
+        else:
+            jobs.extend(ReadPlotJobs(arg))
+    print('Rendering ' + str(len(jobs)) + ' plots...')
+    RenderPlots(jobs, num_processes)
@@ -1,25 +1,36 @@
 import os
 import sys
+import getopt
+import gzip
 import subprocess
 import shutil
-import pandas as pd
 from Bio import SeqIO
 from Bio.Seq import Seq
 from Bio import Align
-import numpy as np
-
-import matplotlib as mplt
-mplt.use('Agg')
-import matplotlib.pyplot as plt
-import seaborn as sns
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.join(SCRIPT_DIR, 'py'))
 import extract_aligned_genes as gene_finding_tools
 import visualization_tools as visual_tools
 import locus_boundaries_refiner as locus_refiner
+import locus_config
+import result_store
+import contig_cache
+import shard_queue
+import progress_events
+import stage_scheduler
+import annotation_service
+import packed_genome
+import reference_bundle
+import gene_records
 
 ref_gene_dir = os.path.join(SCRIPT_DIR, 'datafiles', 'human_reference_genes')
+# number of threads used by minimap2 by default
+MINIMAP_THREADS = 3
+# windows of the de novo search, see GetLocusWindows
+MAX_HIT_GAP = 200000
+WINDOW_PADDING = 100000
+LOCUS_END_PADDING = 1000000
 
 def CheckPythonVersionFatal():
     if sys.version_info.major != 3:
@@ -39,59 +50,73 @@ def PrepareOutputDir(output_dir):
         shutil.rmtree(output_dir)
     os.mkdir(output_dir)
 
-def GetRange(min_pos, max_pos, seq_len, max_len = 10000000):
-    prefix_len = max_pos
-    suffix_len = seq_len - min_pos
-    gap = 1000000
-    if prefix_len > max_len and suffix_len > max_len:
-        return (max(min_pos - gap, 0), min(prefix_len + gap, seq_len))
-    if prefix_len < suffix_len:
-        return (0, min(prefix_len + gap, seq_len))
-    return (max(min_pos - gap, 0), seq_len)
+def GetLocusWindows(sorted_hits, seq_len, max_gap = MAX_HIT_GAP, padding = WINDOW_PADDING, end_padding = LOCUS_END_PADDING):
+    # windows of the de novo search follow the density of minimap2 hits (position, gene type): hits closer than
+    # max_gap form a cluster, clusters are padded on both sides and overlapping windows are merged. Only a gap between
+    # two V hits splits clusters, since D and J genes between V and C genes often have no hits. Clusters of single hits
+    # (e.g., an isolated distal V gene) are kept. Ends of the locus are padded by end_padding as the single range of
+    # the locus was, since genes of the ends can have no hits when reference genes map to other copies of the locus
+    clusters = []
+    prev_type = ''
+    for pos, gene_type in sorted_hits:
+        if len(clusters) != 0 and (pos - clusters[-1][1] <= max_gap or gene_type != 'V' or prev_type != 'V'):
+            clusters[-1][1] = pos
+        else:
+            clusters.append([pos, pos])
+        prev_type = gene_type
+    windows = []
+    for cluster_idx, (min_pos, max_pos) in enumerate(clusters):
+        start = max(0, min_pos - (end_padding if cluster_idx == 0 else padding))
+        end = min(seq_len, max_pos + (end_padding if cluster_idx == len(clusters) - 1 else padding))
+        if len(windows) != 0 and start <= windows[-1][1]:
+            windows[-1] = (windows[-1][0], max(windows[-1][1], end))
+        else:
+            windows.append((start, end))
+    return windows
 
-def AlignIgGenes(genome_fasta, ig_gene_fasta, sam_file):
-    os.system('minimap2 -a ' + genome_fasta + ' ' + ig_gene_fasta + ' -o ' + sam_file + ' > /dev/null 2>&1')
+def MinimapCommand(genome_fasta, ig_gene_fasta, sam_file):
+    return ['minimap2', '-a', genome_fasta, ig_gene_fasta, '-o', sam_file]
 
-def AlignReferenceGenes(align_dir, genome_fasta, ig_gene_dir, output_dir):
+def AlignReferenceGenes(align_dir, genome_fasta, ig_gene_dir, num_threads = 1):
     ref_gene_dict = dict()
     for f in os.listdir(ig_gene_dir):
         gene_type = f.split('.')[0]
         if gene_type not in ref_gene_dict:
             ref_gene_dict[gene_type] = os.path.join(ig_gene_dir, f)
+    # alignments of gene types are independent and run concurrently within the thread budget
+    scheduler = stage_scheduler.StageScheduler(num_threads, 'reference_alignment')
     for gene_type in ref_gene_dict:
         print('Aligning ' + gene_type + ' genes (' + ref_gene_dict[gene_type] + ')...')
-        AlignIgGenes(genome_fasta, ref_gene_dict[gene_type], os.path.join(align_dir, gene_type + '.sam'))
+        command = MinimapCommand(genome_fasta, ref_gene_dict[gene_type], os.path.join(align_dir, gene_type + '.sam'))
+        scheduler.Add('minimap2_' + gene_type, command, cpus = MINIMAP_THREADS, quiet = True, genes = gene_type)
+    scheduler.Run()
 
-def IdentifyIGContigs(igcontig_dir, alignment_dir, output_dir, genome_fasta):
+def IdentifyIGContigs(igcontig_dir, alignment_dir, output_dir, genome_fasta, num_threads = 1, plots = 'inline'):
     match_log = igcontig_dir + '.out'
     AM_SCRIPT_PATH = os.path.join(SCRIPT_DIR, 'py', 'analyze_matches.py')
-    os.system('python ' + AM_SCRIPT_PATH + ' ' + alignment_dir + ' ' + igcontig_dir + ' ' + genome_fasta + ' > ' + match_log)
-
-def GetPositionRange(sorted_positions):
-    if len(sorted_positions) == 1:
-        return sorted_positions[0], sorted_positions[0]
-    distances = [sorted_positions[i] - sorted_positions[i - 1] for i in range(1, len(sorted_positions))]
-    median = np.median(distances)
-    start_pos = sorted_positions[0]
-    end_pos = sorted_positions[-1]
-    if distances[0] / median > 100:
-        start_pos = sorted_positions[1]
-    if distances[-1] / median > 100:
-        end_pos = sorted_positions[-2]
-    return start_pos, end_pos
-
-def GetFastaID(igcontig_dir, contig_id, locus):
-    fasta_files = os.listdir(igcontig_dir)
-    for f in fasta_files:
-        if f.find(contig_id) == -1:
+    stage_scheduler.RunCommand([sys.executable, AM_SCRIPT_PATH, alignment_dir, igcontig_dir, genome_fasta, str(num_threads), plots], match_log)
+
+def GetContigFastas(igcontig_dir):
+    # (locus, contig ID) -> FASTA file of the whole contig, the files are named <loci>_<contig>.fasta and
+    # the contig ID is taken from the header CONTIG:<contig>|GENES:<genes>
+    contig_fastas = dict()
+    for f in os.listdir(igcontig_dir):
+        loci = f.split('_')[0].split(',')
+        if not f.endswith('.fasta') or len([l for l in loci if l not in locus_config.LOCI]) != 0:
             continue
-        loci_str = f.split('_')[0]
-        if loci_str.find(locus) == -1:
+        fname = os.path.join(igcontig_dir, f)
+        with open(fname) as fh:
+            header = fh.readline().strip()
+        if header.find('|GENES:') == -1:
             continue
-        return os.path.join(igcontig_dir, f)
-    return ''
+        contig_id = header[1 :].split('|')[0].split(':', 1)[1]
+        for locus in loci:
+            contig_fastas[(locus, contig_id)] = fname
+    return contig_fastas
 
-def RunIgDetective(igcontig_dir, output_dir, locus = 'IGH'):
+def RunIgDetective(igcontig_dir, output_dir, locus = 'IGH', num_threads = 1):
+    # pandas is imported by the stages reading tables, so that workers and the service start without it
+    import pandas as pd
     print('==== Running RSS-based IgDetective for ' + locus + '...')
     txt = os.path.join(igcontig_dir, '__summary.txt')
     if not os.path.exists(txt):
@@ -103,34 +128,34 @@ def RunIgDetective(igcontig_dir, output_dir, locus = 'IGH'):
     fasta = os.path.join(output_dir, 'combined_contigs_' + locus + '.fasta')
     fh = open(fasta, 'w')
     contigs = set(igh_df['ContigID'])
+    contig_fastas = GetContigFastas(igcontig_dir)
     for c in contigs:
         c_df = igh_df.loc[igh_df['ContigID'] == c]
-        contig_fasta = GetFastaID(igcontig_dir, c, locus) #os.path.join(igcontig_dir, locus + '_' + str(c) + '.fasta')
-        if not os.path.exists(contig_fasta) or contig_fasta == '':
-            print('WARN: ' + contig_fasta + ' does not exist')
+        if (locus, c) not in contig_fastas:
+            print('WARN: FASTA of contig ' + c + ' does not exist')
             continue
+        contig_fasta = contig_fastas[(locus, c)]
         seq = ''
         seq_id = ''
         for r in SeqIO.parse(contig_fasta, 'fasta'):
             seq = str(r.seq)
             seq_id = r.id
-        #min_pos = min(c_df['Position'])
-        #max_pos = max(c_df['Position'])
-        positions = sorted(c_df['Position'])
-        min_pos, max_pos = GetPositionRange(positions)
-        contig_range = GetRange(min_pos, max_pos, len(seq))
-        print('Contig: ' + str(c) + ', contig range: ' + str(contig_range) + ', approx locus length: ' + str(contig_range[1] - contig_range[0]))
-        fh.write('>' + seq_id + '|START:' + str(contig_range[0]) + '|END:' + str(contig_range[1]) + '\n')
-        fh.write(seq[contig_range[0] : contig_range[1]] + '\n')
+        # every window is a separate record, gene positions are lifted to the contig by START of the header
+        hits = sorted(zip(c_df['Position'], c_df['GeneType']))
+        for start, end in GetLocusWindows(hits, len(seq)):
+            print('Contig: ' + str(c) + ', window: ' + str((start, end)) + ', window length: ' + str(end - start))
+            fh.write('>' + seq_id + '|START:' + str(start) + '|END:' + str(end) + '\n')
+            fh.write(seq[start : end] + '\n')
     fh.close()
     # running IgDetective
     igdetective_dir = os.path.join(output_dir, 'predicted_genes_' + locus)
     IGD_PATH = os.path.join(SCRIPT_DIR, 'py', 'IGDetective.py')
-    command_line = 'python ' + IGD_PATH + ' -i ' + fasta + ' -o ' + igdetective_dir + ' -m 1 -l ' + locus
-    print('Running: ' + command_line)
-    os.system(command_line + ' > ' + os.path.join(output_dir, 'predicted_genes_' + locus + '.out'))
+    command = [sys.executable, IGD_PATH, '-i', fasta, '-o', igdetective_dir, '-m', str(num_threads), '-l', locus]
+    print('Running: ' + ' '.join(command))
+    stage_scheduler.RunCommand(command, os.path.join(output_dir, 'predicted_genes_' + locus + '.out'))
 
 def CombineIGGenes(genes_fasta, igdetective_tsv, output_fasta):
+    import pandas as pd
     nucl_seqs = set()
     if os.path.exists(genes_fasta):
         for r in SeqIO.parse(genes_fasta, 'fasta'):
@@ -153,10 +178,10 @@ def CombineIGGenes(genes_fasta, igdetective_tsv, output_fasta):
         fh.write('>seq_' + str(seq_idx) + '\n' + seq + '\n')
     fh.close()
 
-def AlignGenesIteratively(ref_gene_fasta, igdetective_tsv, genome_fasta, output_dir, gene_type, num_iter = 5):
+def AlignGenesIteratively(ref_gene_fasta, igdetective_tsv, genome_fasta, output_dir, gene_type, num_iter = 5, num_threads = 1, minimap_index = None, genome = None, seeded = False):
     # aligning reference genes
     iter0_dir = os.path.join(output_dir, gene_type + '_iter0')
-    gene_finding_tools.main(genome_fasta, ref_gene_fasta, iter0_dir)
+    gene_finding_tools.main(genome_fasta, ref_gene_fasta, iter0_dir, seeded = seeded, num_workers = num_threads, minimap_index = minimap_index, genome = genome)
     iter0_fasta = os.path.join(iter0_dir, 'genes.fasta')
     # combining genes
     combined_fasta = os.path.join(output_dir, gene_type + '_combined.fasta')
@@ -171,13 +196,15 @@ def AlignGenesIteratively(ref_gene_fasta, igdetective_tsv, genome_fasta, output_
     for i in range(num_iter):
         print('== Iteration ' + str(i + 1) + '...')
         iter_dir = os.path.join(output_dir, gene_type + '_iter' + str(i + 1))
-        gene_finding_tools.main(genome_fasta, prev_fasta, iter_dir)
+        with progress_events.Stage('iterative_round', gene = gene_type, iteration = i + 1):
+            gene_finding_tools.main(genome_fasta, prev_fasta, iter_dir, seeded = seeded, num_workers = num_threads, minimap_index = minimap_index, genome = genome)
         curr_iter_fasta = os.path.join(iter_dir, 'genes.fasta')
         if not os.path.exists(curr_iter_fasta):
             print('gene file does not exist')
             break
         curr_iter_seqs = [r for r in SeqIO.parse(curr_iter_fasta, 'fasta')]
         num_gene_dict[iter_dir] = len(curr_iter_seqs)
+        progress_events.Count('iterative_round', 'genes', len(curr_iter_seqs), gene = gene_type, iteration = i + 1, previous_genes = len(prev_iter_seqs))
         print('# current genes: ' + str(len(curr_iter_seqs)) + ', # previous genes: ' + str(len(prev_iter_seqs)))
         if len(prev_iter_seqs) >= len(curr_iter_seqs) and i != 0:
             print('no new genes were detected, stopping the iterative search')
@@ -185,7 +212,7 @@ def AlignGenesIteratively(ref_gene_fasta, igdetective_tsv, genome_fasta, output_
         prev_iter_seqs = curr_iter_seqs
         prev_fasta = curr_iter_fasta
     best_iter = sorted(num_gene_dict, key = lambda x : num_gene_dict[x], reverse = True)[0]
-    os.system('cp -r ' + best_iter + ' ' + os.path.join(output_dir, gene_type + '_final'))
+    shutil.copytree(best_iter, os.path.join(output_dir, gene_type + '_final'))
 
 def ReadGeneDir(ig_gene_dir):
     files = os.listdir(ig_gene_dir)
@@ -198,90 +225,275 @@ def ReadGeneDir(ig_gene_dir):
 def CleanLargeContigs(ig_contig_dir):
     files = [f for f in os.listdir(ig_contig_dir) if f.find('fasta') != -1]
     for f in files:
-        os.system('rm ' + os.path.join(ig_contig_dir, f))
-
-def UpdateVGeneDF(df, summary_df):
-    for i in range(len(df)):
-        summary_df['GeneType'].append('V')
-        summary_df['Contig'].append(str(df['Contig'][i]).replace('|', '_'))
-        summary_df['Pos'].append(df['Pos'][i])
-        summary_df['Strand'].append(df['Strand'][i])
-        summary_df['Sequence'].append(df['Seq'][i])
-        summary_df['Productive'].append(df['Productive'][i])
-    return summary_df
-
-def UpdateDJGeneDF(df, summary_df, gene_type):
-    for i in range(len(df)):
-        summary_df['GeneType'].append(gene_type)
-        splits = df['reference contig'][i].split('|')
-        start_pos = int(splits[2].split(':')[1])
-        summary_df['Contig'].append(str(splits[0].split(':')[1]).replace('|', '_'))
-        summary_df['Pos'].append(start_pos + df['start of gene'][i])
-        summary_df['Strand'].append(df['strand'][i])
-        summary_df['Sequence'].append(df['gene sequence'][i])
-        summary_df['Productive'].append('NA')
-    return summary_df
+        os.remove(os.path.join(ig_contig_dir, f))
 
 def CollectLocusSummary(denovo_dir, iter_dir, locus, output_fname):
+    # V genes of the iterative search and D/J genes of the de novo search, returns gene records of the locus
     gene_dict = dict()
     gene_dict['V'] = os.path.join(os.path.join(iter_dir, locus + 'V_final'), 'genes.tsv')
-    if locus == 'IGH':
+    if locus_config.GetLocusConfig(locus).HasDGenes():
         gene_dict['D'] = os.path.join(denovo_dir, 'genes_D.tsv')
     gene_dict['J'] = os.path.join(denovo_dir, 'genes_J.tsv')
     gene_order = ['V', 'D', 'J']
-    sum_df = {'GeneType' : [], 'Contig' : [], 'Pos' : [], 'Strand' : [], 'Sequence' : [], 'Productive' : []}
+    records = gene_records.GeneRecords()
     for gene_type in gene_order:
         if gene_type not in gene_dict:
             continue
         if not os.path.exists(gene_dict[gene_type]):
             continue
-        df = pd.read_csv(gene_dict[gene_type], sep = '\t', dtype = {'Contig' : str})
         if gene_type == 'V':
-            sum_df = UpdateVGeneDF(df, sum_df)
+            gene_records.ReadAlignedGenes(gene_dict[gene_type], locus, gene_type, records)
         else:
-            sum_df = UpdateDJGeneDF(df, sum_df, gene_type)
-    sum_df = pd.DataFrame(sum_df)
-    sum_df['Locus'] = locus
-    sum_df = sum_df.sort_values(by=['Contig', 'Pos'])
-    sum_df.to_csv(output_fname, sep = '\t', index = False)
+            gene_records.ReadDenovoGenes(gene_dict[gene_type], locus, gene_type, records)
+    for gene_type in gene_order:
+        progress_events.Count('combine_genes', 'genes', records.Count(gene_type), locus = locus, gene = gene_type)
+    records.SortByPosition()
+    records.WriteTsv(output_fname)
+    return records
+
+def SearchLocusDenovo(igcontig_dir, igdetect_dir, output_dir, locus, num_threads, cache, run_stages):
+    if run_stages:
+        RunIgDetective(igcontig_dir, igdetect_dir, locus, num_threads)
+    if cache is not None:
+        cache.MergeTables(output_dir, os.path.join('denovo_search', 'predicted_genes_' + locus, ''))
+
+def SearchLocusIteratively(ig_genes, igdetect_dir, genome_fasta, iter_dir, locus, num_threads, seeded):
+    for gene_type in ['V']:
+        gene = locus + gene_type
+        print('==== Iterative processing ' + gene + ' genes...')
+        if gene not in ig_genes:
+            continue
+        ref_gene_fasta = ig_genes[gene]
+        igdetective_tsv = os.path.join(os.path.join(igdetect_dir, 'predicted_genes_' + locus), 'genes_' + gene_type + '.tsv')
+        AlignGenesIteratively(ref_gene_fasta, igdetective_tsv, genome_fasta, iter_dir, gene, num_threads = num_threads, seeded = seeded)
+
+def FindGenes(genome_fasta, alignment_dir, output_dir, ig_gene_dir, loci, num_threads = 1, plots = 'inline', cache = None, run_stages = True, iterative_search = True, seeded = False):
+    # stages form a DAG: the de novo search of a locus depends on the identification of IG contigs and the iterative
+    # search of a locus depends on the de novo search of the same locus only, so searches of different loci are run
+    # concurrently. The thread budget is shared by loci. Without iterative_search, only the de novo search is run
+    scheduler = stage_scheduler.StageScheduler(num_threads)
+    locus_threads = max(1, num_threads // len(loci))
+    igcontig_dir = os.path.join(output_dir, 'ig_contigs')
+    igdetect_dir = os.path.join(output_dir, 'denovo_search')
+    iter_dir = os.path.join(output_dir, 'iterative_search')
+    os.mkdir(igdetect_dir)
+    if iterative_search:
+        os.mkdir(iter_dir)
+    ig_genes = ReadGeneDir(ig_gene_dir)
+    # the reference bundle is compiled here if it is stale, rather than by every concurrent search stage
+    reference_bundle.LoadBundle()
+
+    #### identifying IG contigs
+    print('==== Identifying contigs containing adaptive immune loci...')
+    identification_stages = []
+    if run_stages:
+        scheduler.Add('ig_contig_identification', lambda : IdentifyIGContigs(igcontig_dir, alignment_dir, output_dir, genome_fasta, num_threads, plots), cpus = num_threads)
+        identification_stages.append('ig_contig_identification')
+    else:
+        os.mkdir(igcontig_dir)
+
+    #### running IgDetective and aligning IG genes
+    denovo_stages = []
+    for locus in loci:
+        denovo_stage = 'denovo_search_' + locus
+        scheduler.Add(denovo_stage, lambda locus = locus : SearchLocusDenovo(igcontig_dir, igdetect_dir, output_dir, locus, locus_threads, cache, run_stages), identification_stages, cpus = locus_threads, locus = locus)
+        if iterative_search:
+            scheduler.Add('iterative_search_' + locus, lambda locus = locus : SearchLocusIteratively(ig_genes, igdetect_dir, genome_fasta, iter_dir, locus, locus_threads, seeded), [denovo_stage], cpus = locus_threads, locus = locus)
+        denovo_stages.append(denovo_stage)
+    if cache is not None:
+        # cached contigs have no FASTA files in ig_contigs, so their rows are added after the de novo search
+        scheduler.Add('ig_contig_merging', lambda : cache.MergeTables(output_dir, os.path.join('ig_contigs', '')), denovo_stages)
+    scheduler.Run()
+
+def SearchGenesIteratively(genome_fasta, output_dir, ig_gene_dir, loci, num_threads = 1, seeded = False):
+    # iterative searches of all loci on the whole genome, seeded by de novo genes of denovo_search
+    scheduler = stage_scheduler.StageScheduler(num_threads)
+    locus_threads = max(1, num_threads // len(loci))
+    igdetect_dir = os.path.join(output_dir, 'denovo_search')
+    iter_dir = os.path.join(output_dir, 'iterative_search')
+    os.mkdir(iter_dir)
+    ig_genes = ReadGeneDir(ig_gene_dir)
+    for locus in loci:
+        scheduler.Add('iterative_search_' + locus, lambda locus = locus : SearchLocusIteratively(ig_genes, igdetect_dir, genome_fasta, iter_dir, locus, locus_threads, seeded), cpus = locus_threads, locus = locus)
+    scheduler.Run()
+
+def SplitGenome(genome_fasta, shard_dir, num_shards):
+    # contigs are distributed greedily (the longest first) into shards of similar total length
+    contigs = []
+    if genome_fasta.endswith('.gz'):
+        genome_handle = gzip.open(genome_fasta, 'rt')
+    else:
+        genome_handle = open(genome_fasta, 'r')
+    for r in SeqIO.parse(genome_handle, 'fasta'):
+        contigs.append((r.id, len(r.seq)))
+    genome_handle.close()
+    shard_contigs = [set() for i in range(min(num_shards, len(contigs)))]
+    shard_lengths = [0] * len(shard_contigs)
+    for contig_id, contig_len in sorted(contigs, key = lambda x : x[1], reverse = True):
+        shard_idx = shard_lengths.index(min(shard_lengths))
+        shard_contigs[shard_idx].add(contig_id)
+        shard_lengths[shard_idx] += contig_len
+    shards = []
+    for shard_idx in sorted(range(len(shard_contigs)), key = lambda i : shard_lengths[i], reverse = True):
+        shard_fasta = os.path.join(shard_dir, 'shard_' + str(len(shards)) + '.fasta')
+        contig_cache.WriteContigs(genome_fasta, shard_fasta, shard_contigs[shard_idx])
+        shards.append((shard_fasta, os.path.join(shard_dir, 'shard_' + str(len(shards))), shard_lengths[shard_idx]))
+    return shards
+
+def ProcessShard(shard_fasta, shard_output_dir, settings):
+    # stages from the identification of IG contigs to the de novo search are run on a shard independently of other
+    # shards. Hits of reference genes and the iterative search depend on all contigs, so reference genes are aligned
+    # to the whole genome before and the iterative search is run on the whole genome after merging (see main)
+    PrepareOutputDir(shard_output_dir)
+    alignment_dir = os.path.join(shard_output_dir, 'initial_alignments')
+    os.mkdir(alignment_dir)
+    contig_ids = {r.id for r in SeqIO.parse(shard_fasta, 'fasta')}
+    for sam_fname in os.listdir(settings['alignment_dir']):
+        contig_cache.FilterSamFile(os.path.join(settings['alignment_dir'], sam_fname), os.path.join(alignment_dir, sam_fname), contig_ids)
+    FindGenes(shard_fasta, alignment_dir, shard_output_dir, settings['ig_gene_dir'], settings['loci'], settings['num_threads'], settings['plots'], iterative_search = False)
+    CleanLargeContigs(os.path.join(shard_output_dir, 'ig_contigs'))
+
+def RunShardWorker(output_dir):
+    queue_db = os.path.join(output_dir, 'shards', 'queue.db')
+    if not os.path.exists(queue_db):
+        print('ERROR: shard queue ' + queue_db + ' does not exist')
+        sys.exit(1)
+    num_processed = shard_queue.RunWorker(queue_db, ProcessShard)
+    print('Worker processed ' + str(num_processed) + ' shards')
+
+def MergeShards(shards, output_dir, loci):
+    # tables of shards are concatenated into the usual output tables
+    import pandas as pd
+    for table in list(contig_cache.CachedTables(loci)) + [os.path.join('ig_contigs', '__plots.jsonl')]:
+        shard_tables = [os.path.join(shard_output_dir, table) for shard_id, shard_fasta, shard_output_dir in shards]
+        shard_tables = [fname for fname in shard_tables if os.path.exists(fname)]
+        if len(shard_tables) == 0:
+            continue
+        output_fname = os.path.join(output_dir, table)
+        os.makedirs(os.path.dirname(output_fname), exist_ok = True)
+        if table.endswith('.jsonl'):
+            with open(output_fname, 'w') as fh:
+                for fname in shard_tables:
+                    fh.write(open(fname).read())
+            continue
+        df = pd.concat([pd.read_csv(fname, sep = '\t', dtype = str, keep_default_na = False) for fname in shard_tables])
+        df.to_csv(output_fname, sep = '\t', index = False)
 
-def main(genome_fasta, output_dir, ig_gene_dir):
+def RunShards(genome_fasta, alignment_dir, output_dir, ig_gene_dir, loci, num_shards, num_workers, num_threads = 1, plots = 'inline'):
+    print('==== Splitting the genome into ' + str(num_shards) + ' shards...')
+    # paths are absolute, so that workers on other hosts can find shards on the shared file system
+    shard_dir = os.path.abspath(os.path.join(output_dir, 'shards'))
+    os.mkdir(shard_dir)
+    queue_db = os.path.join(shard_dir, 'queue.db')
+    queue = shard_queue.ShardQueue(queue_db)
+    queue.AddShards(SplitGenome(genome_fasta, shard_dir, num_shards), {'ig_gene_dir' : ig_gene_dir, 'alignment_dir' : os.path.abspath(alignment_dir), 'loci' : loci, 'num_threads' : num_threads, 'plots' : plots})
+    print('==== Processing shards, workers on other hosts can be started by:')
+    print('python ' + os.path.abspath(__file__) + ' --worker ' + os.path.abspath(output_dir))
+    # this process is one of the local workers
+    worker_processes = [subprocess.Popen([sys.executable, os.path.abspath(__file__), '--worker', output_dir]) for i in range(num_workers - 1)]
+    counts = shard_queue.WaitForShards(queue_db, ProcessShard if num_workers > 0 else None)
+    for p in worker_processes:
+        p.wait()
+    if counts['failed'] != 0:
+        for shard_id, worker, error in queue.Errors():
+            print('ERROR: shard ' + str(shard_id) + ' failed on ' + worker + ': ' + error)
+        sys.exit(1)
+    print('==== Merging results of ' + str(counts['done']) + ' shards...')
+    MergeShards(queue.Shards(), output_dir, loci)
+    queue.Close()
+
+def RunServiceJob(job, index_cache, job_dir, num_threads, ig_gene_dir):
+    # annotates regions of a genome within the service process: the de novo search is run in-process on region windows
+    # and the iterative search aligns genes to the cached minimap2 index of regions. Positions are genome positions
+    import IGDetective as igdetective
+    loci = job.get('loci', locus_config.LOCI)
+    seeded = job.get('seeded', False)
+    for locus in loci:
+        if locus not in locus_config.LOCI:
+            raise ValueError('unknown locus ' + locus)
+    region_fasta = os.path.join(job_dir, 'regions.fasta')
+    window_fasta = os.path.join(job_dir, 'windows.fasta')
+    region_starts = annotation_service.WriteRegions(job['genome'], job.get('regions', []), region_fasta, window_fasta)
+    region_starts = {gene_records.ContigKey(contig_id) : region_starts[contig_id] for contig_id in region_starts}
+    minimap_index = index_cache.Get(region_fasta)
+    window_seqs = packed_genome.PackFasta(window_fasta).Contigs()
+    # regions of a job are packed in memory rather than in the genome cache
+    region_genome = packed_genome.PackFasta(region_fasta)
+    ig_genes = ReadGeneDir(ig_gene_dir)
+    igdetect_dir = os.path.join(job_dir, 'denovo_search')
+    iter_dir = os.path.join(job_dir, 'iterative_search')
+    os.mkdir(iter_dir)
+    igdetective.NUM_THREADS = num_threads
+    genes = []
+    for locus in loci:
+        denovo_dir = os.path.join(igdetect_dir, 'predicted_genes_' + locus)
+        os.makedirs(denovo_dir)
+        igdetective.find_genes(window_seqs, locus_config.GetLocusConfig(locus), denovo_dir)
+        if locus + 'V' in ig_genes:
+            AlignGenesIteratively(ig_genes[locus + 'V'], os.path.join(denovo_dir, 'genes_V.tsv'), region_fasta, iter_dir, locus + 'V', num_threads = num_threads, minimap_index = minimap_index, genome = region_genome, seeded = seeded)
+        txt = os.path.join(job_dir, 'combined_genes_' + locus + '.txt')
+        for gene in CollectLocusSummary(denovo_dir, iter_dir, locus, txt).Rows():
+            if gene['GeneType'] == 'V':
+                # D and J positions are lifted by window headers, V genes are aligned to regions
+                gene['Pos'] += region_starts[gene['Contig']]
+            genes.append(gene)
+    return genes
+
+def RunService(socket_path, work_dir, ig_gene_dir, num_threads = 1, max_indexes = annotation_service.DEFAULT_MAX_INDEXES):
+    CheckMinimapFatal()
+    os.makedirs(work_dir, exist_ok = True)
+    # modules, the reference bundle and motif tables stay resident, workers of jobs are forked from this process
+    import IGDetective
+    IGDetective.load_reference_data()
+    process_job = lambda job, index_cache, job_dir, num_threads : RunServiceJob(job, index_cache, job_dir, num_threads, ig_gene_dir)
+    service = annotation_service.AnnotationService(process_job, work_dir, num_threads, max_indexes)
+    annotation_service.Serve(socket_path, service)
+
+def main(genome_fasta, output_dir, ig_gene_dir, num_threads = 1, plots = 'inline', db_fname = None, label = None, cache_dir = None, num_shards = 0, num_workers = 1, seeded = False):
     #### preparation
     CheckPythonVersionFatal()
     CheckMinimapFatal()
     PrepareOutputDir(output_dir)
+    loci = locus_config.LOCI
+    cache = None
 
     #### running IG gene alignments
     print('==== Aligning reference adaptive immune genes...')
     alignment_dir = os.path.join(output_dir, 'initial_alignments')
     os.mkdir(alignment_dir)
-    AlignReferenceGenes(alignment_dir, genome_fasta, ig_gene_dir, output_dir)
-    
-    #### identifying IG contigs
-    print('==== Identifying contigs containing adaptive immune loci...')
-    igcontig_dir = os.path.join(output_dir, 'ig_contigs')
-    IdentifyIGContigs(igcontig_dir, alignment_dir, output_dir, genome_fasta)
+    AlignReferenceGenes(alignment_dir, genome_fasta, ig_gene_dir, num_threads)
 
-    #### running IgDetective
-    loci = ['IGH', 'IGK', 'IGL', 'TRA', 'TRB', 'TRG']
-    igdetect_dir = os.path.join(output_dir, 'denovo_search')
-    os.mkdir(igdetect_dir)
-    for locus in loci:
-        RunIgDetective(igcontig_dir, igdetect_dir, locus)
+    if num_shards > 0:
+        #### sharded mode: stages from the identification of IG contigs to the de novo search are run by workers
+        RunShards(genome_fasta, alignment_dir, output_dir, ig_gene_dir, loci, num_shards, num_workers, num_threads, plots)
+        # a V gene found in one shard seeds the search in others, as in a single-host run
+        print('==== Iterative search of genes on the whole genome...')
+        SearchGenesIteratively(genome_fasta, output_dir, ig_gene_dir, loci, num_threads, seeded)
+    else:
+        #### selecting contigs for incremental re-annotation
+        stage_genome = genome_fasta
+        stage_alignment_dir = alignment_dir
+        run_stages = True
+        if cache_dir is not None:
+            print('==== Comparing contigs with cached results in ' + cache_dir + '...')
+            cache = contig_cache.ContigCache(cache_dir, ig_gene_dir, loci, seeded)
+            rerun_contigs = cache.Update(genome_fasta, alignment_dir)
+            if rerun_contigs is not None:
+                run_stages = len(rerun_contigs) != 0
+                stage_genome, stage_alignment_dir = cache.PrepareInputs(genome_fasta, alignment_dir, os.path.join(output_dir, 'changed_contigs'))
 
-    #### aligning IG genes
-    ig_genes = ReadGeneDir(ig_gene_dir)
+        FindGenes(stage_genome, stage_alignment_dir, output_dir, ig_gene_dir, loci, num_threads, plots, cache, run_stages, iterative_search = cache is None, seeded = seeded)
+        if cache is not None:
+            # the iterative search is seeded by de novo genes of all contigs (cached and rerun) and aligns them to
+            # the whole genome, so its cached results are valid only if no contig changed
+            if cache.IterativeResultsValid():
+                cache.MergeTables(output_dir, os.path.join('iterative_search', ''))
+            else:
+                print('==== Iterative search of genes on the whole genome...')
+                SearchGenesIteratively(genome_fasta, output_dir, ig_gene_dir, loci, num_threads, seeded)
+    igcontig_dir = os.path.join(output_dir, 'ig_contigs')
+    igdetect_dir = os.path.join(output_dir, 'denovo_search')
     iter_dir = os.path.join(output_dir, 'iterative_search')
-    os.mkdir(iter_dir)
-    for locus in loci:
-        for gene_type in ['V']:
-            gene = locus + gene_type
-            print('==== Iterative processing ' + gene + ' genes...')
-            if gene not in ig_genes:
-                continue
-            ref_gene_fasta = ig_genes[gene]
-            igdetective_tsv = os.path.join(os.path.join(igdetect_dir, 'predicted_genes_' + locus), 'genes_' + gene_type + '.tsv')
-            AlignGenesIteratively(ref_gene_fasta, igdetective_tsv, genome_fasta, iter_dir, gene)
 
     #### combine locus genes
     print('==== Combining genes for the same adaptive immune locus...')
@@ -293,29 +505,101 @@ def main(genome_fasta, output_dir, ig_gene_dir):
 
     #### visualization
     print('==== Visualization IG/TR gene counts and positions...')
-    visual_tools.OutputHeatmap(combined_txt_files, os.path.join(output_dir, 'summary.png'))
-    plot_dir = os.path.join(output_dir, 'position_plots')
-    os.mkdir(plot_dir)
-    for locus, fname in zip(loci, combined_txt_files):
-        visual_tools.OutputPositionsPerContig(fname, locus, plot_dir)
+    plot_jobs_fname = os.path.join(output_dir, 'deferred_plots.jsonl')
+    plot_jobs = visual_tools.PlotJobs(plots, plot_jobs_fname, num_threads)
+    with progress_events.Stage('visualization'):
+        visual_tools.OutputHeatmap(combined_txt_files, os.path.join(output_dir, 'summary.png'), plot_jobs)
+        plot_dir = os.path.join(output_dir, 'position_plots')
+        os.mkdir(plot_dir)
+        for locus, fname in zip(loci, combined_txt_files):
+            visual_tools.OutputPositionsPerContig(fname, locus, plot_dir, plot_jobs)
 
     #### IG locus refinement: clearing spurious matches, extracting sequences of IG loci
     print('==== Refinement of positions of IG/TR loci')
     locus_seq_dir = os.path.join(output_dir, 'refined_ig_loci')
     os.mkdir(locus_seq_dir)
-    locus_refiner.main(genome_fasta, output_dir, locus_seq_dir)
+    with progress_events.Stage('locus_refinement'):
+        locus_index = locus_refiner.main(genome_fasta, output_dir, locus_seq_dir, plot_jobs)
+
+    #### rendering plots
+    with progress_events.Stage('plot_rendering', plots = len(plot_jobs.jobs)):
+        plot_jobs.Finish()
+    if plots == 'deferred':
+        print('Plots were not rendered, to render them run:')
+        print('python ' + os.path.join(SCRIPT_DIR, 'py', 'visualization_tools.py') + ' ' + os.path.join(igcontig_dir, '__plots.jsonl') + ' ' + plot_jobs_fname)
+
+    #### storing results
+    if db_fname is not None:
+        print('==== Storing results in ' + db_fname + '...')
+        if label is None:
+            label = os.path.basename(genome_fasta)
+        run_id = result_store.StoreRunResults(db_fname, label, genome_fasta, output_dir, loci, locus_index, {'num_threads' : num_threads, 'ig_gene_dir' : ig_gene_dir, 'seeded' : seeded})
+        print('Results were stored as run ' + str(run_id))
+
+    #### caching per-contig results
+    if cache is not None:
+        cache.Save(output_dir)
 
     #### cleanup
-    CleanLargeContigs(igcontig_dir)
+    if os.path.exists(igcontig_dir):
+        CleanLargeContigs(igcontig_dir)
 
     #### the end
     print('Thank you for using IgDetective!')
 
 if __name__ == '__main__':
-    if len(sys.argv) != 3:
-        print('python run_iterative_igdetective.py genome.fasta output_dir')
-        sys.exit(1)
-    genome_fasta = sys.argv[1]
-    output_dir = sys.argv[2]
+    options, args = getopt.gnu_getopt(sys.argv[1:], '', ['plots=', 'db=', 'label=', 'cache=', 'shards=', 'workers=', 'worker', 'events=', 'serve', 'indexes=', 'seeded'])
+    plots = 'inline'
+    db_fname = None
+    label = None
+    cache_dir = None
+    num_shards = 0
+    num_workers = 1
+    is_worker = False
+    is_service = False
+    seeded = False
+    max_indexes = annotation_service.DEFAULT_MAX_INDEXES
+    for option, value in options:
+        if option == '--plots':
+            plots = value
+        elif option == '--db':
+            db_fname = value
+        elif option == '--label':
+            label = value
+        elif option == '--cache':
+            cache_dir = value
+        elif option == '--shards':
+            num_shards = int(value)
+        elif option == '--workers':
+            num_workers = int(value)
+        elif option == '--worker':
+            is_worker = True
+        elif option == '--events':
+            progress_events.SetEventStream(value)
+        elif option == '--serve':
+            is_service = True
+        elif option == '--indexes':
+            max_indexes = int(value)
+        elif option == '--seeded':
+            seeded = True
     ig_gene_dir = os.path.join(SCRIPT_DIR, "datafiles", "combined_reference_genes") #sys.argv[3]
-    main(genome_fasta, output_dir, ig_gene_dir)
+    if is_worker and len(args) == 1:
+        RunShardWorker(args[0])
+        sys.exit(0)
+    if is_service and len(args) in [2, 3]:
+        RunService(args[0], args[1], ig_gene_dir, int(args[2]) if len(args) == 3 else 1, max_indexes)
+        sys.exit(0)
+    if len(args) not in [2, 3] or plots not in visual_tools.PLOT_MODES or (num_shards > 0 and cache_dir is not None):
+        print('python run_iterative_igdetective.py genome.fasta output_dir [num_threads] [--plots none|deferred|inline] [--db results.db] [--label genome_label] [--cache cache_dir | --shards num_shards [--workers num_local_workers]] [--seeded] [--events events.jsonl]')
+        print('python run_iterative_igdetective.py --worker output_dir [--events events.jsonl]')
+        print('python run_iterative_igdetective.py --serve service.sock work_dir [num_threads] [--indexes max_cached_indexes] [--events events.jsonl]')
+        sys.exit(1)
+    genome_fasta = args[0]
+    output_dir = args[1]
+    num_threads = int(args[2]) if len(args) == 3 else 1
+    with progress_events.Stage('run', genome = os.path.abspath(genome_fasta), output_dir = os.path.abspath(output_dir)):
+        try:
+            main(genome_fasta, output_dir, ig_gene_dir, num_threads, plots, db_fname, label, cache_dir, num_shards, num_workers, seeded)
+        except stage_scheduler.StageError as e:
+            print('ERROR: ' + str(e))
+            sys.exit(1)